@@ -0,0 +1,76 @@
+﻿'''
+Benchmark: per-agent AWS clients vs the shared client pool
+
+Measures the cost of getting the Bedrock client and DynamoDB Table that
+one workflow needs, the way BaseAgent used to do it (new clients for
+every agent) and through utils.aws_clients. No AWS calls are made, so
+this runs without credentials or network access.
+
+Usage:
+    python benchmarks/bench_client_pool.py [--iterations 50]
+'''
+import argparse
+import os
+import statistics
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import boto3
+from agents.base_agent import BaseAgent
+from utils import aws_clients
+
+
+def legacy_agent_setup():
+    '''What BaseAgent.__init__ did before the pool: fresh clients every time'''
+    bedrock_client = boto3.client('bedrock-runtime', region_name='us-east-1')
+    dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+    state_table = dynamodb.Table('workflow-agent-agent-state')
+    return bedrock_client, state_table
+
+
+def pooled_agent_setup():
+    '''Current BaseAgent: handles resolved lazily from the shared pool'''
+    agent = BaseAgent('bench-agent')
+    return agent.bedrock_client, agent.state_table
+
+
+def measure(setup, iterations: int) -> dict:
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        setup()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    return {
+        'cold_ms': round(timings[0], 3),
+        'steady_mean_ms': round(statistics.mean(timings[1:]), 3),
+        'steady_p95_ms': round(sorted(timings[1:])[int(len(timings[1:]) * 0.95) - 1], 3)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=50)
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_REGION', 'us-east-1')
+
+    # Warm up botocore's shared data loaders so neither side pays for them
+    boto3.client('sts', region_name='us-east-1')
+
+    legacy = measure(legacy_agent_setup, args.iterations)
+
+    aws_clients.reset()
+    pooled = measure(pooled_agent_setup, args.iterations)
+
+    print(f'{"":10} {"cold (ms)":>12} {"steady mean (ms)":>18} {"steady p95 (ms)":>17}')
+    for name, result in [('legacy', legacy), ('pooled', pooled)]:
+        print(f'{name:10} {result["cold_ms"]:>12} {result["steady_mean_ms"]:>18} {result["steady_p95_ms"]:>17}')
+
+    speedup = legacy['steady_mean_ms'] / max(pooled['steady_mean_ms'], 1e-6)
+    print(f'\nSteady-state setup cost per workflow: {speedup:.0f}x lower with the pool')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+﻿'''
+Benchmark: standard vs token-economy triage prompts
+
+Classifies the same reports (a mix of short ones and long ones carrying
+logs and stack traces) with TRIAGE_TOKEN_ECONOMY off and on, against the
+stubbed Bedrock client with a per-output-token decode cost. Reports mean
+input/output/cached tokens, estimated cost and latency per request.
+
+Usage:
+    python benchmarks/bench_token_economy.py [--requests 200] [--long-ratio 0.3]
+'''
+import argparse
+import os
+import random
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import fakes
+from run_benchmarks import synthetic_reports, percentiles
+from agents.triage_agent import TriageAgent
+from observability.structured_logging import configure_logging
+
+
+MODEL_ID = 'anthropic.claude-3-5-haiku-20241022-v1:0'
+
+# USD per 1K tokens: input, output; cache reads cost 10% and writes 125% of input
+PRICES = (0.0008, 0.004)
+
+LOG_LINES = [
+    'ERROR [worker-{n}] Unhandled exception in request handler',
+    '  File "/srv/app/handlers.py", line {n}, in handle',
+    '    return self.dispatch(request)',
+    'WARN  connection pool exhausted, waited {n}ms',
+    'INFO  retrying upstream call (attempt {n})',
+]
+
+
+def long_reports(reports, seed: int = 11):
+    '''Reports padded with a few KB of pasted logs'''
+    rng = random.Random(seed)
+    return [
+        report + '\n\n' + '\n'.join(rng.choice(LOG_LINES).format(n=rng.randrange(1000)) for _ in range(80))
+        for report in reports
+    ]
+
+
+def run(reports, economy: bool) -> dict:
+    os.environ['TRIAGE_TOKEN_ECONOMY'] = 'true' if economy else 'false'
+    agent = TriageAgent()
+
+    latencies = []
+    for report in reports:
+        start = time.perf_counter()
+        agent.classify_request(report)
+        latencies.append(time.perf_counter() - start)
+
+    stats = next(iter(agent.token_stats().values()))
+    calls = stats['calls']
+    cost = (
+        stats['input_tokens'] * PRICES[0]
+        + stats['cache_read_tokens'] * PRICES[0] * 0.1
+        + stats['cache_write_tokens'] * PRICES[0] * 1.25
+        + stats['output_tokens'] * PRICES[1]
+    ) / 1000
+    return {
+        'input_tokens': stats['input_tokens'] / calls,
+        'output_tokens': stats['output_tokens'] / calls,
+        'cached_tokens': (stats['cache_read_tokens'] + stats['cache_write_tokens']) / calls,
+        'cost_per_1k': cost / calls * 1000,
+        'latency': percentiles(latencies)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--long-ratio', type=float, default=0.3, help='share of reports with pasted logs')
+    parser.add_argument('--latency-ms', type=float, default=150)
+    parser.add_argument('--output-token-ms', type=float, default=10, help='decode time per output token')
+    args = parser.parse_args()
+
+    configure_logging(level='WARNING')
+    os.environ['BEDROCK_MODEL_ID'] = MODEL_ID
+    # Every request should reach the model
+    os.environ['TRIAGE_CACHE_ENABLED'] = 'false'
+    os.environ['PRECLASSIFIER_ENABLED'] = 'false'
+    os.environ['MODEL_ROUTING_ENABLED'] = 'false'
+
+    reports = synthetic_reports(args.requests)
+    split = int(len(reports) * args.long_ratio)
+    reports = long_reports(reports[:split]) + reports[split:]
+    random.Random(3).shuffle(reports)
+
+    results = {}
+    for name, economy in [('standard', False), ('economy', True)]:
+        fakes.install(latency_ms=args.latency_ms, jitter_ms=args.latency_ms / 5, seed=1,
+                      output_token_ms=args.output_token_ms)
+        results[name] = run(reports, economy)
+
+    print(f'{"":10} {"input tok":>10} {"output tok":>11} {"cached tok":>11} {"$/1k req":>9} {"p50 ms":>8} {"p95 ms":>8}')
+    for name, result in results.items():
+        print(f'{name:10} {result["input_tokens"]:>10.0f} {result["output_tokens"]:>11.0f} '
+              f'{result["cached_tokens"]:>11.0f} {result["cost_per_1k"]:>9.3f} '
+              f'{result["latency"]["p50_ms"]:>8.0f} {result["latency"]["p95_ms"]:>8.0f}')
+
+    before, after = results['standard'], results['economy']
+    print(f'\nCost per request: {1 - after["cost_per_1k"] / before["cost_per_1k"]:.0%} lower, '
+          f'p50 latency: {1 - after["latency"]["p50_ms"] / before["latency"]["p50_ms"]:.0%} lower')
+
+
+if __name__ == '__main__':
+    main()
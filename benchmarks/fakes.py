@@ -0,0 +1,342 @@
+﻿'''
+Local stand-ins for AWS services used by the benchmarks
+
+FakeBedrockClient answers invoke_model / invoke_model_with_response_stream
+after a configurable latency with jitter, in Claude or Titan format. It
+honours max_tokens, stop sequences and assistant prefill, can charge
+decode time per output token, and reports prompt-cache usage for Claude
+system blocks marked with cache_control. A share of calls can be failed
+with ThrottlingException to exercise retries and fallbacks.
+InMemoryDynamoDB implements the slice of the DynamoDB resource API that
+the agents use (Table.put_item/get_item/query/scan/batch_writer).
+
+install() plugs both into utils.aws_clients so every agent picks them up.
+add_mcp_latency() makes an in-process MCP server behave like a remote one.
+'''
+import io
+import json
+import random
+import re
+import threading
+import time
+from decimal import Decimal
+from typing import Dict, Any, List, Optional, Tuple
+
+from botocore.exceptions import ClientError
+from utils import aws_clients
+
+
+CATEGORIES = ['bug', 'feature', 'question', 'incident']
+
+# Smallest prefix Bedrock will cache for Claude (tokens)
+CACHE_MIN_TOKENS = 1024
+
+# Free-form reasoning runs to a few sentences; the JSON format caps it
+VERBOSE_REASONING = (
+    'The report describes behaviour that differs from what the user expects in a '
+    'specific part of the product, which points to a defect rather than a request '
+    'for new functionality. The impact appears limited to a subset of users and '
+    'there is no indication of an outage, so the priority reflects a contained issue.'
+)
+PRIORITIES = ['P0', 'P1', 'P2', 'P3']
+
+
+class FakeBedrockClient:
+    '''Stubbed bedrock-runtime client with configurable latency'''
+
+    def __init__(
+        self,
+        latency_ms: float = 300,
+        jitter_ms: float = 100,
+        seed: Optional[int] = None,
+        output_token_ms: float = 0,
+        cache_min_tokens: int = CACHE_MIN_TOKENS,
+        throttle_rate: float = 0
+    ):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.output_token_ms = output_token_ms
+        self.throttle_rate = throttle_rate
+        self.cache_min_tokens = cache_min_tokens
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._cached_prefixes = set()
+        self.calls = 0
+
+    def invoke_model(self, modelId: str, body: str, **kwargs) -> Dict[str, Any]:
+        self._maybe_throttle('InvokeModel')
+        request = json.loads(body)
+        text = _shape(request, self._answer(request))
+
+        input_tokens, output_tokens = _estimate_tokens(request), len(text) // 4
+        time.sleep(self._delay() + output_tokens * self.output_token_ms / 1000)
+
+        if 'claude' in modelId:
+            usage = {'input_tokens': input_tokens, 'output_tokens': output_tokens}
+            usage.update(self._cache_usage(request))
+            usage['input_tokens'] -= usage.get('cache_read_input_tokens', 0) + usage.get('cache_creation_input_tokens', 0)
+            result = {
+                'content': [{'type': 'text', 'text': text}],
+                'usage': usage
+            }
+            input_tokens = usage['input_tokens']
+        else:
+            result = {
+                'inputTextTokenCount': input_tokens,
+                'results': [{'outputText': text, 'tokenCount': output_tokens}]
+            }
+
+        return {
+            'body': io.BytesIO(json.dumps(result).encode('utf-8')),
+            'ResponseMetadata': {'HTTPHeaders': {
+                'x-amzn-bedrock-input-token-count': str(input_tokens),
+                'x-amzn-bedrock-output-token-count': str(output_tokens)
+            }}
+        }
+
+    def invoke_model_with_response_stream(self, modelId: str, body: str, **kwargs) -> Dict[str, Any]:
+        self._maybe_throttle('InvokeModelWithResponseStream')
+        request = json.loads(body)
+        text = _shape(request, self._answer(request))
+        delay = self._delay() + len(text) // 4 * self.output_token_ms / 1000
+        chunks = [text[i:i + 16] for i in range(0, len(text), 16)] or ['']
+
+        def events():
+            # Time to first token is most of the latency; the rest is spread
+            time.sleep(delay * 0.7)
+            for i, chunk in enumerate(chunks):
+                time.sleep(delay * 0.3 / len(chunks))
+                if 'claude' in modelId:
+                    event = {'type': 'content_block_delta', 'delta': {'type': 'text_delta', 'text': chunk}}
+                else:
+                    event = {'outputText': chunk}
+                if i == len(chunks) - 1:
+                    # Bedrock attaches usage to the final chunk
+                    event['amazon-bedrock-invocationMetrics'] = {
+                        'inputTokenCount': _estimate_tokens(request),
+                        'outputTokenCount': len(text) // 4
+                    }
+                yield {'chunk': {'bytes': json.dumps(event).encode('utf-8')}}
+
+        return {'body': events()}
+
+    def _answer(self, request: Dict[str, Any]) -> str:
+        with self._lock:
+            self.calls += 1
+            rng = random.Random(self._random.random())
+
+        prompt = _prompt_text(request)
+        numbered = re.findall(r'^\[(\d+)\] ', prompt, re.MULTILINE)
+
+        def classification() -> str:
+            return (
+                f'Category: {rng.choice(CATEGORIES)}\n'
+                f'Priority: {rng.choice(PRIORITIES)}\n'
+                f'Reasoning: {VERBOSE_REASONING}\n'
+            )
+
+        if numbered:
+            return '\n'.join(f'[{n}]\n{classification()}' for n in numbered)
+        if '"category"' in prompt:
+            return json.dumps({
+                'category': rng.choice(CATEGORIES),
+                'priority': rng.choice(PRIORITIES),
+                'reasoning': 'Synthetic classification for benchmarking'
+            })
+        return classification()
+
+    def _cache_usage(self, request: Dict[str, Any]) -> Dict[str, int]:
+        '''Cache read/write tokens for a system prefix marked with cache_control'''
+        system = request.get('system') or []
+        if not any(isinstance(block, dict) and 'cache_control' in block for block in system):
+            return {}
+
+        prefix = ''.join(block.get('text', '') for block in system if isinstance(block, dict))
+        tokens = len(prefix) // 4
+        if tokens < self.cache_min_tokens:
+            # Bedrock ignores checkpoints on prefixes below the model's minimum
+            return {}
+
+        with self._lock:
+            hit = prefix in self._cached_prefixes
+            self._cached_prefixes.add(prefix)
+        return {'cache_read_input_tokens': tokens} if hit else {'cache_creation_input_tokens': tokens}
+
+    def _maybe_throttle(self, operation: str):
+        '''Reject a `throttle_rate` share of calls the way Bedrock does, after a short round trip'''
+        if not self.throttle_rate:
+            return
+        with self._lock:
+            throttled = self._random.random() < self.throttle_rate
+        if throttled:
+            time.sleep(min(self.latency_ms, 20) / 1000)
+            raise ClientError(
+                {'Error': {'Code': 'ThrottlingException', 'Message': 'Too many requests'}}, operation
+            )
+
+    def _delay(self) -> float:
+        with self._lock:
+            jitter = self._random.uniform(-self.jitter_ms, self.jitter_ms)
+        return max(0.0, self.latency_ms + jitter) / 1000
+
+
+class InMemoryTable:
+    '''Thread-safe in-memory DynamoDB Table (hash key + optional range key)'''
+
+    def __init__(self, name: str, hash_key: str, range_key: Optional[str] = None, write_latency_ms: float = 0):
+        self.name = name
+        self.hash_key = hash_key
+        self.range_key = range_key
+        self.write_latency_ms = write_latency_ms
+        self.items: Dict[Tuple, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self.writes = 0
+
+    def put_item(self, Item: Dict[str, Any], **kwargs):
+        if self.write_latency_ms:
+            time.sleep(self.write_latency_ms / 1000)
+        with self._lock:
+            self.items[self._key(Item)] = _to_dynamo(Item)
+            self.writes += 1
+        return {}
+
+    def get_item(self, Key: Dict[str, Any], **kwargs):
+        with self._lock:
+            item = self.items.get(self._key(Key))
+        return {'Item': dict(item)} if item else {}
+
+    def query(self, KeyConditionExpression=None, ScanIndexForward: bool = True, Limit: Optional[int] = None, **kwargs):
+        # Only equality on the hash key is supported
+        value = _condition_value(KeyConditionExpression)
+        with self._lock:
+            items = [dict(i) for k, i in self.items.items() if k[0] == value]
+        if self.range_key:
+            items.sort(key=lambda i: i[self.range_key], reverse=not ScanIndexForward)
+        return {'Items': items[:Limit] if Limit else items, 'Count': len(items)}
+
+    def scan(self, **kwargs):
+        with self._lock:
+            return {'Items': [dict(i) for i in self.items.values()]}
+
+    def batch_writer(self, overwrite_by_pkeys: Optional[List[str]] = None):
+        return _BatchWriter(self)
+
+    def _key(self, item: Dict[str, Any]) -> Tuple:
+        return (item[self.hash_key], item.get(self.range_key) if self.range_key else None)
+
+
+class InMemoryDynamoDB:
+    '''Stand-in for boto3.resource('dynamodb') with the project's tables'''
+
+    def __init__(self, write_latency_ms: float = 0):
+        self.write_latency_ms = write_latency_ms
+        self._tables: Dict[str, InMemoryTable] = {}
+        self._lock = threading.Lock()
+
+    def Table(self, name: str) -> InMemoryTable:
+        with self._lock:
+            if name not in self._tables:
+                # Key schemas mirror terraform/aws/main.tf
+                if name.endswith('-cache'):
+                    table = InMemoryTable(name, 'key', write_latency_ms=self.write_latency_ms)
+                else:
+                    table = InMemoryTable(name, 'workflow_id', 'timestamp', self.write_latency_ms)
+                self._tables[name] = table
+            return self._tables[name]
+
+
+class _BatchWriter:
+    def __init__(self, table: InMemoryTable):
+        self.table = table
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def put_item(self, Item: Dict[str, Any]):
+        self.table.put_item(Item=Item)
+
+
+def install(
+    latency_ms: float = 300,
+    jitter_ms: float = 100,
+    dynamo_latency_ms: float = 0,
+    seed: Optional[int] = None,
+    output_token_ms: float = 0,
+    throttle_rate: float = 0
+) -> Tuple[FakeBedrockClient, InMemoryDynamoDB]:
+    '''Route all Bedrock and DynamoDB access through fresh fakes'''
+    bedrock = FakeBedrockClient(latency_ms, jitter_ms, seed, output_token_ms, throttle_rate=throttle_rate)
+    dynamodb = InMemoryDynamoDB(dynamo_latency_ms)
+    aws_clients.reset()
+    aws_clients.override('bedrock-runtime', bedrock)
+    aws_clients.override('dynamodb', dynamodb)
+    return bedrock, dynamodb
+
+
+def add_mcp_latency(server, latency_ms: float, jitter_ms: float = 0, seed: Optional[int] = None):
+    '''Delay every execute() call on `server` as if it crossed the network'''
+    rng = random.Random(seed)
+    lock = threading.Lock()
+    execute = server.execute
+
+    def delayed(action: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        with lock:
+            jitter = rng.uniform(-jitter_ms, jitter_ms)
+        time.sleep(max(0.0, latency_ms + jitter) / 1000)
+        return execute(action, params)
+
+    server.execute = delayed
+    return server
+
+
+def _prompt_text(request: Dict[str, Any]) -> str:
+    if 'inputText' in request:
+        return request['inputText']
+    parts = []
+    for block in request.get('system', []) or []:
+        parts.append(block.get('text', '') if isinstance(block, dict) else str(block))
+    for message in request.get('messages', []):
+        content = message['content']
+        if isinstance(content, str):
+            parts.append(content)
+        else:
+            parts.extend(c.get('text', '') for c in content if isinstance(c, dict))
+    return '\n'.join(parts)
+
+
+def _shape(request: Dict[str, Any], text: str) -> str:
+    '''Apply assistant prefill, stop sequences and the output token budget'''
+    messages = request.get('messages') or []
+    if messages and messages[-1]['role'] == 'assistant':
+        # The model continues the prefilled answer rather than repeating it
+        prefill = messages[-1]['content']
+        if text.startswith(prefill):
+            text = text[len(prefill):]
+
+    for stop in request.get('stop_sequences') or []:
+        if stop in text:
+            text = text[:text.index(stop)]
+
+    max_tokens = request.get('max_tokens') or request.get('textGenerationConfig', {}).get('maxTokenCount')
+    if max_tokens:
+        text = text[:max_tokens * 4]
+    return text
+
+
+def _estimate_tokens(request: Dict[str, Any]) -> int:
+    return max(1, len(_prompt_text(request)) // 4)
+
+
+def _condition_value(condition) -> Any:
+    # boto3.dynamodb.conditions.Key('workflow_id').eq(value)
+    if condition is None:
+        return None
+    return condition.get_expression()['values'][1]
+
+
+def _to_dynamo(item: Dict[str, Any]) -> Dict[str, Any]:
+    # DynamoDB hands numbers back as Decimal
+    return {k: Decimal(str(v)) if isinstance(v, float) else v for k, v in item.items()}
@@ -0,0 +1,316 @@
+﻿'''
+Open-loop replay of a traffic trace against the workflow pipeline
+
+Reads a JSONL trace, one request per line:
+
+    {"timestamp": "2024-06-03T09:00:01+00:00", "user_input": "...", "channel": "#bugs"}
+
+(timestamp may also be epoch seconds) and starts every workflow at its
+scheduled time whether or not earlier ones have finished, through the
+same priority scheduler the queue worker uses. Arrivals keep the trace's
+shape, compressed by --speedup, or are re-spaced at a fixed --rate.
+Bedrock and DynamoDB are the fakes from benchmarks/fakes.py (or real
+AWS with --backend aws); the MCP servers can be given network latency.
+
+Latency is measured from the scheduled start. A driver that waits for a
+free worker before starting the clock (or a closed loop) stops measuring
+exactly when the system saturates and under-reports the latencies that
+matter (coordinated omission). Both views are reported: "service" is the
+time a worker spent on a workflow, "response" is what the reporter
+waited, including queueing.
+
+Usage:
+    python benchmarks/replay.py --generate /tmp/burst.jsonl --shape burst --requests 600 --span-s 120
+    python benchmarks/replay.py /tmp/burst.jsonl --speedup 4 --concurrency 16
+    python benchmarks/replay.py /tmp/burst.jsonl --rate 40 --poisson --output /tmp/replay.json
+'''
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import fakes
+from run_benchmarks import synthetic_reports, percentiles
+from observability.structured_logging import configure_logging, flush_logs
+from utils import state_writer
+from workflows.orchestrator import WorkflowOrchestrator
+
+
+SHAPES = ('steady', 'burst', 'backlog')
+
+# Reports filed during the simulated outage in a 'burst' trace
+OUTAGE_REPORTS = [
+    'Checkout is down for all customers, payments fail with a 500 error',
+    'Production outage: the site returns 503 for every page',
+    'Cannot log in, the login service is down for everyone',
+    'All orders are failing since a few minutes ago, revenue impacted',
+    'The API is down and our integration is completely broken',
+]
+
+
+def generate_trace(path: str, shape: str, requests: int, span_s: float, seed: int = 1):
+    '''
+    Write a synthetic trace
+
+    steady: uniform arrivals over the span. burst: the same, plus 30% of
+    the requests packed into a tenth of the span as outage reports.
+    backlog: a Monday morning; 40% arrive in the first 5% of the span,
+    the rest at a rate that tapers off.
+    '''
+    rng = random.Random(seed)
+    reports = synthetic_reports(requests, seed=seed)
+    arrivals = []
+    for i in range(requests):
+        u = rng.random()
+        if shape == 'burst' and i < requests * 0.3:
+            arrivals.append((span_s * (0.4 + 0.1 * u), True))
+        elif shape == 'backlog' and i < requests * 0.4:
+            arrivals.append((span_s * 0.05 * u, False))
+        elif shape == 'backlog':
+            # Density falling linearly to zero at the end of the span
+            arrivals.append((span_s * (0.05 + 0.95 * (1 - math.sqrt(1 - u))), False))
+        else:
+            arrivals.append((span_s * u, False))
+    arrivals.sort()
+
+    # A Monday, 09:00 UTC
+    start = datetime(2024, 6, 3, 9, 0, tzinfo=timezone.utc)
+    with open(path, 'w', encoding='utf-8') as f:
+        for i, (offset, outage) in enumerate(arrivals):
+            f.write(json.dumps({
+                'timestamp': (start + timedelta(seconds=offset)).isoformat(),
+                'user_input': f'{rng.choice(OUTAGE_REPORTS)} (report {i})' if outage else reports[i],
+                'channel': '#incidents' if outage else '#bugs'
+            }) + '\n')
+
+
+def load_trace(path: str) -> List[Dict[str, Any]]:
+    '''Trace entries sorted by time, each with 'offset' (seconds after the first)'''
+    entries = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                entry['time'] = _parse_timestamp(entry['timestamp'])
+                entries.append(entry)
+
+    entries.sort(key=lambda entry: entry['time'])
+    first = entries[0]['time'] if entries else 0.0
+    for entry in entries:
+        entry['offset'] = entry['time'] - first
+    return entries
+
+
+def schedule(
+    entries: List[Dict[str, Any]],
+    speedup: float = 1.0,
+    rate: Optional[float] = None,
+    poisson: bool = False,
+    seed: int = 1
+) -> List[float]:
+    '''Start offsets (seconds after replay start), one per entry'''
+    if rate is None:
+        return [entry['offset'] / speedup for entry in entries]
+
+    rng = random.Random(seed)
+    offsets, t = [], 0.0
+    for _ in entries:
+        offsets.append(t)
+        t += rng.expovariate(rate) if poisson else 1.0 / rate
+    return offsets
+
+
+def replay(
+    orchestrator: WorkflowOrchestrator,
+    entries: List[Dict[str, Any]],
+    offsets: List[float],
+    concurrency: int
+) -> Dict[str, Any]:
+    '''Start each entry at its offset, open-loop, and time every workflow'''
+    scheduler = orchestrator.build_scheduler(concurrency, name='replay')
+    records: List[Dict[str, Any]] = [None] * len(entries)
+
+    def run(index: int, item: Dict[str, Any], scheduled: float):
+        started = time.perf_counter()
+        state = orchestrator.run_isolated(item)
+        records[index] = {
+            'scheduled': scheduled - origin,
+            'started': started - origin,
+            'finished': time.perf_counter() - origin,
+            'status': state['status'],
+            'error': state['error'].split(':', 1)[0] if state['error'] else '',
+            'fallback': bool((state.get('classification') or {}).get('fallback'))
+        }
+
+    futures = []
+    max_lag = 0.0
+    # A short lead so the first arrivals are not late before we start
+    origin = time.perf_counter() + 0.05
+    try:
+        for index, (entry, offset) in enumerate(zip(entries, offsets)):
+            scheduled = origin + offset
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            # Late dispatch is still timed from `scheduled`; the lag only
+            # says how far the driver itself fell behind
+            max_lag = max(max_lag, time.perf_counter() - scheduled)
+
+            item = {'user_input': entry['user_input'], 'channel': entry.get('channel', '#bugs')}
+            futures.append(scheduler.submit(orchestrator.admission_priority(item), run, index, item, scheduled))
+
+        for future in futures:
+            future.result()
+    finally:
+        scheduler.shutdown()
+        state_writer.flush_all()
+
+    return {'records': records, 'max_dispatch_lag_s': round(max_lag, 4)}
+
+
+def summarize(records: List[Dict[str, Any]], window_s: float) -> Dict[str, Any]:
+    '''Overall and per-window latency, queueing, throughput and errors'''
+    end = max(r['finished'] for r in records)
+    span = max(r['scheduled'] for r in records) or 1e-9
+
+    summary = {
+        'requests': len(records),
+        'failed': sum(1 for r in records if r['status'] == 'failed'),
+        'fallbacks': sum(1 for r in records if r['fallback']),
+        'errors': dict(Counter(r['error'] for r in records if r['error'])),
+        'offered_per_s': round(len(records) / span, 2),
+        'completed_per_s': round(len(records) / end, 2),
+        'response': percentiles([r['finished'] - r['scheduled'] for r in records]),
+        'service': percentiles([r['finished'] - r['started'] for r in records]),
+        'queue': percentiles([r['started'] - r['scheduled'] for r in records]),
+        'windows': []
+    }
+
+    for w in range(int(end // window_s) + 1):
+        lo, hi = w * window_s, (w + 1) * window_s
+        arrived = [r for r in records if lo <= r['scheduled'] < hi]
+        completed = [r for r in records if lo <= r['finished'] < hi]
+        response = percentiles([r['finished'] - r['scheduled'] for r in arrived])
+        queue = percentiles([r['started'] - r['scheduled'] for r in arrived])
+        summary['windows'].append({
+            'start_s': lo,
+            'arrivals': len(arrived),
+            'offered_per_s': round(len(arrived) / window_s, 2),
+            'completed_per_s': round(len(completed) / window_s, 2),
+            'in_flight_at_end': sum(1 for r in records if r['scheduled'] < hi <= r['finished']),
+            'errors': sum(1 for r in arrived if r['status'] == 'failed'),
+            'fallbacks': sum(1 for r in arrived if r['fallback']),
+            'response_p50_ms': response.get('p50_ms'),
+            'response_p99_ms': response.get('p99_ms'),
+            'queue_p95_ms': queue.get('p95_ms'),
+        })
+
+    # Saturation: arrivals start waiting longer for a worker than a workflow takes
+    service_p95 = summary['service']['p95_ms']
+    saturated = [w['start_s'] for w in summary['windows'] if (w['queue_p95_ms'] or 0) > service_p95]
+    summary['saturated_from_s'] = saturated[0] if saturated else None
+    return summary
+
+
+def print_summary(summary: Dict[str, Any]):
+    print(f'\n{"t (s)":>7} {"arrive/s":>9} {"done/s":>8} {"in flight":>10} {"errors":>7} '
+          f'{"resp p50":>9} {"resp p99":>9} {"queue p95":>10}')
+    for w in summary['windows']:
+        print(f'{w["start_s"]:>7.0f} {w["offered_per_s"]:>9} {w["completed_per_s"]:>8} {w["in_flight_at_end"]:>10} '
+              f'{w["errors"]:>7} {_ms(w["response_p50_ms"]):>9} {_ms(w["response_p99_ms"]):>9} {_ms(w["queue_p95_ms"]):>10}')
+
+    print(f'\n{"":10} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"max ms":>9}')
+    for name in ('response', 'service', 'queue'):
+        stats = summary[name]
+        print(f'{name:10} {stats["p50_ms"]:>9.1f} {stats["p95_ms"]:>9.1f} {stats["p99_ms"]:>9.1f} {stats["max_ms"]:>9.1f}')
+
+    print(f'\nOffered {summary["offered_per_s"]}/s, completed {summary["completed_per_s"]}/s; '
+          f'{summary["failed"]} failed, {summary["fallbacks"]} fallback classifications')
+    if summary['errors']:
+        print(f'Errors: {summary["errors"]}')
+    if summary['saturated_from_s'] is not None:
+        print(f'Saturated from t={summary["saturated_from_s"]:.0f}s: queueing p95 exceeded service p95')
+    print(f'Driver lag (max): {summary["max_dispatch_lag_s"] * 1000:.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('trace', nargs='?', help='JSONL trace to replay')
+    parser.add_argument('--generate', metavar='PATH', help='Write a synthetic trace to PATH and exit')
+    parser.add_argument('--shape', choices=SHAPES, default='burst')
+    parser.add_argument('--requests', type=int, default=600)
+    parser.add_argument('--span-s', type=float, default=120, help='Trace length in seconds')
+    parser.add_argument('--speedup', type=float, default=1.0, help='Replay the trace this many times faster')
+    parser.add_argument('--rate', type=float, help='Ignore trace timing; start this many workflows per second')
+    parser.add_argument('--poisson', action='store_true', help='Exponential gaps with --rate')
+    parser.add_argument('--limit', type=int, help='Replay only the first N requests')
+    parser.add_argument('--concurrency', type=int, default=8, help='Workflow workers')
+    parser.add_argument('--window-s', type=float, default=5, help='Reporting window')
+    parser.add_argument('--backend', choices=('fake', 'aws'), default='fake', help='Bedrock/DynamoDB backend')
+    parser.add_argument('--latency-ms', type=float, default=300, help='Fake Bedrock latency')
+    parser.add_argument('--jitter-ms', type=float, default=100, help='Fake Bedrock jitter (+/-)')
+    parser.add_argument('--throttle-rate', type=float, default=0, help='Share of fake Bedrock calls throttled')
+    parser.add_argument('--dynamo-latency-ms', type=float, default=5, help='Fake DynamoDB write latency')
+    parser.add_argument('--mcp-latency-ms', type=float, default=0, help='Latency added to each MCP call')
+    parser.add_argument('--mcp-jitter-ms', type=float, default=0)
+    parser.add_argument('--output', help='Save the summary and per-request records as JSON')
+    args = parser.parse_args()
+
+    if args.generate:
+        generate_trace(args.generate, args.shape, args.requests, args.span_s)
+        print(f'Wrote {args.requests} requests ({args.shape}) to {args.generate}')
+        return
+    if not args.trace:
+        parser.error('a trace file (or --generate) is required')
+
+    entries = load_trace(args.trace)[:args.limit]
+    offsets = schedule(entries, args.speedup, args.rate, args.poisson)
+
+    if args.backend == 'fake':
+        fakes.install(args.latency_ms, args.jitter_ms, args.dynamo_latency_ms, seed=1,
+                      throttle_rate=args.throttle_rate)
+
+    with open(os.devnull, 'w') as devnull:
+        configure_logging(stream=devnull)
+        orchestrator = WorkflowOrchestrator(max_concurrency=args.concurrency)
+        if args.mcp_latency_ms:
+            for server in (orchestrator.jira_mcp, orchestrator.slack_mcp):
+                fakes.add_mcp_latency(server, args.mcp_latency_ms, args.mcp_jitter_ms, seed=1)
+
+        print(f'Replaying {len(entries)} requests over {offsets[-1]:.1f}s '
+              f'with {args.concurrency} workers...', file=sys.stderr)
+        result = replay(orchestrator, entries, offsets, args.concurrency)
+        flush_logs()
+
+    summary = summarize(result['records'], args.window_s)
+    summary['max_dispatch_lag_s'] = result['max_dispatch_lag_s']
+    print_summary(summary)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'config': vars(args), 'summary': summary, 'records': result['records']}, f, indent=2)
+        print(f'\nResults saved to {args.output}')
+
+
+def _parse_timestamp(value) -> float:
+    if isinstance(value, (int, float)):
+        return float(value)
+    # fromisoformat() only accepts a trailing Z from Python 3.11
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+def _ms(value: Optional[float]) -> str:
+    return '-' if value is None else f'{value:.0f}'
+
+
+if __name__ == '__main__':
+    main()
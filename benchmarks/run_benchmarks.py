@@ -0,0 +1,314 @@
+﻿'''
+Benchmark suite for the workflow pipeline
+
+Runs WorkflowOrchestrator end to end, plus TriageAgent, JiraMCPServer and
+SlackMCPServer on their own, against a stubbed Bedrock client (configurable
+latency/jitter) and an in-memory DynamoDB. Reports per-node and end-to-end
+p50/p95/p99 latency, throughput and allocations at several concurrency
+levels, and saves everything as JSON so runs can be compared across commits.
+
+Usage:
+    python benchmarks/run_benchmarks.py --concurrency 1,8,32 --workflows 200
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/<old>.json
+'''
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Callable
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import fakes
+from agents.triage_agent import TriageAgent
+from mcp_servers.jira_mcp import JiraMCPServer
+from mcp_servers.slack_mcp import SlackMCPServer
+from observability.structured_logging import configure_logging, flush_logs
+from utils import state_writer
+from workflows.orchestrator import WorkflowOrchestrator
+
+
+# Vocabulary chosen to avoid the pre-classifier rules and dedup matches,
+# so every workflow exercises the full path including the model call
+SUBJECTS = ['checkout', 'invoice', 'profile page', 'search', 'export', 'dashboard',
+            'login form', 'report builder', 'notification', 'billing page', 'upload']
+PROBLEMS = ['shows the wrong total', 'is slow to load', 'fails intermittently',
+            'renders incorrectly', 'times out', 'loses my changes', 'shows stale data',
+            'returns an empty list', 'ignores my filter', 'crashes the tab']
+CONTEXTS = ['on mobile', 'in Safari', 'for EU customers', 'after the last release',
+            'for admins', 'on large accounts', 'when offline', 'since Monday']
+
+
+def synthetic_reports(count: int, seed: int = 7) -> List[str]:
+    '''Distinct, realistic-looking reports'''
+    rng = random.Random(seed)
+    return [
+        f'The {rng.choice(SUBJECTS)} {rng.choice(PROBLEMS)} {rng.choice(CONTEXTS)} '
+        f'(ticket ref {i}-{rng.randrange(10**6)}, account {rng.randrange(10**5)})'
+        for i in range(count)
+    ]
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    '''p50/p95/p99/mean/max in milliseconds'''
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    return {
+        'count': len(ordered),
+        'p50_ms': round(pick(0.50) * 1000, 3),
+        'p95_ms': round(pick(0.95) * 1000, 3),
+        'p99_ms': round(pick(0.99) * 1000, 3),
+        'mean_ms': round(sum(ordered) / len(ordered) * 1000, 3),
+        'max_ms': round(ordered[-1] * 1000, 3)
+    }
+
+
+def instrument_nodes(orchestrator: WorkflowOrchestrator) -> Dict[str, List[float]]:
+    '''Wrap every *_step node with a timer and rebuild the graph'''
+    timings: Dict[str, List[float]] = {}
+
+    for attr in dir(orchestrator):
+        if not (attr.startswith('_') and attr.endswith('_step')):
+            continue
+        node = attr[1:-len('_step')]
+        samples = timings.setdefault(node, [])
+        original = getattr(orchestrator, attr)
+
+        def timed(state, _original=original, _samples=samples):
+            start = time.perf_counter()
+            try:
+                return _original(state)
+            finally:
+                _samples.append(time.perf_counter() - start)
+
+        setattr(orchestrator, attr, timed)
+
+    orchestrator.workflow = orchestrator._build_workflow()
+    return timings
+
+
+def bench_workflows(args, concurrency: int) -> Dict[str, Any]:
+    fakes.install(args.latency_ms, args.jitter_ms, args.dynamo_latency_ms, seed=concurrency)
+    orchestrator = WorkflowOrchestrator(max_concurrency=concurrency)
+    node_timings = instrument_nodes(orchestrator)
+    reports = synthetic_reports(args.workflows, seed=concurrency)
+
+    end_to_end = []
+    run_isolated = orchestrator.run_isolated
+
+    def run_one(item):
+        start = time.perf_counter()
+        try:
+            return run_isolated(item)
+        finally:
+            end_to_end.append(time.perf_counter() - start)
+
+    # run_batch maps self.run_isolated, so timing it here covers each workflow
+    orchestrator.run_isolated = run_one
+    start = time.perf_counter()
+    results = orchestrator.run_batch(reports, max_concurrency=concurrency)
+    elapsed = time.perf_counter() - start
+    state_writer.flush_all()
+
+    return {
+        'concurrency': concurrency,
+        'workflows': len(results),
+        'failed': sum(1 for r in results if r['status'] == 'failed'),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_per_s': round(len(results) / elapsed, 2),
+        'end_to_end': percentiles(end_to_end),
+        'nodes': {node: percentiles(samples) for node, samples in node_timings.items() if samples}
+    }
+
+
+def bench_allocations(args) -> Dict[str, Any]:
+    '''Memory allocated per workflow (zero-latency fakes so tracing dominates less)'''
+    fakes.install(0, 0, seed=1)
+    orchestrator = WorkflowOrchestrator(max_concurrency=1)
+    reports = synthetic_reports(args.alloc_workflows, seed=99)
+
+    # Warm up imports and lazy clients outside the measurement
+    orchestrator.run(reports[0])
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for report in reports[1:]:
+        orchestrator.run(report)
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    runs = max(1, len(reports) - 1)
+    stats = after.compare_to(before, 'filename')
+    allocated = sum(s.size_diff for s in stats if s.size_diff > 0)
+    top = sorted(stats, key=lambda s: s.size_diff, reverse=True)[:5]
+
+    return {
+        'workflows': runs,
+        'retained_kib_per_workflow': round(allocated / runs / 1024, 3),
+        'peak_traced_kib': round(peak / 1024, 1),
+        'top_retaining_files': [
+            {'file': str(s.traceback[0].filename), 'kib': round(s.size_diff / 1024, 1)}
+            for s in top
+        ]
+    }
+
+
+def time_calls(fn: Callable[[int], Any], count: int) -> Dict[str, Any]:
+    samples = []
+    for i in range(count):
+        start = time.perf_counter()
+        fn(i)
+        samples.append(time.perf_counter() - start)
+    return percentiles(samples)
+
+
+def bench_components(args) -> Dict[str, Any]:
+    fakes.install(args.latency_ms, args.jitter_ms, seed=3)
+    reports = synthetic_reports(1000, seed=5)
+    results = {}
+
+    def report(i: int) -> str:
+        return reports[i % len(reports)]
+
+    triage = TriageAgent()
+    results['triage.classify_request'] = time_calls(
+        lambda i: triage.classify_request(report(i)), min(args.component_calls, 50)
+    )
+
+    for size in args.jira_sizes:
+        jira = JiraMCPServer()
+        for i in range(size):
+            jira.execute('create_ticket', {'title': report(i)[:100], 'description': report(i),
+                                           'ticket_type': 'Bug'})
+        results[f'jira.create_ticket@{size}'] = time_calls(
+            lambda i: jira.execute('create_ticket', {'title': report(i)[:100], 'description': report(i),
+                                                     'ticket_type': 'Bug'}),
+            args.component_calls
+        )
+        results[f'jira.get_ticket@{size}'] = time_calls(
+            lambda i: jira.execute('get_ticket', {'ticket_id': f'BUG-{(i * 7919) % size + 1}'}),
+            args.component_calls
+        )
+        results[f'jira.search_tickets@{size}'] = time_calls(
+            lambda i: jira.execute('search_tickets', {'query': random.choice(SUBJECTS), 'limit': 10}),
+            args.component_calls
+        )
+
+    slack = SlackMCPServer()
+    channels = [f'#team-{i}' for i in range(20)]
+    results['slack.send_message'] = time_calls(
+        lambda i: slack.execute('send_message', {'channel': channels[i % 20], 'text': report(i)}),
+        max(args.component_calls, 5000)
+    )
+    results['slack.get_messages'] = time_calls(
+        lambda i: slack.execute('get_messages', {'channel': channels[i % 20], 'limit': 20}),
+        args.component_calls
+    )
+
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return 'unknown'
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]):
+    '''Print p95/throughput deltas against a previous results file'''
+    print(f'\nComparison against {baseline["commit"]} ({baseline["timestamp"]}):')
+    previous = {r['concurrency']: r for r in baseline['workflows']}
+    for result in current['workflows']:
+        old = previous.get(result['concurrency'])
+        if not old:
+            continue
+        p95_new, p95_old = result['end_to_end']['p95_ms'], old['end_to_end']['p95_ms']
+        tput_new, tput_old = result['throughput_per_s'], old['throughput_per_s']
+        print(f'  concurrency {result["concurrency"]:>3}: '
+              f'p95 {p95_old:.1f} -> {p95_new:.1f} ms ({(p95_new / p95_old - 1) * 100:+.1f}%), '
+              f'throughput {tput_old:.1f} -> {tput_new:.1f}/s ({(tput_new / tput_old - 1) * 100:+.1f}%)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Workflow pipeline benchmarks')
+    parser.add_argument('--concurrency', default='1,8,32',
+                        help='Comma-separated concurrency levels')
+    parser.add_argument('--workflows', type=int, default=200)
+    parser.add_argument('--latency-ms', type=float, default=300, help='Fake Bedrock latency')
+    parser.add_argument('--jitter-ms', type=float, default=100, help='Fake Bedrock jitter (+/-)')
+    parser.add_argument('--dynamo-latency-ms', type=float, default=5, help='Fake DynamoDB write latency')
+    parser.add_argument('--alloc-workflows', type=int, default=50)
+    parser.add_argument('--component-calls', type=int, default=500)
+    parser.add_argument('--jira-sizes', default='1000,100000',
+                        help='Comma-separated ticket counts for the Jira benchmarks')
+    parser.add_argument('--output', help='Results file (default: benchmarks/results/<commit>.json)')
+    parser.add_argument('--compare', help='Previous results file to compare against')
+    args = parser.parse_args()
+    args.jira_sizes = [int(s) for s in args.jira_sizes.split(',')]
+
+    results = {
+        'commit': git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'config': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+        'workflows': []
+    }
+
+    # The pipeline logs every step; keep the logging cost but not the output
+    with open(os.devnull, 'w') as devnull:
+        configure_logging(stream=devnull)
+
+        for level in [int(c) for c in args.concurrency.split(',')]:
+            print(f'Running {args.workflows} workflows at concurrency {level}...', file=sys.stderr)
+            results['workflows'].append(bench_workflows(args, level))
+
+        print('Measuring allocations...', file=sys.stderr)
+        results['allocations'] = bench_allocations(args)
+
+        print('Running component benchmarks...', file=sys.stderr)
+        results['components'] = bench_components(args)
+
+        flush_logs()
+
+    print(f'\n{"concurrency":>11} {"wf/s":>8} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9}')
+    for r in results['workflows']:
+        e2e = r['end_to_end']
+        print(f'{r["concurrency"]:>11} {r["throughput_per_s"]:>8} {e2e["p50_ms"]:>9} {e2e["p95_ms"]:>9} {e2e["p99_ms"]:>9}')
+
+    print('\nPer-node p95 (ms) at the highest concurrency:')
+    for node, stats in results['workflows'][-1]['nodes'].items():
+        print(f'  {node:>14}: {stats["p95_ms"]}')
+
+    print(f'\nRetained per workflow: {results["allocations"]["retained_kib_per_workflow"]} KiB')
+
+    print('\nComponents (p50 / p99 ms):')
+    for name, stats in results['components'].items():
+        print(f'  {name:>32}: {stats["p50_ms"]} / {stats["p99_ms"]}')
+
+    output = args.output or os.path.join(os.path.dirname(__file__), 'results', f'{results["commit"]}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'\nResults saved to {output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,24 @@
-﻿import boto3
+﻿import asyncio
+import functools
+import itertools
 import json
-from typing import Dict, Any, Optional
+import logging
+from typing import Dict, Any, Iterator, List, Optional, Tuple
 import os
+import re
+import time
 from datetime import datetime
+from boto3.dynamodb.conditions import Key
+from observability import metrics
+from observability.structured_logging import get_logger
+from utils import aws_clients, state_records
+from utils.llm_policy import get_llm_policy
+from utils.rate_limiter import estimate_tokens, get_rate_limiter
+from utils.state_writer import get_state_writer
+
+
+# Claude models on Bedrock that accept cache_control checkpoints
+PROMPT_CACHING_MODELS = re.compile(r'claude-(3-5-haiku|3-7-sonnet|(sonnet|opus|haiku)-4)')
 
 
 class BaseAgent:
@@ -10,75 +26,335 @@ class BaseAgent:
     
     def __init__(self, agent_name: str):
         self.agent_name = agent_name
-        self.bedrock_client = boto3.client(
-            'bedrock-runtime',
-            region_name=os.getenv('AWS_REGION', 'us-east-1')
-        )
+        self.logger = get_logger(f'agent.{agent_name}')
         self.model_id = os.getenv(
             'BEDROCK_MODEL_ID',
             'amazon.titan-text-express-v1'
         )
-        self.dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
-        self.state_table = self.dynamodb.Table(
-            os.getenv('DYNAMODB_STATE_TABLE', 'workflow-agent-agent-state')
+        self.state_table_name = os.getenv(
+            'DYNAMODB_STATE_TABLE', 'workflow-agent-agent-state'
         )
     
-    def call_llm(self, prompt: str, max_tokens: int = 1000) -> str:
+    # AWS handles come from the process-wide pool and are created on first use
+    
+    @property
+    def bedrock_client(self):
+        return aws_clients.get_client('bedrock-runtime')
+    
+    @property
+    def dynamodb(self):
+        return aws_clients.get_resource('dynamodb')
+    
+    @property
+    def state_table(self):
+        return aws_clients.get_table(self.state_table_name)
+    
+    def call_llm(self, prompt: str, max_tokens: int = 1000, model_id: Optional[str] = None) -> str:
         '''Call LLM via Bedrock (supports Claude and Titan)'''
+        return self.call_llm_with_usage(prompt, max_tokens, model_id)[0]
+    
+    def call_llm_with_usage(
+        self,
+        prompt: str,
+        max_tokens: int = 1000,
+        model_id: Optional[str] = None,
+        system: Optional[str] = None,
+        stop_sequences: Optional[List[str]] = None,
+        prefill: Optional[str] = None
+    ) -> Tuple[str, Dict[str, Any]]:
+        '''
+        Call the LLM and also return what the call cost
+        
+        `model_id` overrides the agent's model for this call. `system` is
+        a static prefix, sent as a prompt-cache checkpoint on models that
+        support it. `prefill` starts the model's answer (Claude only) and
+        is included in the returned text.
+        
+        The usage dict has model_id, input_tokens, output_tokens,
+        cache_read_tokens, cache_write_tokens (None if Bedrock did not
+        report them) and latency in seconds (including retries).
+        
+        Raises LLMUnavailableError when the call policy gives up (deadline,
+        retries exhausted or circuit open) or the rate limiter has no room.
+        '''
+        model_id = model_id or self.model_id
+        body = json.dumps(self._build_body(prompt, max_tokens, model_id, system, stop_sequences, prefill))
+        estimated = estimate_tokens(prompt + (system or ''), max_tokens)
+        
+        def request():
+            response = self.bedrock_client.invoke_model(modelId=model_id, body=body)
+            return response, json.loads(response['body'].read())
+        
         try:
-            # Different format for Claude vs Titan
-            if 'claude' in self.model_id:
-                body = {
-                    'anthropic_version': 'bedrock-2023-05-31',
-                    'max_tokens': max_tokens,
-                    'messages': [
-                        {'role': 'user', 'content': prompt}
-                    ]
-                }
-            else:  # Titan
-                body = {
-                    'inputText': prompt,
-                    'textGenerationConfig': {
-                        'maxTokenCount': max_tokens,
-                        'temperature': 0.7
-                    }
-                }
+            start = time.perf_counter()
+            response, result = self._with_policy(model_id, request, estimated)
             
-            response = self.bedrock_client.invoke_model(
-                modelId=self.model_id,
-                body=json.dumps(body)
-            )
+            latency = time.perf_counter() - start
+            input_tokens, output_tokens = self._token_usage(response, result, model_id)
+            cache_read_tokens, cache_write_tokens = self._cache_usage(response, result)
+            self._settle_tokens(estimated, input_tokens, output_tokens)
+            metrics.observe_bedrock(model_id, latency, input_tokens, output_tokens)
             
-            result = json.loads(response['body'].read())
+            text = self._extract_text(result, model_id)
+            if prefill and 'claude' in model_id:
+                text = prefill + text
             
-            # Different response format for Claude vs Titan
-            if 'claude' in self.model_id:
-                return result['content'][0]['text']
-            else:  # Titan
-                return result['results'][0]['outputText']
+            return text, {
+                'model_id': model_id,
+                'input_tokens': input_tokens,
+                'output_tokens': output_tokens,
+                'cache_read_tokens': cache_read_tokens,
+                'cache_write_tokens': cache_write_tokens,
+                'latency': latency
+            }
             
         except Exception as e:
-            print(f'❌ LLM Error in {self.agent_name}: {str(e)}')
+            self.logger.error(f'LLM error: {str(e)}', extra={'model_id': model_id})
             raise
     
-    def save_state(self, workflow_id: str, state: Dict[str, Any]):
-        '''Save workflow state to DynamoDB'''
+    async def acall_llm(self, prompt: str, max_tokens: int = 1000, model_id: Optional[str] = None) -> str:
+        '''
+        Async variant of call_llm
+        
+        boto3 has no native asyncio transport, so the blocking call runs
+        on the event loop's executor and the loop stays free meanwhile.
+        '''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(self.call_llm, prompt, max_tokens, model_id)
+        )
+    
+    def call_llm_stream(
+        self,
+        prompt: str,
+        max_tokens: int = 1000,
+        model_id: Optional[str] = None
+    ) -> Iterator[str]:
+        '''
+        Stream LLM output via invoke_model_with_response_stream
+        
+        Yields text fragments as they arrive. Closing the generator early
+        (e.g. breaking out of the loop) closes the underlying stream.
+        '''
+        model_id = model_id or self.model_id
+        start = time.perf_counter()
+        usage = (None, None)
+        body = json.dumps(self._build_body(prompt, max_tokens, model_id))
+        estimated = estimate_tokens(prompt, max_tokens)
+        try:
+            # The policy covers opening the stream, not reading it
+            response = self._with_policy(
+                model_id,
+                lambda: self.bedrock_client.invoke_model_with_response_stream(modelId=model_id, body=body),
+                estimated
+            )
+        except Exception as e:
+            self.logger.error(f'LLM error: {str(e)}', extra={'model_id': model_id})
+            raise
+        
+        stream = response['body']
         try:
-            self.state_table.put_item(
-                Item={
-                    'workflow_id': workflow_id,
-                    'timestamp': int(datetime.now().timestamp()),
-                    'agent': self.agent_name,
-                    'state': json.dumps(state),
-                    'updated_at': datetime.now().isoformat()
+            for event in stream:
+                if 'chunk' not in event:
+                    # Modeled stream errors arrive as events, not exceptions
+                    error = next(iter(event.values()), {})
+                    raise RuntimeError(f'Bedrock stream error: {error}')
+                
+                chunk = json.loads(event['chunk']['bytes'])
+                if 'amazon-bedrock-invocationMetrics' in chunk:
+                    invocation = chunk['amazon-bedrock-invocationMetrics']
+                    usage = (invocation.get('inputTokenCount'), invocation.get('outputTokenCount'))
+                
+                text = self._extract_stream_text(chunk, model_id)
+                if text:
+                    yield text
+        finally:
+            if hasattr(stream, 'close'):
+                stream.close()
+            # Token counts only arrive with the last chunk, so an early
+            # close records latency alone (and keeps the estimate charged)
+            self._settle_tokens(estimated, *usage)
+            metrics.observe_bedrock(
+                model_id, time.perf_counter() - start, *usage, mode='stream'
+            )
+    
+    def _with_policy(self, model_id: str, request, estimated_tokens: int):
+        '''
+        Run a Bedrock request under the shared rate limiter and call policy
+        
+        Every attempt the policy sends, retries and hedges included, takes
+        a request slot and the estimated tokens. The first attempt's share
+        is taken here, before the policy's deadline starts, so ordinary
+        local queueing never counts as a Bedrock failure.
+        '''
+        limiter = get_rate_limiter()
+        if limiter is not None:
+            limiter.acquire(model_id, estimated_tokens)
+            attempts = itertools.count()
+            send = request
+            
+            def request():
+                if next(attempts):
+                    limiter.acquire(model_id, estimated_tokens)
+                return send()
+        
+        policy = get_llm_policy()
+        if policy is None:
+            return request()
+        return policy.call(model_id, request)
+    
+    def _settle_tokens(self, estimated: int, input_tokens: Optional[int], output_tokens: Optional[int]):
+        '''Replace the limiter's token estimate with the reported usage'''
+        limiter = get_rate_limiter()
+        if limiter is not None and input_tokens is not None and output_tokens is not None:
+            limiter.settle(estimated, input_tokens + output_tokens)
+    
+    def _build_body(
+        self,
+        prompt: str,
+        max_tokens: int,
+        model_id: Optional[str] = None,
+        system: Optional[str] = None,
+        stop_sequences: Optional[List[str]] = None,
+        prefill: Optional[str] = None
+    ) -> Dict[str, Any]:
+        '''Request body for the given (default: configured) model'''
+        model_id = model_id or self.model_id
+        
+        # Different format for Claude vs Titan
+        if 'claude' in model_id:
+            body = {
+                'anthropic_version': 'bedrock-2023-05-31',
+                'max_tokens': max_tokens,
+                'messages': [
+                    {'role': 'user', 'content': prompt}
+                ]
+            }
+            if system:
+                block = {'type': 'text', 'text': system}
+                if PROMPT_CACHING_MODELS.search(model_id):
+                    # The prefix up to here is cached and billed at the cache-read rate
+                    block['cache_control'] = {'type': 'ephemeral'}
+                body['system'] = [block]
+            if stop_sequences:
+                body['stop_sequences'] = stop_sequences
+            if prefill:
+                body['messages'].append({'role': 'assistant', 'content': prefill})
+            return body
+        else:  # Titan: no system prompt, prefill or custom stop sequences
+            return {
+                'inputText': f'{system}\n\n{prompt}' if system else prompt,
+                'textGenerationConfig': {
+                    'maxTokenCount': max_tokens,
+                    'temperature': 0.7
                 }
+            }
+    
+    def _extract_text(self, result: Dict[str, Any], model_id: Optional[str] = None) -> str:
+        '''Generated text from a complete response body'''
+        # Different response format for Claude vs Titan
+        if 'claude' in (model_id or self.model_id):
+            return result['content'][0]['text']
+        else:  # Titan
+            return result['results'][0]['outputText']
+    
+    def _token_usage(
+        self,
+        response: Dict[str, Any],
+        result: Dict[str, Any],
+        model_id: Optional[str] = None
+    ) -> tuple:
+        '''(input_tokens, output_tokens) from the response headers, else the body'''
+        headers = response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+        if 'x-amzn-bedrock-input-token-count' in headers:
+            return (
+                int(headers['x-amzn-bedrock-input-token-count']),
+                int(headers.get('x-amzn-bedrock-output-token-count', 0))
+            )
+        
+        if 'claude' in (model_id or self.model_id):
+            usage = result.get('usage', {})
+            return usage.get('input_tokens'), usage.get('output_tokens')
+        else:  # Titan
+            output = sum(r.get('tokenCount', 0) for r in result.get('results', []))
+            return result.get('inputTextTokenCount'), output
+    
+    def _cache_usage(self, response: Dict[str, Any], result: Dict[str, Any]) -> tuple:
+        '''(cache_read_tokens, cache_write_tokens); None when prompt caching was not used'''
+        headers = response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+        if 'x-amzn-bedrock-cache-read-input-token-count' in headers:
+            return (
+                int(headers['x-amzn-bedrock-cache-read-input-token-count']),
+                int(headers.get('x-amzn-bedrock-cache-write-input-token-count', 0))
             )
-            print(f'✅ State saved by {self.agent_name}')
+        
+        usage = result.get('usage', {})
+        return usage.get('cache_read_input_tokens'), usage.get('cache_creation_input_tokens')
+    
+    def _extract_stream_text(self, chunk: Dict[str, Any], model_id: Optional[str] = None) -> str:
+        '''Generated text from one streamed chunk ('' for control events)'''
+        if 'claude' in (model_id or self.model_id):
+            if chunk.get('type') == 'content_block_delta':
+                return chunk['delta'].get('text', '')
+            return ''
+        else:  # Titan
+            return chunk.get('outputText', '')
+    
+    def save_state(self, workflow_id: str, state: Dict[str, Any], sync: Optional[bool] = None):
+        '''
+        Save workflow state to DynamoDB
+        
+        By default the record goes through the write-behind StateWriter and
+        is persisted in a later batch (STATE_WRITE_MODE=sync changes the
+        default). Pass sync=True when the caller must read its own write.
+        '''
+        item = {
+            'workflow_id': workflow_id,
+            'timestamp': int(datetime.now().timestamp()),
+            'agent': self.agent_name
+        }
+        # Compact (possibly delta) record, or the JSON one with STATE_RECORD_FORMAT=json
+        codec = state_records.get_codec()
+        key = f'{self.agent_name}:{workflow_id}'
+        item.update(codec.attributes(key, state, timestamp=item['timestamp']))
+        
+        def written(ok: bool):
+            # Later deltas may only build on records that are in the table
+            if ok:
+                codec.acknowledge(key, item['timestamp'])
+            else:
+                codec.forget(key)
+        
+        if sync is None:
+            sync = os.getenv('STATE_WRITE_MODE', 'async').lower() == 'sync'
+        
+        try:
+            if sync:
+                with metrics.time_dynamodb_write(self.state_table_name):
+                    self.state_table.put_item(Item=item)
+                written(True)
+                self.logger.debug('State saved')
+            else:
+                get_state_writer(self.state_table_name).submit(item, on_written=written)
+                self.logger.debug('State queued')
         except Exception as e:
-            print(f'❌ State save error: {str(e)}')
+            codec.forget(key)
+            self.logger.error(f'State save error: {str(e)}')
             raise
     
-    def log(self, message: str):
-        '''Simple logging'''
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        print(f'[{timestamp}] [{self.agent_name}] {message}')
+    def load_state(self, workflow_id: str) -> Optional[Dict[str, Any]]:
+        '''Latest state this agent saved for a workflow, or None'''
+        query = {'KeyConditionExpression': Key('workflow_id').eq(workflow_id)}
+        items = []
+        while True:
+            page = self.state_table.query(**query)
+            items.extend(item for item in page.get('Items', []) if item.get('agent') == self.agent_name)
+            if 'LastEvaluatedKey' not in page:
+                break
+            query['ExclusiveStartKey'] = page['LastEvaluatedKey']
+        
+        return state_records.rebuild_state(sorted(items, key=lambda item: int(item['timestamp'])))
+    
+    def log(self, message: str, level: int = logging.INFO):
+        '''Log through the shared non-blocking pipeline'''
+        self.logger.log(level, message)
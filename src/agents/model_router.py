@@ -0,0 +1,156 @@
+﻿from typing import Dict, Any, Optional, Tuple
+from collections import Counter, deque
+import json
+import os
+import re
+import threading
+
+
+# USD per 1K tokens (input, output); override or extend with MODEL_PRICES
+DEFAULT_PRICES = {
+    'amazon.titan-text-lite-v1': (0.00015, 0.0002),
+    'amazon.titan-text-express-v1': (0.0002, 0.0006),
+    'anthropic.claude-3-haiku-20240307-v1:0': (0.00025, 0.00125),
+    'anthropic.claude-3-sonnet-20240229-v1:0': (0.003, 0.015),
+    'anthropic.claude-3-5-sonnet-20240620-v1:0': (0.003, 0.015),
+}
+
+# Words that point at a category; a report hitting several is ambiguous
+CATEGORY_HINTS = {
+    'bug': re.compile(r'\b(error|errors|broken|crash\w*|fail\w*|bug|wrong|exception)\b', re.IGNORECASE),
+    'feature': re.compile(r'\b(add|support for|would like|wish|feature|enhancement|request)\b', re.IGNORECASE),
+    'question': re.compile(r'(\?|\b(how|why|where|what|whether)\b)', re.IGNORECASE),
+    'incident': re.compile(r'\b(down|outage|everyone|all users|production|urgent|asap)\b', re.IGNORECASE),
+}
+
+# Latency samples kept per route for percentiles
+LATENCY_WINDOW = 1000
+
+FAST = 'fast'
+STRONG = 'strong'
+
+
+class ModelRouter:
+    '''
+    Chooses between a cheap, fast model and a stronger one per request
+
+    Short, unambiguous reports go to `fast_model`. Long reports (over
+    `max_fast_chars`), reports whose wording hints at more than
+    `max_hinted_categories` categories, and reports the pre-classifier
+    is unsure about (confidence below `ambiguous_confidence`) go to
+    `strong_model`. A fast answer that does not parse is retried on the
+    strong model.
+
+    Latency, tokens and estimated cost are recorded per route so the
+    thresholds can be tuned from stats().
+    '''
+
+    def __init__(
+        self,
+        fast_model: str,
+        strong_model: str,
+        max_fast_chars: int = 800,
+        ambiguous_confidence: float = 0.5,
+        max_hinted_categories: int = 2,
+        prices: Optional[Dict[str, Tuple[float, float]]] = None
+    ):
+        self.fast_model = fast_model
+        self.strong_model = strong_model
+        self.max_fast_chars = max_fast_chars
+        self.ambiguous_confidence = ambiguous_confidence
+        self.max_hinted_categories = max_hinted_categories
+        self.prices = dict(DEFAULT_PRICES, **(prices or {}))
+        self._lock = threading.Lock()
+        self._counts = Counter()
+        self._tokens = Counter()
+        self._cost = Counter()
+        self._latencies = {FAST: deque(maxlen=LATENCY_WINDOW), STRONG: deque(maxlen=LATENCY_WINDOW)}
+
+    @classmethod
+    def from_env(cls) -> Optional['ModelRouter']:
+        '''Router from MODEL_ROUTING_* settings (None when routing is off)'''
+        if os.getenv('MODEL_ROUTING_ENABLED', 'false').lower() != 'true':
+            return None
+
+        prices = {
+            model: tuple(price)
+            for model, price in json.loads(os.getenv('MODEL_PRICES', '{}')).items()
+        }
+        return cls(
+            fast_model=os.getenv('ROUTER_FAST_MODEL', 'amazon.titan-text-express-v1'),
+            strong_model=os.getenv('ROUTER_STRONG_MODEL', 'anthropic.claude-3-sonnet-20240229-v1:0'),
+            max_fast_chars=int(os.getenv('ROUTER_MAX_FAST_CHARS', '800')),
+            ambiguous_confidence=float(os.getenv('ROUTER_AMBIGUOUS_CONFIDENCE', '0.5')),
+            max_hinted_categories=int(os.getenv('ROUTER_MAX_HINTED_CATEGORIES', '2')),
+            prices=prices
+        )
+
+    @property
+    def name(self) -> str:
+        '''Identifies the routing setup (e.g. for cache keys)'''
+        return f'router:{self.fast_model}|{self.strong_model}'
+
+    def choose(self, user_input: str, prediction: Optional[Dict[str, Any]] = None) -> Tuple[str, str]:
+        '''(route, reason) for a request'''
+        if len(user_input) > self.max_fast_chars:
+            route, reason = STRONG, 'long'
+        elif prediction is not None and prediction['confidence'] < self.ambiguous_confidence:
+            route, reason = STRONG, 'low_confidence'
+        elif sum(1 for p in CATEGORY_HINTS.values() if p.search(user_input)) > self.max_hinted_categories:
+            route, reason = STRONG, 'ambiguous'
+        else:
+            route, reason = FAST, 'simple'
+
+        with self._lock:
+            self._counts[f'{route}:{reason}'] += 1
+        return route, reason
+
+    def model_for(self, route: str) -> str:
+        return self.fast_model if route == FAST else self.strong_model
+
+    def record(self, route: str, usage: Dict[str, Any], escalated: bool = False):
+        '''Account one model call (usage as returned by call_llm_with_usage)'''
+        input_tokens = usage.get('input_tokens') or 0
+        output_tokens = usage.get('output_tokens') or 0
+        price_in, price_out = self.prices.get(usage['model_id'], (0.0, 0.0))
+
+        with self._lock:
+            self._counts[f'{route}_calls'] += 1
+            if escalated:
+                self._counts['escalations'] += 1
+            self._tokens[f'{route}_input'] += input_tokens
+            self._tokens[f'{route}_output'] += output_tokens
+            self._cost[route] += input_tokens / 1000 * price_in + output_tokens / 1000 * price_out
+            if usage.get('latency') is not None:
+                self._latencies[route].append(usage['latency'])
+
+    def stats(self) -> Dict[str, Any]:
+        '''Decisions, escalations, and per-route calls/tokens/cost/latency'''
+        with self._lock:
+            counts = dict(self._counts)
+            tokens = dict(self._tokens)
+            cost = dict(self._cost)
+            latencies = {route: sorted(samples) for route, samples in self._latencies.items()}
+
+        routes = {}
+        for route, model in ((FAST, self.fast_model), (STRONG, self.strong_model)):
+            calls = counts.get(f'{route}_calls', 0)
+            samples = latencies[route]
+            routes[route] = {
+                'model_id': model,
+                'calls': calls,
+                'input_tokens': tokens.get(f'{route}_input', 0),
+                'output_tokens': tokens.get(f'{route}_output', 0),
+                'cost_usd': round(cost.get(route, 0.0), 6),
+                'cost_per_call_usd': round(cost.get(route, 0.0) / calls, 6) if calls else None,
+                'latency_p50': samples[len(samples) // 2] if samples else None,
+                'latency_p95': samples[int(len(samples) * 0.95)] if samples else None
+            }
+
+        fast_calls = routes[FAST]['calls']
+        return {
+            'decisions': {k: v for k, v in counts.items() if ':' in k},
+            'escalations': counts.get('escalations', 0),
+            'escalation_rate': counts.get('escalations', 0) / fast_calls if fast_calls else 0.0,
+            'routes': routes
+        }
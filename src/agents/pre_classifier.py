@@ -0,0 +1,241 @@
+﻿from typing import Dict, Any, List, Optional, Tuple
+from collections import Counter, defaultdict
+import math
+import random
+import re
+import threading
+from utils import state_records
+
+
+# Reasoning of classifications the LLM did not make (see TriageAgent)
+UNTRAINABLE_REASONING = ('Matched by ', 'Fallback classification', 'Could not parse response')
+
+# (pattern, category, priority, confidence) for reports that need no model
+RULES = [
+    # "down" only right after the subject and a copula. Matches "the site is
+    # down", "API went completely down"; must not match "the app slows down
+    # when I scroll", "site traffic is down 5%", "API latency went down after
+    # deploy" or "the site went down after the update, now fine"
+    (r'\b(site|website|app|service|system|server|api|prod(uction)?)\s+(is|are|went|seems)\s+'
+     r'(completely\s+|totally\s+)?down\b(?!\s*(after|since|by|from|to|\d))',
+     'incident', 'P0', 0.95),
+    (r'\b(outage|50[023] errors?|all pages|nobody can (log ?in|access))\b', 'incident', 'P0', 0.92),
+    (r'\b(security breach|data (leak|breach)|been hacked|ransomware)\b', 'incident', 'P0', 0.92),
+    (r'^\s*(can|could) (we|you) (please )?add\b|\bfeature request\b|\bit would be (nice|great) (if|to)\b',
+     'feature', 'P3', 0.92),
+    (r'^\s*(how (do|can) i|where (is|can i)|is there a way to)\b', 'question', 'P3', 0.9),
+]
+
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+
+
+class PreClassifier:
+    '''
+    Cheap local classifier that runs before the LLM
+
+    Two stages: hand-written rules for the obvious cases, then (once
+    trained on stored classifications) a TF-IDF weighted multinomial
+    Naive Bayes model over joint category/priority labels. Predictions
+    at or above `threshold` confidence skip the LLM.
+
+    A `shadow_rate` fraction of confident predictions is still sent to
+    the LLM so the agreement rate keeps being measured.
+    '''
+
+    def __init__(self, threshold: float = 0.9, shadow_rate: float = 0.05, min_examples: int = 50):
+        self.threshold = threshold
+        self.shadow_rate = shadow_rate
+        self.min_examples = min_examples
+        self.rules = [(re.compile(p, re.IGNORECASE), c, pr, conf) for p, c, pr, conf in RULES]
+        self._model = None
+        self._lock = threading.Lock()
+        self._stats = Counter()
+
+    def predict(self, text: str) -> Optional[Dict[str, Any]]:
+        '''Best local guess with its confidence, or None if there is none'''
+        for pattern, category, priority, confidence in self.rules:
+            if pattern.search(text):
+                return {
+                    'category': category,
+                    'priority': priority,
+                    'confidence': confidence,
+                    'source': 'rules'
+                }
+
+        model = self._model
+        if model is None:
+            return None
+
+        label, confidence = model.predict(text)
+        category, priority = label.split('/')
+        return {
+            'category': category,
+            'priority': priority,
+            'confidence': confidence,
+            'source': 'model'
+        }
+
+    def should_skip_llm(self, prediction: Optional[Dict[str, Any]]) -> bool:
+        '''Whether a prediction is confident enough to be used as-is'''
+        if prediction is None or prediction['confidence'] < self.threshold:
+            with self._lock:
+                self._stats['llm_calls'] += 1
+            return False
+
+        if random.random() < self.shadow_rate:
+            with self._lock:
+                self._stats['llm_calls'] += 1
+                self._stats['shadow_checks'] += 1
+            return False
+
+        with self._lock:
+            self._stats['fast_path'] += 1
+            self._stats[f'fast_path_{prediction["source"]}'] += 1
+        return True
+
+    def record_agreement(self, prediction: Optional[Dict[str, Any]], llm_result: Dict[str, Any]):
+        '''Compare a local prediction with the LLM's answer for the same input'''
+        if prediction is None:
+            return
+
+        agreed = (
+            prediction['category'] == llm_result['category']
+            and prediction['priority'] == llm_result['priority']
+        )
+        confident = prediction['confidence'] >= self.threshold
+
+        with self._lock:
+            self._stats['compared'] += 1
+            self._stats['agreed'] += agreed
+            if confident:
+                self._stats['compared_confident'] += 1
+                self._stats['agreed_confident'] += agreed
+
+    def train(self, examples: List[Tuple[str, Dict[str, Any]]]) -> bool:
+        '''
+        Fit the model from (user_input, classification) pairs
+
+        Returns False (and keeps any previous model) when there are fewer
+        than `min_examples` examples.
+        '''
+        if len(examples) < self.min_examples:
+            return False
+
+        model = _NaiveBayesModel()
+        model.fit([
+            (text, f'{c["category"]}/{c["priority"]}')
+            for text, c in examples
+        ])
+        self._model = model
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        '''Routing counters and agreement rates against the LLM'''
+        with self._lock:
+            stats = dict(self._stats)
+
+        decided = stats.get('fast_path', 0) + stats.get('llm_calls', 0)
+        stats['threshold'] = self.threshold
+        stats['fast_path_rate'] = stats.get('fast_path', 0) / decided if decided else 0.0
+        stats['agreement_rate'] = (
+            stats['agreed'] / stats['compared'] if stats.get('compared') else None
+        )
+        # Agreement of the predictions that would have skipped the LLM
+        stats['confident_agreement_rate'] = (
+            stats['agreed_confident'] / stats['compared_confident']
+            if stats.get('compared_confident') else None
+        )
+        stats['model_trained'] = self._model is not None
+        return stats
+
+
+def examples_from_state_items(items: List[Dict[str, Any]], agent: str) -> List[Tuple[str, Dict[str, Any]]]:
+    '''
+    Extract training pairs from agent-state records written by save_state
+
+    Only `agent`'s records count, one example per workflow (its latest
+    state), and only classifications the LLM made: the pre-classifier's
+    own fast-path answers, fallbacks and unparsed responses would teach
+    the model its own output or noise.
+    '''
+    records: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for item in items:
+        if item.get('agent') == agent and 'workflow_id' in item and 'state' in item:
+            records[item['workflow_id']].append(item)
+
+    examples = []
+    for workflow_items in records.values():
+        try:
+            state = state_records.rebuild_state(sorted(workflow_items, key=lambda item: int(item['timestamp'])))
+        except (KeyError, TypeError, ValueError):
+            continue
+        classification = state.get('classification') or {}
+        if state.get('user_input') and _from_llm(classification):
+            examples.append((state['user_input'], classification))
+    return examples
+
+
+def _from_llm(classification: Dict[str, Any]) -> bool:
+    if 'category' not in classification or 'priority' not in classification:
+        return False
+    if classification.get('fast_path') or classification.get('fallback'):
+        return False
+    # Records from before the fast_path flag
+    return not str(classification.get('reasoning', '')).startswith(UNTRAINABLE_REASONING)
+
+
+class _NaiveBayesModel:
+    '''Multinomial Naive Bayes over TF-IDF weighted token counts'''
+
+    def __init__(self, alpha: float = 0.5):
+        self.alpha = alpha
+
+    def fit(self, examples: List[Tuple[str, str]]):
+        documents = [(Counter(_tokenize(text)), label) for text, label in examples]
+
+        document_frequency = Counter()
+        for counts, _ in documents:
+            document_frequency.update(counts.keys())
+
+        total = len(documents)
+        self.idf = {t: math.log((1 + total) / (1 + df)) + 1 for t, df in document_frequency.items()}
+
+        label_counts = Counter(label for _, label in documents)
+        weights: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+        for counts, label in documents:
+            for token, count in counts.items():
+                weights[label][token] += count * self.idf[token]
+
+        vocabulary = len(self.idf)
+        self.log_prior = {label: math.log(n / total) for label, n in label_counts.items()}
+        self.log_likelihood = {}
+        self.log_unseen = {}
+        for label, token_weights in weights.items():
+            denominator = sum(token_weights.values()) + self.alpha * vocabulary
+            self.log_likelihood[label] = {
+                token: math.log((weight + self.alpha) / denominator)
+                for token, weight in token_weights.items()
+            }
+            self.log_unseen[label] = math.log(self.alpha / denominator)
+
+    def predict(self, text: str) -> Tuple[str, float]:
+        counts = Counter(t for t in _tokenize(text) if t in self.idf)
+
+        scores = {}
+        for label, prior in self.log_prior.items():
+            likelihood = self.log_likelihood[label]
+            unseen = self.log_unseen[label]
+            scores[label] = prior + sum(
+                count * self.idf[token] * likelihood.get(token, unseen)
+                for token, count in counts.items()
+            )
+
+        # Softmax over log scores gives the posterior used as confidence
+        best = max(scores, key=scores.get)
+        top = scores[best]
+        normalizer = sum(math.exp(score - top) for score in scores.values())
+        return best, 1.0 / normalizer
+
+
+def _tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
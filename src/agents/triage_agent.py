@@ -1,5 +1,54 @@
-﻿from typing import Dict, Any
+﻿from typing import Dict, Any, List, Optional, Tuple
+from collections import Counter
+from boto3.dynamodb.conditions import Attr
 from .base_agent import BaseAgent
+from .pre_classifier import PreClassifier, examples_from_state_items
+from .model_router import ModelRouter, FAST, STRONG
+from utils.cache import ClassificationCache
+from utils.llm_policy import LLMUnavailableError, get_llm_policy
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+
+# Bump whenever the prompt or parser changes so cached results are not reused
+PROMPT_VERSION = 'v1'
+
+GUIDELINES = '''Priority guidelines:
+- P0: System down, revenue impacted, security breach
+- P1: Major feature broken, affects many users
+- P2: Minor bug, affects some users
+- P3: Enhancement, cosmetic issue
+
+Category guidelines:
+- bug: Something is broken
+- feature: Request for new functionality
+- question: Asking for help or information
+- incident: Active emergency or outage'''
+
+# Answers in a batch response are introduced by their number, e.g. "[3]"
+BATCH_ITEM_PATTERN = re.compile(r'^\s*\[(\d+)\]\s*$', re.MULTILINE)
+
+# Token-economy mode: the static part of the prompt is a cacheable system
+# prefix, and the answer is a one-line JSON object that the model starts
+# from ECONOMY_PREFILL and stops at the closing brace
+ECONOMY_SYSTEM = f'''You classify user requests for a support team.
+
+{GUIDELINES}
+
+Answer with one JSON object on a single line:
+{{"category": "bug|feature|question|incident", "priority": "P0|P1|P2|P3", "reasoning": "at most 15 words"}}'''
+ECONOMY_PREFILL = '{"category": "'
+ECONOMY_STOP = ['}']
+
+JSON_FIELD_PATTERNS = {
+    'category': re.compile(r'"category"\s*:\s*"(\w+)"'),
+    'priority': re.compile(r'"priority"\s*:\s*"(\w+)"'),
+    'reasoning': re.compile(r'"reasoning"\s*:\s*"((?:[^"\\]|\\.)*)"'),
+}
 
 
 class TriageAgent(BaseAgent):
@@ -7,11 +56,128 @@ class TriageAgent(BaseAgent):
     
     def __init__(self):
         super().__init__('triage-agent')
+        self.cache = self._build_cache()
+        self.pre_classifier = self._build_pre_classifier()
+        self.router = ModelRouter.from_env()
+        self.fallback = self._build_fallback()
+        self.token_economy = os.getenv('TRIAGE_TOKEN_ECONOMY', 'false').lower() == 'true'
+        self.max_input_chars = int(os.getenv('TRIAGE_MAX_INPUT_CHARS', '2000'))
+        self.economy_max_tokens = int(os.getenv('TRIAGE_ECONOMY_MAX_TOKENS', '96'))
+        self._token_counts = Counter()
+        self._token_lock = threading.Lock()
+    
+    def _build_cache(self):
+        '''Create the classification cache (None when disabled)'''
+        if os.getenv('TRIAGE_CACHE_ENABLED', 'true').lower() != 'true':
+            return None
+        
+        shared_table_name = None
+        if os.getenv('TRIAGE_CACHE_SHARED', 'true').lower() == 'true':
+            shared_table_name = os.getenv('DYNAMODB_CACHE_TABLE', 'workflow-agent-cache')
+        
+        return ClassificationCache(
+            table_name=shared_table_name,
+            max_entries=int(os.getenv('TRIAGE_CACHE_SIZE', '1024')),
+            ttl_seconds=int(os.getenv('TRIAGE_CACHE_TTL', '86400'))
+        )
+    
+    def _build_pre_classifier(self):
+        '''Create the local pre-classifier (None when disabled)'''
+        if os.getenv('PRECLASSIFIER_ENABLED', 'true').lower() != 'true':
+            return None
+        
+        return PreClassifier(
+            threshold=float(os.getenv('PRECLASSIFIER_THRESHOLD', '0.9')),
+            shadow_rate=float(os.getenv('PRECLASSIFIER_SHADOW_RATE', '0.05'))
+        )
+    
+    def _build_fallback(self) -> Optional[Dict[str, str]]:
+        '''Classification used when the model is unavailable (None: fail instead)'''
+        category = os.getenv('TRIAGE_FALLBACK_CATEGORY')
+        if not category:
+            return None
+        return {'category': category, 'priority': os.getenv('TRIAGE_FALLBACK_PRIORITY', 'P2')}
+    
+    def train_pre_classifier(self, max_items: int = 10000) -> bool:
+        '''Fit the pre-classifier's model from classifications stored in the state table'''
+        if not self.pre_classifier:
+            return False
+        
+        items = []
+        scan_kwargs = {
+            'FilterExpression': Attr('agent').eq(self.agent_name),
+            'ProjectionExpression': 'workflow_id, #t, agent, #s',
+            'ExpressionAttributeNames': {'#t': 'timestamp', '#s': 'state'}
+        }
+        while len(items) < max_items:
+            page = self.state_table.scan(**scan_kwargs)
+            items.extend(page.get('Items', []))
+            if 'LastEvaluatedKey' not in page:
+                break
+            scan_kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+        
+        examples = examples_from_state_items(items[:max_items], self.agent_name)
+        trained = self.pre_classifier.train(examples)
+        self.log(f'Pre-classifier training on {len(examples)} examples: {"done" if trained else "skipped"}')
+        return trained
+    
+    def cache_stats(self) -> Dict[str, Any]:
+        '''Cache hit/miss counters (empty when caching is disabled)'''
+        return self.cache.stats() if self.cache else {}
+    
+    def pre_classifier_stats(self) -> Dict[str, Any]:
+        '''Fast-path and LLM agreement counters (empty when disabled)'''
+        return self.pre_classifier.stats() if self.pre_classifier else {}
+    
+    def router_stats(self) -> Dict[str, Any]:
+        '''Per-route calls, cost and latency (empty when routing is off)'''
+        return self.router.stats() if self.router else {}
+    
+    def policy_stats(self) -> Dict[str, Any]:
+        '''Retries, hedges, deadline misses and breaker states (empty when the policy is off)'''
+        policy = get_llm_policy()
+        return policy.stats() if policy else {}
+    
+    def token_stats(self) -> Dict[str, Any]:
+        '''
+        Model calls and tokens per prompt mode (standard, economy, batch)
+        
+        Compare avg_input_tokens / avg_output_tokens across runs with
+        TRIAGE_TOKEN_ECONOMY off and on to see what the mode saves.
+        '''
+        with self._token_lock:
+            counts = dict(self._token_counts)
+        
+        stats = {}
+        for mode in sorted({key.split(':')[0] for key in counts}):
+            calls = counts.get(f'{mode}:calls', 0)
+            stats[mode] = {
+                field: counts.get(f'{mode}:{field}', 0)
+                for field in ('calls', 'input_tokens', 'output_tokens', 'cache_read_tokens', 'cache_write_tokens')
+            }
+            stats[mode]['avg_input_tokens'] = round(stats[mode]['input_tokens'] / calls, 1) if calls else None
+            stats[mode]['avg_output_tokens'] = round(stats[mode]['output_tokens'] / calls, 1) if calls else None
+        return stats
+    
+    @property
+    def prompt_version(self) -> str:
+        '''Prompt identity used in cache keys (economy answers differ in form)'''
+        return f'{PROMPT_VERSION}-economy' if self.token_economy else PROMPT_VERSION
     
-    def classify_request(self, user_input: str) -> Dict[str, Any]:
+    @property
+    def cache_model_id(self) -> str:
+        '''Model identity used in cache keys (the routing setup when routing)'''
+        return self.router.name if self.router else self.model_id
+    
+    def classify_request(self, user_input: str, stream: bool = None) -> Dict[str, Any]:
         '''
         Classify a user request into category and priority
         
+        With `stream` (default: TRIAGE_STREAMING env) the response is read
+        incrementally and the stream is dropped as soon as all three
+        fields have arrived. Token-economy mode (TRIAGE_TOKEN_ECONOMY)
+        asks for a short JSON answer instead and never streams.
+        
         Returns:
             {
                 'category': 'bug' | 'feature' | 'question' | 'incident',
@@ -21,7 +187,277 @@ class TriageAgent(BaseAgent):
         '''
         self.log(f'Classifying request: {user_input[:50]}...')
         
-        prompt = f'''Analyze this user request and classify it.
+        cache_key = None
+        if self.cache:
+            cache_key = self.cache.make_key(user_input, self.cache_model_id, self.prompt_version)
+            cached = self.cache.get(cache_key)
+            if cached:
+                self.log(f'Classification (cached): {cached["category"]} / {cached["priority"]}')
+                return cached
+        
+        prediction = self.pre_classifier.predict(user_input) if self.pre_classifier else None
+        if self.pre_classifier and self.pre_classifier.should_skip_llm(prediction):
+            result = self._fast_path_result(prediction)
+            self.log(f'Classification (pre-classifier): {result["category"]} / {result["priority"]}')
+            return result
+        
+        return self._classify_with_llm(user_input, prediction, cache_key, stream)
+    
+    def _classify_with_llm(
+        self,
+        user_input: str,
+        prediction: Optional[Dict[str, Any]],
+        cache_key: Optional[str],
+        stream: bool = None,
+        route: Optional[str] = None
+    ) -> Dict[str, Any]:
+        '''Classify with a model call, routed and escalated when a router is set'''
+        prompt, max_tokens, options = self._classification_request(user_input)
+        
+        if self.token_economy:
+            # The answer is a few dozen tokens; there is nothing to cut short
+            stream = False
+        elif stream is None:
+            stream = os.getenv('TRIAGE_STREAMING', 'false').lower() == 'true'
+        
+        model_id = None
+        if self.router:
+            if route is None:
+                route, reason = self.router.choose(user_input, prediction)
+                self.log(f'Routed to {route} model ({reason})')
+            model_id = self.router.model_for(route)
+        
+        try:
+            response = self._call_model(prompt, max_tokens, model_id, stream, route, options=options)
+        except LLMUnavailableError as e:
+            return self._fallback_result(prediction, e)
+        
+        # Parse the response
+        fields = self._parse_fields(response)
+        
+        if self.router and route == FAST and len(fields) < 3:
+            # The fast model's answer did not parse; ask the strong one
+            self.log('Fast model response incomplete, escalating')
+            try:
+                response = self._call_model(
+                    prompt, max_tokens, self.router.strong_model, stream, STRONG, escalated=True, options=options
+                )
+                fields = self._parse_fields(response)
+            except LLMUnavailableError as e:
+                # Keep whatever the fast model gave us
+                self.log(f'Escalation skipped: {str(e)}', logging.WARNING)
+        
+        result = self._parse_classification(response)
+        
+        # Only cache complete answers so a malformed response is retried next time
+        if cache_key and len(fields) == 3:
+            self.cache.put(cache_key, result)
+        
+        if prediction and len(fields) == 3:
+            self.pre_classifier.record_agreement(prediction, result)
+        
+        self.log(f'Classification: {result["category"]} / {result["priority"]}')
+        
+        return result
+    
+    def classify_batch(
+        self,
+        user_inputs: List[str],
+        batch_size: int = None
+    ) -> List[Dict[str, Any]]:
+        '''
+        Classify many requests with one model call per batch
+        
+        Requests are packed into numbered prompts that share a single copy
+        of the guidelines. Batches are capped by `batch_size` and by
+        TRIAGE_BATCH_MAX_CHARS so a prompt stays within the token limit.
+        Any item missing from the response is classified on its own.
+        
+        Returns one classification per input, in input order.
+        '''
+        batch_size = batch_size or int(os.getenv('TRIAGE_BATCH_SIZE', '10'))
+        max_chars = int(os.getenv('TRIAGE_BATCH_MAX_CHARS', '12000'))
+        
+        results: List[Dict[str, Any]] = [None] * len(user_inputs)
+        cache_keys = {}
+        predictions = {}
+        pending = []
+        strong = []
+        
+        for index, user_input in enumerate(user_inputs):
+            if self.cache:
+                cache_keys[index] = self.cache.make_key(user_input, self.cache_model_id, self.prompt_version)
+                cached = self.cache.get(cache_keys[index])
+                if cached:
+                    results[index] = cached
+                    continue
+            if self.pre_classifier:
+                predictions[index] = self.pre_classifier.predict(user_input)
+                if self.pre_classifier.should_skip_llm(predictions[index]):
+                    results[index] = self._fast_path_result(predictions[index])
+                    continue
+            if self.router and self.router.choose(user_input, predictions.get(index))[0] == STRONG:
+                # Long or ambiguous: the strong model classifies it on its own
+                strong.append(index)
+                continue
+            pending.append(index)
+        
+        self.log(f'Classifying batch: {len(user_inputs)} requests ({len(pending) + len(strong)} need the model)')
+        
+        # Group pending items into batches by count and prompt size
+        batches = []
+        current, current_chars = [], 0
+        for index in pending:
+            size = len(user_inputs[index])
+            if current and (len(current) >= batch_size or current_chars + size > max_chars):
+                batches.append(current)
+                current, current_chars = [], 0
+            current.append(index)
+            current_chars += size
+        if current:
+            batches.append(current)
+        
+        for batch in batches:
+            parsed = {}
+            if len(batch) > 1:
+                prompt = self._build_batch_prompt([user_inputs[i] for i in batch])
+                model_id = self.router.fast_model if self.router else None
+                try:
+                    response = self._call_model(
+                        prompt, 150 * len(batch), model_id, False, FAST if self.router else None, mode='batch'
+                    )
+                    parsed = self._parse_batch_classification(response, len(batch))
+                except LLMUnavailableError as e:
+                    # Items fall through to single calls, which fail fast or fall back
+                    self.log(f'Batch call failed: {str(e)}', logging.WARNING)
+            
+            for position, index in enumerate(batch, start=1):
+                if position in parsed:
+                    results[index] = parsed[position]
+                    if index in cache_keys:
+                        self.cache.put(cache_keys[index], parsed[position])
+                    if predictions.get(index):
+                        self.pre_classifier.record_agreement(predictions[index], parsed[position])
+                else:
+                    # Missing or incomplete answer: fall back to a single call
+                    results[index] = self._classify_with_llm(
+                        user_inputs[index], predictions.get(index), cache_keys.get(index),
+                        route=FAST if self.router else None
+                    )
+        
+        for index in strong:
+            results[index] = self._classify_with_llm(
+                user_inputs[index], predictions.get(index), cache_keys.get(index), route=STRONG
+            )
+        
+        return results
+    
+    def _call_model(
+        self,
+        prompt: str,
+        max_tokens: int,
+        model_id: Optional[str],
+        stream: bool,
+        route: Optional[str] = None,
+        escalated: bool = False,
+        options: Optional[Dict[str, Any]] = None,
+        mode: Optional[str] = None
+    ) -> str:
+        '''One model call, accounted to its route when routing and to its prompt mode'''
+        if stream:
+            start = time.perf_counter()
+            response = self._read_classification_stream(prompt, max_tokens, model_id)
+            # Early-stopped streams report no token counts
+            usage = {'model_id': model_id or self.model_id, 'latency': time.perf_counter() - start}
+        else:
+            response, usage = self.call_llm_with_usage(prompt, max_tokens, model_id, **(options or {}))
+        
+        self._record_tokens(mode or ('economy' if options else 'standard'), usage)
+        if self.router and route:
+            self.router.record(route, usage, escalated)
+        return response
+    
+    def _record_tokens(self, mode: str, usage: Dict[str, Any]):
+        with self._token_lock:
+            self._token_counts[f'{mode}:calls'] += 1
+            for field in ('input_tokens', 'output_tokens', 'cache_read_tokens', 'cache_write_tokens'):
+                self._token_counts[f'{mode}:{field}'] += usage.get(field) or 0
+    
+    def _fast_path_result(self, prediction: Dict[str, Any]) -> Dict[str, Any]:
+        '''Classification taken straight from a confident pre-classifier prediction'''
+        return {
+            'category': prediction['category'],
+            'priority': prediction['priority'],
+            'reasoning': f'Matched by {prediction["source"]} pre-classifier '
+                         f'(confidence {prediction["confidence"]:.2f})',
+            # Kept out of the pre-classifier's training data
+            'fast_path': True
+        }
+    
+    def _fallback_result(self, prediction: Optional[Dict[str, Any]], error: Exception) -> Dict[str, Any]:
+        '''
+        Degraded classification while the model is unavailable
+        
+        Uses the pre-classifier's guess when there is one, else the
+        configured default. Re-raises when no fallback is configured.
+        Fallbacks are never cached.
+        '''
+        if prediction is not None:
+            result = {'category': prediction['category'], 'priority': prediction['priority']}
+        elif self.fallback is not None:
+            result = dict(self.fallback)
+        else:
+            raise error
+        
+        result['reasoning'] = f'Fallback classification (model unavailable: {str(error)})'
+        result['fallback'] = True
+        self.log(f'Classification (fallback): {result["category"]} / {result["priority"]}', logging.WARNING)
+        return result
+    
+    def _read_classification_stream(self, prompt: str, max_tokens: int, model_id: Optional[str] = None) -> str:
+        '''Read a streamed response only until Category, Priority and Reasoning are complete'''
+        text = ''
+        chunks = self.call_llm_stream(prompt, max_tokens=max_tokens, model_id=model_id)
+        
+        try:
+            for chunk in chunks:
+                text += chunk
+                # Only lines terminated by a newline are known to be complete
+                complete_lines = text[:text.rfind('\n') + 1]
+                if '\n' in chunk and len(self._parse_fields(complete_lines)) == 3:
+                    return complete_lines
+        finally:
+            chunks.close()
+        
+        return text
+    
+    def _classification_request(self, user_input: str) -> Tuple[str, int, Dict[str, Any]]:
+        '''(prompt, max_tokens, call_llm_with_usage options) for classifying one request'''
+        if not self.token_economy:
+            return self._build_prompt(user_input), 500, {}
+        
+        return f'User request:\n{self._excerpt(user_input)}', self.economy_max_tokens, {
+            'system': ECONOMY_SYSTEM,
+            'stop_sequences': ECONOMY_STOP,
+            'prefill': ECONOMY_PREFILL
+        }
+    
+    def _excerpt(self, user_input: str) -> str:
+        '''
+        Bound a report to max_input_chars
+        
+        Keeps the start (what the report is about) and the end (often the
+        error message or stack trace), dropping the middle.
+        '''
+        if len(user_input) <= self.max_input_chars:
+            return user_input
+        head = self.max_input_chars * 3 // 4
+        tail = self.max_input_chars - head
+        return f'{user_input[:head]}\n[... {len(user_input) - head - tail} characters omitted ...]\n{user_input[-tail:]}'
+    
+    def _build_prompt(self, user_input: str) -> str:
+        '''Prompt for classifying a single request'''
+        return f'''Analyze this user request and classify it.
 
 User Request: {user_input}
 
@@ -30,50 +466,110 @@ Category: [bug/feature/question/incident]
 Priority: [P0/P1/P2/P3]
 Reasoning: [brief explanation]
 
-Priority guidelines:
-- P0: System down, revenue impacted, security breach
-- P1: Major feature broken, affects many users
-- P2: Minor bug, affects some users
-- P3: Enhancement, cosmetic issue
+{GUIDELINES}'''
+    
+    def _build_batch_prompt(self, user_inputs: List[str]) -> str:
+        '''Prompt for classifying several numbered requests at once'''
+        if self.token_economy:
+            user_inputs = [self._excerpt(user_input) for user_input in user_inputs]
+        
+        requests = '\n\n'.join(
+            f'[{number}] {user_input}'
+            for number, user_input in enumerate(user_inputs, start=1)
+        )
+        
+        return f'''Analyze each of these {len(user_inputs)} user requests and classify it.
 
-Category guidelines:
-- bug: Something is broken
-- feature: Request for new functionality
-- question: Asking for help or information
-- incident: Active emergency or outage'''
+{requests}
 
-        response = self.call_llm(prompt, max_tokens=500)
+For every request, answer with its number on its own line followed by your analysis in this exact format:
+[1]
+Category: [bug/feature/question/incident]
+Priority: [P0/P1/P2/P3]
+Reasoning: [brief explanation]
+
+{GUIDELINES}'''
+    
+    def _parse_batch_classification(self, response: str, count: int) -> Dict[int, Dict[str, Any]]:
+        '''
+        Parse a numbered batch response
         
-        # Parse the response
-        result = self._parse_classification(response)
+        Returns {item number: classification} for the items whose answer
+        was complete. Unknown numbers and partial answers are dropped.
+        '''
+        results = {}
+        markers = list(BATCH_ITEM_PATTERN.finditer(response))
         
-        self.log(f'Classification: {result["category"]} / {result["priority"]}')
+        for marker, following in zip(markers, markers[1:] + [None]):
+            number = int(marker.group(1))
+            end = following.start() if following else len(response)
+            fields = self._parse_fields(response[marker.end():end])
+            
+            if 1 <= number <= count and len(fields) == 3 and number not in results:
+                results[number] = self._parse_classification(response[marker.end():end])
         
-        return result
+        return results
     
     def _parse_classification(self, response: str) -> Dict[str, Any]:
         '''Parse LLM response into structured format'''
-        lines = response.strip().split('\n')
-        
         result = {
             'category': 'question',  # default
             'priority': 'P3',        # default
             'reasoning': 'Could not parse response'
         }
         
+        result.update(self._parse_fields(response))
+        
+        return result
+    
+    def _parse_fields(self, response: str) -> Dict[str, Any]:
+        '''Extract only the valid fields present in the response'''
+        if response.lstrip().startswith('{'):
+            return self._parse_json_fields(response)
+        
+        lines = response.strip().split('\n')
+        
+        fields = {}
+        
         for line in lines:
             line = line.strip()
             if line.startswith('Category:'):
                 category = line.split(':', 1)[1].strip().lower()
                 if category in ['bug', 'feature', 'question', 'incident']:
-                    result['category'] = category
+                    fields['category'] = category
             
             elif line.startswith('Priority:'):
                 priority = line.split(':', 1)[1].strip().upper()
                 if priority in ['P0', 'P1', 'P2', 'P3']:
-                    result['priority'] = priority
+                    fields['priority'] = priority
             
             elif line.startswith('Reasoning:'):
-                result['reasoning'] = line.split(':', 1)[1].strip()
+                fields['reasoning'] = line.split(':', 1)[1].strip()
         
-        return result
+        return fields
+    
+    def _parse_json_fields(self, response: str) -> Dict[str, Any]:
+        '''
+        Extract the valid fields from a JSON answer
+        
+        Fields are matched individually because the stop sequence cuts
+        the closing brace (and a reasoning that contains one).
+        '''
+        fields = {}
+        
+        match = JSON_FIELD_PATTERNS['category'].search(response)
+        if match and match.group(1).lower() in ['bug', 'feature', 'question', 'incident']:
+            fields['category'] = match.group(1).lower()
+        
+        match = JSON_FIELD_PATTERNS['priority'].search(response)
+        if match and match.group(1).upper() in ['P0', 'P1', 'P2', 'P3']:
+            fields['priority'] = match.group(1).upper()
+        
+        match = JSON_FIELD_PATTERNS['reasoning'].search(response)
+        if match:
+            try:
+                fields['reasoning'] = json.loads(f'"{match.group(1)}"')
+            except ValueError:
+                fields['reasoning'] = match.group(1)
+        
+        return fields
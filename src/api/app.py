@@ -0,0 +1,139 @@
+﻿'''
+HTTP ingestion API for workflows
+
+    POST /workflows                submit one report          -> 202 + workflow_id
+    POST /workflows/bulk           submit up to API_MAX_BULK  -> 202 + workflow_ids
+    GET  /workflows/{id}           status and results so far
+    GET  /workflows/{id}/events    Server-Sent Events: queued, started, one
+                                   per node, then completed or failed
+    GET  /health                   pending work against capacity
+
+Handlers only validate and enqueue. Workflows run on WorkflowService's
+bounded scheduler threads, so a slow model call never holds an HTTP
+worker. When the service is full, submissions get 503 with Retry-After.
+
+Run with:
+    PYTHONPATH=src uvicorn api.app:app --host 0.0.0.0 --port 8000
+'''
+from typing import Any, AsyncIterator, Dict, List, Optional
+import asyncio
+import contextlib
+import json
+import os
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from api.service import ServiceBusy, TERMINAL_EVENTS, WorkflowService
+
+
+MAX_BULK = int(os.getenv('API_MAX_BULK', '500'))
+RETRY_AFTER_SECONDS = os.getenv('API_RETRY_AFTER_SECONDS', '5')
+# Comment lines keep idle event streams open through proxies
+SSE_KEEPALIVE_SECONDS = float(os.getenv('API_SSE_KEEPALIVE_SECONDS', '15'))
+
+
+class SubmitRequest(BaseModel):
+    user_input: str = Field(min_length=1)
+    channel: str = '#bugs'
+    # Resubmitting a known workflow_id returns its status instead of running it again
+    workflow_id: Optional[str] = None
+
+
+class BulkSubmitRequest(BaseModel):
+    items: List[SubmitRequest] = Field(min_length=1, max_length=MAX_BULK)
+
+
+def create_app(service: Optional[WorkflowService] = None) -> FastAPI:
+    '''App serving `service` (default: one built from API_* settings at startup)'''
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app: FastAPI):
+        app.state.service = service or WorkflowService.from_env()
+        yield
+        # Accepted workflows were promised a run; let the queued ones finish
+        await asyncio.get_running_loop().run_in_executor(None, app.state.service.close)
+
+    app = FastAPI(title='Workflow ingestion API', lifespan=lifespan)
+
+    @app.exception_handler(ServiceBusy)
+    async def busy(request: Request, error: ServiceBusy):
+        return JSONResponse(
+            status_code=503,
+            content={'detail': str(error)},
+            headers={'Retry-After': RETRY_AFTER_SECONDS}
+        )
+
+    @app.post('/workflows', status_code=202)
+    async def submit(body: SubmitRequest, request: Request, response: Response) -> Dict[str, Any]:
+        status = request.app.state.service.submit(body.user_input, body.channel, body.workflow_id)
+        response.headers['Location'] = f'/workflows/{status["workflow_id"]}'
+        return status
+
+    @app.post('/workflows/bulk', status_code=202)
+    async def submit_bulk(body: BulkSubmitRequest, request: Request) -> Dict[str, Any]:
+        statuses = request.app.state.service.submit_many([item.model_dump() for item in body.items])
+        return {'workflows': statuses}
+
+    @app.get('/workflows/{workflow_id}')
+    async def get_status(workflow_id: str, request: Request) -> Dict[str, Any]:
+        status = request.app.state.service.status(workflow_id)
+        if status is None:
+            raise HTTPException(status_code=404, detail=f'Unknown workflow {workflow_id}')
+        return status
+
+    @app.get('/workflows/{workflow_id}/events')
+    async def stream_events(workflow_id: str, request: Request) -> StreamingResponse:
+        loop = asyncio.get_running_loop()
+        events: asyncio.Queue = asyncio.Queue()
+        subscription = request.app.state.service.subscribe(
+            workflow_id, lambda event: loop.call_soon_threadsafe(events.put_nowait, event)
+        )
+        if subscription is None:
+            raise HTTPException(status_code=404, detail=f'Unknown workflow {workflow_id}')
+        past, unsubscribe = subscription
+
+        # A reconnecting EventSource sends the id of the last event it saw
+        last_id = request.headers.get('last-event-id')
+        seen = int(last_id) if last_id and last_id.isdigit() else 0
+
+        async def stream() -> AsyncIterator[str]:
+            try:
+                for event in past:
+                    if event['id'] > seen:
+                        yield _sse(event)
+                    if event['event'] in TERMINAL_EVENTS:
+                        return
+                while True:
+                    try:
+                        event = await asyncio.wait_for(events.get(), SSE_KEEPALIVE_SECONDS)
+                    except asyncio.TimeoutError:
+                        yield ': keepalive\n\n'
+                        continue
+                    yield _sse(event)
+                    if event['event'] in TERMINAL_EVENTS:
+                        return
+            finally:
+                unsubscribe()
+
+        return StreamingResponse(
+            stream(),
+            media_type='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+
+    @app.get('/health')
+    async def health(request: Request) -> Dict[str, Any]:
+        stats = request.app.state.service.stats()
+        stats['status'] = 'ok' if stats['pending'] < stats['max_pending'] else 'saturated'
+        return stats
+
+    return app
+
+
+def _sse(event: Dict[str, Any]) -> str:
+    '''One Server-Sent Events message'''
+    data = json.dumps(dict(event['data'], workflow_id=event['workflow_id'], time=event['time']), default=str)
+    return f'id: {event["id"]}\nevent: {event["event"]}\ndata: {data}\n\n'
+
+
+app = create_app()
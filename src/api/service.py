@@ -0,0 +1,253 @@
+﻿'''
+Background execution and progress tracking for the ingestion API
+
+WorkflowService runs workflows off the caller's thread: submit() assigns
+a workflow_id, queues the workflow on the orchestrator's priority
+scheduler and returns immediately. At most `max_pending` workflows are
+queued or running at a time. Past that, submit() raises ServiceBusy so
+the API can answer 503 instead of buffering without bound.
+
+Progress is kept in memory for the most recent `max_tracked` workflows:
+status, completed nodes and the state as the nodes leave it. It is also
+published as events to subscribers: queued, started, one per node, then
+completed or failed.
+'''
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from collections import OrderedDict
+from datetime import datetime, timezone
+import os
+import threading
+import uuid
+from observability.structured_logging import get_logger
+from workflows.orchestrator import WorkflowOrchestrator
+
+
+# Events after which a workflow publishes nothing more
+TERMINAL_EVENTS = ('completed', 'failed')
+
+# State fields reported while a workflow is in progress and once it is done
+RESULT_FIELDS = ('classification', 'jira_ticket', 'duplicate_of', 'slack_notifications', 'error')
+
+Subscriber = Callable[[Dict[str, Any]], None]
+
+
+class ServiceBusy(RuntimeError):
+    '''The service has max_pending workflows queued or running, or is shutting down'''
+
+
+class WorkflowService:
+    '''Bounded background runner with per-workflow status and events'''
+
+    def __init__(
+        self,
+        orchestrator: Optional[WorkflowOrchestrator] = None,
+        workers: Optional[int] = None,
+        max_pending: int = 1000,
+        max_tracked: int = 10000
+    ):
+        self.orchestrator = orchestrator or WorkflowOrchestrator()
+        self.workers = workers or self.orchestrator.max_concurrency
+        self.max_pending = max_pending
+        self.max_tracked = max_tracked
+        self.logger = get_logger('api.service')
+        self._records: OrderedDict = OrderedDict()
+        self._pending = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._scheduler = self.orchestrator.build_scheduler(self.workers, name='api-workflow')
+        self.orchestrator.add_node_listener(self._on_node)
+
+    @classmethod
+    def from_env(cls) -> 'WorkflowService':
+        workers = os.getenv('API_WORKERS')
+        return cls(
+            workers=int(workers) if workers else None,
+            max_pending=int(os.getenv('API_MAX_PENDING', '1000')),
+            max_tracked=int(os.getenv('API_MAX_TRACKED', '10000'))
+        )
+
+    def submit(self, user_input: str, channel: str = '#bugs', workflow_id: Optional[str] = None) -> Dict[str, Any]:
+        '''Queue one workflow and return its status (see submit_many)'''
+        return self.submit_many([{'user_input': user_input, 'channel': channel, 'workflow_id': workflow_id}])[0]
+
+    def submit_many(self, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        '''
+        Queue workflows and return their statuses, in order
+
+        All items are accepted or none is (ServiceBusy). An item with the
+        workflow_id of a workflow this service already tracks is not run
+        again; its current status is returned instead. Any other given
+        workflow_id resumes from its checkpoints, if it has any.
+        '''
+        # Priorities use the pre-classifier, so work them out before taking the lock
+        priorities = [self.orchestrator.admission_priority(item) for item in items]
+
+        statuses = []
+        with self._lock:
+            if self._closed:
+                raise ServiceBusy('Service is shutting down')
+            new = sum(1 for item in items if item.get('workflow_id') not in self._records)
+            if self._pending + new > self.max_pending:
+                raise ServiceBusy(f'{self._pending} workflows pending (limit {self.max_pending})')
+
+            for item, priority in zip(items, priorities):
+                workflow_id = item.get('workflow_id')
+                if workflow_id in self._records:
+                    statuses.append(self._view(self._records[workflow_id]))
+                    continue
+
+                resume = workflow_id is not None
+                workflow_id = workflow_id or str(uuid.uuid4())[:8]
+                item = {'user_input': item['user_input'], 'channel': item.get('channel') or '#bugs',
+                        'workflow_id': workflow_id}
+                record = {
+                    'workflow_id': workflow_id,
+                    'status': 'queued',
+                    'priority': priority,
+                    'submitted_at': _now(),
+                    'started_at': None,
+                    'finished_at': None,
+                    'completed_nodes': [],
+                    'state': {},
+                    'events': [],
+                    'subscribers': []
+                }
+                self._records[workflow_id] = record
+                self._pending += 1
+                self._publish(record, 'queued')
+                statuses.append(self._view(record))
+                # Under the lock, so close() cannot shut the scheduler in between
+                self._scheduler.submit(priority, self._run, workflow_id, item, resume)
+            self._evict()
+        return statuses
+
+    def status(self, workflow_id: str) -> Optional[Dict[str, Any]]:
+        '''Current status, or None for a workflow this service does not know (any more)'''
+        with self._lock:
+            record = self._records.get(workflow_id)
+            return self._view(record) if record else None
+
+    def subscribe(self, workflow_id: str, subscriber: Subscriber) -> Optional[Tuple[List[Dict[str, Any]], Callable[[], None]]]:
+        '''
+        Receive a workflow's events as they happen
+
+        Returns the events published so far and a function that cancels
+        the subscription, or None for an unknown workflow. `subscriber`
+        is called on workflow threads; it must be quick and not block.
+        '''
+        with self._lock:
+            record = self._records.get(workflow_id)
+            if record is None:
+                return None
+            past = list(record['events'])
+            if not past or past[-1]['event'] not in TERMINAL_EVENTS:
+                record['subscribers'].append(subscriber)
+
+        def unsubscribe():
+            with self._lock:
+                if subscriber in record['subscribers']:
+                    record['subscribers'].remove(subscriber)
+
+        return past, unsubscribe
+
+    def stats(self) -> Dict[str, Any]:
+        '''Pending workflows against the limit, and the scheduler queue per priority'''
+        with self._lock:
+            pending, tracked = self._pending, len(self._records)
+        return {
+            'pending': pending,
+            'max_pending': self.max_pending,
+            'workers': self.workers,
+            'tracked': tracked,
+            'queued': self._scheduler.depth()
+        }
+
+    def close(self, wait: bool = True):
+        '''Stop accepting workflows; queued ones still run (waited for with `wait`)'''
+        with self._lock:
+            self._closed = True
+        self._scheduler.shutdown(wait)
+
+    def _run(self, workflow_id: str, item: Dict[str, Any], resume: bool):
+        self._update(workflow_id, 'started', status='running', started_at=_now())
+        state = None
+        try:
+            state = self.orchestrator.run_isolated(item, resume)
+        finally:
+            failed = state is None or state['status'] == 'failed'
+            result = {field: state.get(field) for field in RESULT_FIELDS} if state else {}
+            with self._lock:
+                self._pending -= 1
+                record = self._records.get(workflow_id)
+                if record is not None:
+                    record['status'] = 'failed' if failed else state['status']
+                    record['finished_at'] = _now()
+                    record['state'].update(result)
+                    self._publish(record, 'failed' if failed else 'completed', result)
+
+    def _on_node(self, workflow_id: str, node: str, update: Dict[str, Any]):
+        '''Orchestrator node listener: record progress and publish a node event'''
+        data = {field: value for field, value in update.items() if field in RESULT_FIELDS}
+        with self._lock:
+            record = self._records.get(workflow_id)
+            if record is None:
+                return
+            record['completed_nodes'].append(node)
+            record['state'].update(data)
+            self._publish(record, 'node', dict(data, node=node))
+
+    def _update(self, workflow_id: str, event: str, **fields):
+        with self._lock:
+            record = self._records.get(workflow_id)
+            if record is not None:
+                record.update(fields)
+                self._publish(record, event)
+
+    def _publish(self, record: Dict[str, Any], event: str, data: Optional[Dict[str, Any]] = None):
+        # Caller must hold _lock
+        message = {
+            'id': len(record['events']) + 1,
+            'event': event,
+            'workflow_id': record['workflow_id'],
+            'time': _now(),
+            'data': data or {}
+        }
+        record['events'].append(message)
+
+        for subscriber in list(record['subscribers']):
+            try:
+                subscriber(message)
+            except Exception as e:
+                # e.g. the client's event loop has closed
+                record['subscribers'].remove(subscriber)
+                self.logger.debug(f'Dropped event subscriber: {str(e)}')
+        if event in TERMINAL_EVENTS:
+            record['subscribers'].clear()
+
+    def _evict(self):
+        # Caller must hold _lock; forgets the oldest finished workflows
+        excess = len(self._records) - self.max_tracked
+        if excess <= 0:
+            return
+        stale = []
+        for workflow_id, record in self._records.items():
+            if len(stale) == excess:
+                break
+            if record['finished_at']:
+                stale.append(workflow_id)
+        for workflow_id in stale:
+            del self._records[workflow_id]
+
+    def _view(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        # Caller must hold _lock
+        view = {
+            field: record[field]
+            for field in ('workflow_id', 'status', 'priority', 'submitted_at', 'started_at', 'finished_at')
+        }
+        view['completed_nodes'] = list(record['completed_nodes'])
+        view.update({field: record['state'].get(field) for field in RESULT_FIELDS})
+        return view
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
@@ -1,23 +1,119 @@
-﻿from typing import Dict, Any, List
-from abc import ABC, abstractmethod
+﻿from typing import Dict, Any, List, Callable, Optional
+from abc import ABC
+import logging
+from observability import metrics
+from observability.structured_logging import get_logger
+
+
+# A bulk handler takes the params of a run of same-action calls and returns
+# one result per call, in order
+BulkHandler = Callable[[List[Dict[str, Any]]], List[Dict[str, Any]]]
+
+
+def tool(name: str, description: str, parameters: Optional[Dict[str, str]] = None):
+    '''
+    Register a server method as an MCP tool
+    
+    The method takes the params dict and returns a result dict. Tools are
+    collected per class, so get_tools() and execute() need no per-server code.
+    '''
+    def decorator(method):
+        method._mcp_tool = {
+            'name': name,
+            'description': description,
+            'parameters': parameters or {}
+        }
+        return method
+    return decorator
 
 
 class BaseMCPServer(ABC):
     '''Base class for all MCP servers'''
     
+    # tool name -> (method name, tool spec), filled in by __init_subclass__
+    _tools: Dict[str, tuple] = {}
+    
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        tools = {}
+        for klass in reversed(cls.__mro__):
+            for attr, value in vars(klass).items():
+                spec = getattr(value, '_mcp_tool', None)
+                if spec is not None:
+                    tools[spec['name']] = (attr, spec)
+        cls._tools = tools
+    
     def __init__(self, server_name: str):
         self.server_name = server_name
+        self.logger = get_logger(f'mcp.{server_name}')
     
-    @abstractmethod
     def get_tools(self) -> List[Dict[str, Any]]:
         '''Return list of available tools/actions'''
-        pass
+        return [dict(spec) for _, spec in self._tools.values()]
     
-    @abstractmethod
     def execute(self, action: str, params: Dict[str, Any]) -> Dict[str, Any]:
         '''Execute an action with given parameters'''
-        pass
+        entry = self._tools.get(action)
+        if entry is None:
+            return {
+                'success': False,
+                'error': f'Unknown action: {action}'
+            }
+        
+        # Per-call line at DEBUG, which is sampled (LOG_SAMPLE_RATES)
+        self.log(f'Executing: {action}', logging.DEBUG)
+        
+        with metrics.time_mcp(self.server_name, action):
+            return getattr(self, entry[0])(params)
+    
+    def execute_many(self, actions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        '''
+        Execute many actions, returning one result per action in order
+        
+        Each action is a dict with 'action' and optional 'params'. A
+        failing action does not stop the rest; its result has success
+        False and the error. Servers override this to batch actions that
+        are cheaper together (see _execute_grouped).
+        '''
+        return self._execute_grouped(actions, {})
+    
+    def _execute_grouped(
+        self,
+        actions: List[Dict[str, Any]],
+        bulk_handlers: Dict[str, BulkHandler]
+    ) -> List[Dict[str, Any]]:
+        '''
+        Run consecutive same-action calls through a bulk handler when one
+        is given for that action, and everything else through execute()
+        
+        Only consecutive calls are grouped, so results stay consistent
+        with running the actions one by one in order.
+        '''
+        self.log(f'Executing {len(actions)} actions')
+        results: List[Dict[str, Any]] = []
+        
+        start = 0
+        while start < len(actions):
+            action = actions[start].get('action')
+            end = start + 1
+            if action in bulk_handlers:
+                while end < len(actions) and actions[end].get('action') == action:
+                    end += 1
+            
+            run = [a.get('params') or {} for a in actions[start:end]]
+            try:
+                if action in bulk_handlers:
+                    with metrics.time_mcp(self.server_name, f'{action}_bulk'):
+                        results.extend(bulk_handlers[action](run))
+                else:
+                    results.append(self.execute(action, run[0]))
+            except Exception as e:
+                error = {'success': False, 'error': f'{type(e).__name__}: {str(e)}'}
+                results.extend(dict(error) for _ in run)
+            start = end
+        
+        return results
     
-    def log(self, message: str):
-        '''Simple logging'''
-        print(f'[{self.server_name}] {message}')
+    def log(self, message: str, level: int = logging.INFO):
+        '''Log through the shared non-blocking pipeline'''
+        self.logger.log(level, message)
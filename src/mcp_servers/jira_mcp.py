@@ -1,130 +1,323 @@
 ﻿from typing import Dict, Any, List
-from .base_mcp import BaseMCPServer
+from collections import OrderedDict
+from concurrent.futures import Future
+from .base_mcp import BaseMCPServer, tool
+from .ticket_store import InMemoryTicketStore, SQLiteTicketStore
+from utils.dedup import NearDuplicateIndex
+from datetime import datetime, timezone
 import json
+import logging
+import os
+import threading
 import uuid
 
 
+# Linked reports kept on a ticket (the count keeps growing past this)
+MAX_LINKED_REPORTS = 100
+
+# create_ticket results remembered per idempotency key
+IDEMPOTENCY_KEYS = 10000
+
+
 class JiraMCPServer(BaseMCPServer):
     '''Mock Jira MCP Server (simulates Jira without real API)'''
     
-    def __init__(self):
+    def __init__(self, store=None, dedup_index=None):
         super().__init__('jira-mcp')
-        # Store mock tickets in memory
-        self.tickets = []
-    
-    def get_tools(self) -> List[Dict[str, Any]]:
-        '''Available Jira tools'''
-        return [
-            {
-                'name': 'create_ticket',
-                'description': 'Create a Jira ticket',
-                'parameters': {
-                    'title': 'Ticket title/summary',
-                    'description': 'Detailed description',
-                    'priority': 'P0/P1/P2/P3',
-                    'ticket_type': 'Bug/Feature/Task'
-                }
-            },
-            {
-                'name': 'get_ticket',
-                'description': 'Get ticket by ID',
-                'parameters': {
-                    'ticket_id': 'Ticket ID (e.g., BUG-123)'
-                }
-            },
-            {
-                'name': 'search_tickets',
-                'description': 'Search for tickets',
-                'parameters': {
-                    'query': 'Search query',
-                    'limit': 'Max results (default: 10)'
-                }
-            }
-        ]
-    
-    def execute(self, action: str, params: Dict[str, Any]) -> Dict[str, Any]:
-        '''Execute Jira action'''
-        self.log(f'Executing: {action}')
-        
-        if action == 'create_ticket':
-            return self._create_ticket(params)
-        elif action == 'get_ticket':
-            return self._get_ticket(params)
-        elif action == 'search_tickets':
-            return self._search_tickets(params)
-        else:
-            return {
-                'success': False,
-                'error': f'Unknown action: {action}'
-            }
+        # Store mock tickets in memory, or in SQLite for large load-test datasets
+        self.store = store if store is not None else self._build_store()
+        # Recent report texts, for linking near-duplicates to existing tickets
+        self.dedup_index = dedup_index if dedup_index is not None else self._build_dedup_index()
+        self._create_lock = threading.Lock()
+        # idempotency key -> Future of its create_ticket result, oldest first
+        self._idempotent: OrderedDict = OrderedDict()
+        self._idempotency_lock = threading.Lock()
+    
+    def _build_dedup_index(self):
+        '''Near-duplicate index from DEDUP_* settings (None when disabled)'''
+        if os.getenv('DEDUP_ENABLED', 'true').lower() != 'true':
+            return None
+        return NearDuplicateIndex(
+            threshold=float(os.getenv('DEDUP_THRESHOLD', '0.6')),
+            window_seconds=float(os.getenv('DEDUP_WINDOW_SECONDS', '3600'))
+        )
+    
+    def _build_store(self):
+        '''Pick the ticket store from JIRA_STORE (memory/sqlite)'''
+        if os.getenv('JIRA_STORE', 'memory').lower() == 'sqlite':
+            return SQLiteTicketStore(os.getenv('JIRA_SQLITE_PATH', ':memory:'))
+        return InMemoryTicketStore()
     
+    @property
+    def tickets(self) -> List[Dict[str, Any]]:
+        '''All tickets in creation order (copies the whole store; avoid in hot paths)'''
+        return self.store.all()
+    
+    def execute_many(self, actions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        '''Bulk execute; consecutive create_ticket calls are stored in one batch'''
+        return self._execute_grouped(actions, {'create_ticket': self._create_tickets})
+    
+    @tool('create_ticket', 'Create a Jira ticket', {
+        'title': 'Ticket title/summary',
+        'description': 'Detailed description',
+        'priority': 'P0/P1/P2/P3',
+        'ticket_type': 'Bug/Feature/Task',
+        'dedup_text': 'Optional report text; a near-duplicate of a recent ticket is linked instead of created',
+        'workflow_id': 'Optional workflow ID recorded when the report is linked',
+        'idempotency_key': 'Optional key; repeating a call with the same key returns the first result'
+    })
     def _create_ticket(self, params: Dict[str, Any]) -> Dict[str, Any]:
-        '''Mock creating a Jira ticket'''
+        '''Mock creating a Jira ticket (or linking a near-duplicate report)'''
+        key = params.get('idempotency_key')
+        if not key:
+            return self._create_or_link(params)
+        
+        # The first call for a key claims it under the lock; concurrent
+        # calls with the same key wait for its result instead of creating
+        with self._idempotency_lock:
+            pending = self._idempotent.get(key)
+            if pending is None:
+                claim = self._idempotent[key] = Future()
+                while len(self._idempotent) > IDEMPOTENCY_KEYS:
+                    self._idempotent.popitem(last=False)
+        if pending is not None:
+            result = pending.result()
+            if result.get('success'):
+                self.log(f'Replaying create_ticket for idempotency key {key}')
+                return dict(result, replayed=True)
+            return result
+        
+        try:
+            result = self._create_or_link(params)
+        except Exception as e:
+            self._release_key(key, claim)
+            claim.set_exception(e)
+            raise
+        if not result.get('success'):
+            # Failures are not remembered; a later call may try again
+            self._release_key(key, claim)
+        claim.set_result(result)
+        return result
+    
+    def _release_key(self, key: str, claim: Future):
+        with self._idempotency_lock:
+            if self._idempotent.get(key) is claim:
+                del self._idempotent[key]
+    
+    def _create_or_link(self, params: Dict[str, Any]) -> Dict[str, Any]:
         title = params.get('title', 'Untitled')
         description = params.get('description', '')
         priority = params.get('priority', 'P3')
         ticket_type = params.get('ticket_type', 'Task')
+        dedup_text = params.get('dedup_text')
+        
+        if dedup_text and self.dedup_index is not None:
+            # Check and create atomically so a burst of concurrent reports
+            # of the same problem yields one ticket
+            with self._create_lock:
+                match = self.dedup_index.find(dedup_text)
+                if not match:
+                    result = self._new_ticket(title, description, priority, ticket_type)
+                    self.dedup_index.add(result['ticket_id'], dedup_text)
+                    return result
+            
+            ticket_id, similarity = match
+            result = self._link_report({'ticket_id': ticket_id, 'workflow_id': params.get('workflow_id')})
+            result['similarity'] = similarity
+            return result
+        
+        return self._new_ticket(title, description, priority, ticket_type)
+    
+    def _create_tickets(self, params_list: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        '''
+        Create many tickets with one ID allocation per type and one store write
+        
+        Calls with dedup_text or an idempotency_key go through
+        _create_ticket one by one, since each may resolve to a ticket
+        created earlier.
+        '''
+        results: List[Dict[str, Any]] = [None] * len(params_list)
+        pending = []
+        
+        for i, params in enumerate(params_list):
+            if params.get('idempotency_key') or (params.get('dedup_text') and self.dedup_index is not None):
+                results[i] = self._create_ticket(params)
+            else:
+                pending.append(i)
+        
+        # Allocate IDs per type in one call each
+        by_prefix: Dict[str, List[int]] = {}
+        for i in pending:
+            prefix = params_list[i].get('ticket_type', 'Task').upper()[:3]
+            by_prefix.setdefault(prefix, []).append(i)
+        
+        ticket_ids = {}
+        for prefix, indexes in by_prefix.items():
+            for i, ticket_id in zip(indexes, self.store.next_ids(prefix, len(indexes))):
+                ticket_ids[i] = ticket_id
         
-        # Generate ticket ID
-        ticket_id = f'{ticket_type.upper()[:3]}-{len(self.tickets) + 1}'
+        tickets = []
+        for i in pending:
+            params = params_list[i]
+            ticket = self._ticket_record(
+                ticket_ids[i],
+                params.get('title', 'Untitled'),
+                params.get('description', ''),
+                params.get('priority', 'P3'),
+                params.get('ticket_type', 'Task')
+            )
+            tickets.append(ticket)
+            results[i] = self._created_result(ticket)
+        
+        self.store.add_many(tickets)
+        
+        self.log(f'Tickets created: {len(tickets)} in bulk')
+        
+        return results
+    
+    def _new_ticket(self, title: str, description: str, priority: str, ticket_type: str) -> Dict[str, Any]:
+        # Generate ticket ID (numbered per ticket type)
+        ticket_id = self.store.next_id(ticket_type.upper()[:3])
+        
+        ticket = self._ticket_record(ticket_id, title, description, priority, ticket_type)
+        
+        self.store.add(ticket)
+        
+        self.log(f'Ticket created: {ticket_id} - {title}')
         
-        ticket = {
+        return self._created_result(ticket)
+    
+    def _ticket_record(
+        self,
+        ticket_id: str,
+        title: str,
+        description: str,
+        priority: str,
+        ticket_type: str
+    ) -> Dict[str, Any]:
+        return {
             'ticket_id': ticket_id,
             'title': title,
             'description': description,
             'priority': priority,
             'ticket_type': ticket_type,
             'status': 'Open',
-            'created_at': '2026-01-30T12:00:00Z',
+            'created_at': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
             'assignee': None
         }
-        
-        self.tickets.append(ticket)
-        
-        self.log(f'Ticket created: {ticket_id} - {title}')
-        
+    
+    def _created_result(self, ticket: Dict[str, Any]) -> Dict[str, Any]:
         return {
             'success': True,
-            'ticket_id': ticket_id,
-            'ticket_url': f'https://jira.example.com/browse/{ticket_id}',
+            'ticket_id': ticket['ticket_id'],
+            'ticket_url': f'https://jira.example.com/browse/{ticket["ticket_id"]}',
             'ticket': ticket
         }
     
+    @tool('get_ticket', 'Get ticket by ID', {
+        'ticket_id': 'Ticket ID (e.g., BUG-123)'
+    })
     def _get_ticket(self, params: Dict[str, Any]) -> Dict[str, Any]:
         '''Mock getting a ticket'''
         ticket_id = params.get('ticket_id')
         
         # Find ticket
-        ticket = next((t for t in self.tickets if t['ticket_id'] == ticket_id), None)
+        ticket = self.store.get(ticket_id)
         
         if ticket:
-            self.log(f'Ticket found: {ticket_id}')
+            self.log(f'Ticket found: {ticket_id}', logging.DEBUG)
             return {
                 'success': True,
                 'ticket': ticket
             }
         else:
-            self.log(f'Ticket not found: {ticket_id}')
+            self.log(f'Ticket not found: {ticket_id}', logging.DEBUG)
             return {
                 'success': False,
                 'error': f'Ticket {ticket_id} not found'
             }
     
+    @tool('search_tickets', 'Search for tickets', {
+        'query': 'Search query (all words must match)',
+        'limit': 'Max results (default: 10)',
+        'offset': 'Number of ranked results to skip (default: 0)'
+    })
     def _search_tickets(self, params: Dict[str, Any]) -> Dict[str, Any]:
-        '''Mock searching tickets'''
-        query = params.get('query', '').lower()
+        '''Mock searching tickets (ranked, paginated)'''
+        query = params.get('query', '')
         limit = params.get('limit', 10)
+        offset = params.get('offset', 0)
         
-        # Simple search in title and description
-        results = [
-            t for t in self.tickets
-            if query in t['title'].lower() or query in t['description'].lower()
-        ][:limit]
+        results, total = self.store.search(query, limit=limit, offset=offset)
         
-        self.log(f'Search found {len(results)} tickets for: {query}')
+        self.log(f'Search found {total} tickets for: {query}', logging.DEBUG)
+        
+        next_offset = offset + len(results)
         
         return {
             'success': True,
             'tickets': results,
-            'count': len(results)
+            'count': len(results),
+            'total': total,
+            'next_offset': next_offset if next_offset < total else None
+        }
+    
+    @tool('find_duplicate', 'Find a recent ticket whose report is a near-duplicate of a text', {
+        'text': 'Report text'
+    })
+    def _find_duplicate(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        '''Look up a recent ticket for a near-duplicate report'''
+        text = params.get('text', '')
+        
+        match = self.dedup_index.find(text) if self.dedup_index is not None else None
+        
+        if not match:
+            return {
+                'success': True,
+                'duplicate': False
+            }
+        
+        ticket_id, similarity = match
+        self.log(f'Near-duplicate of {ticket_id} (similarity {similarity:.2f})')
+        
+        return {
+            'success': True,
+            'duplicate': True,
+            'ticket_id': ticket_id,
+            'similarity': similarity,
+            'ticket': self.store.get(ticket_id)
+        }
+    
+    @tool('link_report', 'Record another report of an existing ticket', {
+        'ticket_id': 'Ticket ID',
+        'workflow_id': 'Workflow that received the report'
+    })
+    def _link_report(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        '''Attach another report to an existing ticket'''
+        ticket_id = params.get('ticket_id')
+        
+        with self._create_lock:
+            ticket = self.store.get(ticket_id)
+            if not ticket:
+                return {
+                    'success': False,
+                    'error': f'Ticket {ticket_id} not found'
+                }
+            
+            ticket = dict(ticket)
+            linked = list(ticket.get('linked_reports', []))
+            if params.get('workflow_id'):
+                linked = (linked + [params['workflow_id']])[-MAX_LINKED_REPORTS:]
+            ticket['linked_reports'] = linked
+            ticket['report_count'] = ticket.get('report_count', 1) + 1
+            self.store.update(ticket)
+        
+        self.log(f'Report linked to {ticket_id} ({ticket["report_count"]} reports)')
+        
+        return {
+            'success': True,
+            'ticket_id': ticket_id,
+            'ticket_url': f'https://jira.example.com/browse/{ticket_id}',
+            'ticket': ticket,
+            'duplicate_of': ticket_id
         }
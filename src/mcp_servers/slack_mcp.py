@@ -1,64 +1,49 @@
-﻿from typing import Dict, Any, List
-from .base_mcp import BaseMCPServer
+﻿from typing import Dict, Any, List, Optional
+from collections import deque
+from itertools import islice
+from .base_mcp import BaseMCPServer, tool
 import json
+import logging
+import os
+import sys
+import threading
+import time
 
 
 class SlackMCPServer(BaseMCPServer):
     '''Mock Slack MCP Server (simulates Slack without real API)'''
     
-    def __init__(self):
+    def __init__(self, retention: Optional[int] = None):
         super().__init__('slack-mcp')
-        # Store mock messages in memory
-        self.messages = []
+        # Store mock messages in memory: one ring buffer per channel that
+        # keeps only the newest `retention` messages
+        self.retention = retention or int(os.getenv('SLACK_CHANNEL_RETENTION', '1000'))
+        self.channels: Dict[str, deque] = {}
+        self._next_seq: Dict[str, int] = {}
+        self._last_ts: Dict[str, float] = {}
+        self._lock = threading.Lock()
     
-    def get_tools(self) -> List[Dict[str, Any]]:
-        '''Available Slack tools'''
-        return [
-            {
-                'name': 'send_message',
-                'description': 'Send a message to a Slack channel',
-                'parameters': {
-                    'channel': 'Channel name (e.g., #bugs)',
-                    'text': 'Message text'
-                }
-            },
-            {
-                'name': 'get_messages',
-                'description': 'Get recent messages from a channel',
-                'parameters': {
-                    'channel': 'Channel name',
-                    'limit': 'Number of messages (default: 10)'
-                }
-            }
-        ]
+    @property
+    def messages(self) -> List[Dict[str, Any]]:
+        '''All retained messages, grouped by channel (copies everything; avoid in hot paths)'''
+        with self._lock:
+            return [m for buffer in self.channels.values() for m in buffer]
     
-    def execute(self, action: str, params: Dict[str, Any]) -> Dict[str, Any]:
-        '''Execute Slack action'''
-        self.log(f'Executing: {action}')
-        
-        if action == 'send_message':
-            return self._send_message(params)
-        elif action == 'get_messages':
-            return self._get_messages(params)
-        else:
-            return {
-                'success': False,
-                'error': f'Unknown action: {action}'
-            }
+    def execute_many(self, actions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        '''Bulk execute; consecutive send_message calls are appended per channel under one lock'''
+        return self._execute_grouped(actions, {'send_message': self._send_messages})
     
+    @tool('send_message', 'Send a message to a Slack channel', {
+        'channel': 'Channel name (e.g., #bugs)',
+        'text': 'Message text'
+    })
     def _send_message(self, params: Dict[str, Any]) -> Dict[str, Any]:
         '''Mock sending a message'''
         channel = params.get('channel', '#general')
         text = params.get('text', '')
         
-        message = {
-            'channel': channel,
-            'text': text,
-            'timestamp': '1234567890.123456',
-            'user': 'workflow-agent'
-        }
-        
-        self.messages.append(message)
+        with self._lock:
+            message = self._append(channel, text)
         
         self.log(f'Message sent to {channel}: {text[:50]}...')
         
@@ -68,20 +53,117 @@ class SlackMCPServer(BaseMCPServer):
             'channel': channel
         }
     
+    def _send_messages(self, params_list: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        '''Send many messages, taking the lock once per channel'''
+        by_channel: Dict[str, List[int]] = {}
+        for i, params in enumerate(params_list):
+            by_channel.setdefault(params.get('channel', '#general'), []).append(i)
+        
+        results: List[Dict[str, Any]] = [None] * len(params_list)
+        for channel, indexes in by_channel.items():
+            with self._lock:
+                for i in indexes:
+                    message = self._append(channel, params_list[i].get('text', ''))
+                    results[i] = {
+                        'success': True,
+                        'message_id': message['timestamp'],
+                        'channel': channel
+                    }
+            self.log(f'{len(indexes)} messages sent to {channel}')
+        
+        return results
+    
+    def _append(self, channel: str, text: str) -> Dict[str, Any]:
+        # Caller must hold _lock
+        buffer = self.channels.get(channel)
+        if buffer is None:
+            buffer = self.channels[channel] = deque(maxlen=self.retention)
+            self._next_seq[channel] = 0
+            self._last_ts[channel] = 0.0
+        
+        # Slack timestamps are unique within a channel
+        ts = max(time.time(), self._last_ts[channel] + 0.000001)
+        self._last_ts[channel] = ts
+        
+        message = {
+            'channel': channel,
+            'text': text,
+            'timestamp': f'{ts:.6f}',
+            'user': 'workflow-agent',
+            'seq': self._next_seq[channel]
+        }
+        self._next_seq[channel] += 1
+        
+        # A full deque drops its oldest message on append
+        buffer.append(message)
+        return message
+    
+    @tool('get_messages', 'Get recent messages from a channel', {
+        'channel': 'Channel name',
+        'limit': 'Number of messages (default: 10)',
+        'cursor': 'next_cursor from a previous call, to page back in history'
+    })
     def _get_messages(self, params: Dict[str, Any]) -> Dict[str, Any]:
-        '''Mock getting messages'''
+        '''
+        Mock getting messages
+        
+        Returns up to `limit` of the newest messages older than `cursor`,
+        oldest first. Pass the returned next_cursor to fetch the page before.
+        '''
         channel = params.get('channel', '#general')
-        limit = params.get('limit', 10)
+        # A non-positive limit asks for an empty page
+        limit = max(0, int(params.get('limit', 10)))
+        cursor = params.get('cursor')
         
-        channel_messages = [
-            m for m in self.messages 
-            if m['channel'] == channel
-        ][-limit:]
+        with self._lock:
+            buffer = self.channels.get(channel)
+            if not buffer:
+                channel_messages, next_cursor = [], None
+            else:
+                # Sequence numbers are contiguous within a buffer, so the
+                # cursor maps straight to a position
+                first_seq = buffer[0]['seq']
+                end = len(buffer) if cursor is None else min(len(buffer), max(0, int(cursor) - first_seq))
+                start = max(0, end - limit)
+                # Indexing a deque is O(n) toward the middle; walk in from
+                # the nearer end instead, which is O(limit) for recent pages
+                if start >= len(buffer) - end:
+                    channel_messages = list(islice(reversed(buffer), len(buffer) - end, len(buffer) - start))
+                    channel_messages.reverse()
+                else:
+                    channel_messages = list(islice(buffer, start, end))
+                next_cursor = str(first_seq + start) if start > 0 else None
         
-        self.log(f'Retrieved {len(channel_messages)} messages from {channel}')
+        self.log(f'Retrieved {len(channel_messages)} messages from {channel}', logging.DEBUG)
         
         return {
             'success': True,
             'messages': channel_messages,
-            'count': len(channel_messages)
+            'count': len(channel_messages),
+            'next_cursor': next_cursor
+        }
+    
+    @tool('get_memory_usage', 'Report retained messages and approximate memory per channel')
+    def _get_memory_usage(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        '''Approximate memory held by each channel's buffer'''
+        with self._lock:
+            buffers = {name: list(buffer) for name, buffer in self.channels.items()}
+        
+        channels = {}
+        for name, messages in buffers.items():
+            size = sys.getsizeof(self.channels[name])
+            for message in messages:
+                size += sys.getsizeof(message)
+                size += sum(sys.getsizeof(v) for v in message.values())
+            channels[name] = {
+                'messages': len(messages),
+                'retention': self.retention,
+                'approx_bytes': size
+            }
+        
+        return {
+            'success': True,
+            'channels': channels,
+            'total_messages': sum(c['messages'] for c in channels.values()),
+            'total_approx_bytes': sum(c['approx_bytes'] for c in channels.values())
         }
@@ -0,0 +1,262 @@
+﻿from typing import Dict, Any, List, Optional, Tuple
+from collections import defaultdict
+import heapq
+import json
+import math
+import re
+import sqlite3
+import threading
+
+
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+
+# Title matches count more than description matches when ranking
+TITLE_WEIGHT = 2
+
+
+def tokenize(text: str) -> List[str]:
+    '''Lowercase alphanumeric tokens'''
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class InMemoryTicketStore:
+    '''
+    Ticket store indexed by ID, with an inverted token index for search
+
+    Search returns tickets containing every query token, ranked by a
+    TF-IDF score (title hits weighted higher), newest first on ties.
+    '''
+
+    def __init__(self):
+        self._tickets: Dict[str, Dict[str, Any]] = {}
+        self._order: Dict[str, int] = {}
+        # token -> {ticket_id: weighted term frequency}
+        self._postings: Dict[str, Dict[str, int]] = defaultdict(dict)
+        self._counters: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def next_id(self, prefix: str) -> str:
+        '''Allocate the next ID for a prefix (each prefix has its own sequence)'''
+        with self._lock:
+            self._counters[prefix] += 1
+            return f'{prefix}-{self._counters[prefix]}'
+
+    def next_ids(self, prefix: str, count: int) -> List[str]:
+        '''Allocate `count` consecutive IDs for a prefix'''
+        with self._lock:
+            first = self._counters[prefix] + 1
+            self._counters[prefix] += count
+            return [f'{prefix}-{n}' for n in range(first, first + count)]
+
+    def add(self, ticket: Dict[str, Any]):
+        self.add_many([ticket])
+
+    def add_many(self, tickets: List[Dict[str, Any]]):
+        with self._lock:
+            for ticket in tickets:
+                ticket_id = ticket['ticket_id']
+                self._order[ticket_id] = len(self._order)
+                self._tickets[ticket_id] = ticket
+                self._index(ticket)
+
+    def update(self, ticket: Dict[str, Any]):
+        '''Replace a stored ticket and reindex its text'''
+        with self._lock:
+            old = self._tickets[ticket['ticket_id']]
+            self._unindex(old)
+            self._tickets[ticket['ticket_id']] = ticket
+            self._index(ticket)
+
+    def get(self, ticket_id: str) -> Optional[Dict[str, Any]]:
+        return self._tickets.get(ticket_id)
+
+    def search(self, query: str, limit: int = 10, offset: int = 0) -> Tuple[List[Dict[str, Any]], int]:
+        '''Return (one page of ranked results, total number of matches)'''
+        tokens = set(tokenize(query))
+
+        with self._lock:
+            if not tokens:
+                # No query: newest tickets first
+                total = len(self._tickets)
+                ids = list(self._tickets)[::-1][offset:offset + limit]
+                return [self._tickets[i] for i in ids], total
+
+            postings = sorted((self._postings.get(t, {}) for t in tokens), key=len)
+            # Intersect starting from the rarest token
+            matches = set(postings[0])
+            for posting in postings[1:]:
+                matches.intersection_update(posting)
+                if not matches:
+                    break
+
+            count = len(self._tickets)
+            idf = [math.log(1 + count / len(p)) if p else 0.0 for p in postings]
+
+            def score(ticket_id):
+                relevance = sum(w * p[ticket_id] for w, p in zip(idf, postings))
+                return (relevance, self._order[ticket_id])
+
+            ranked = heapq.nlargest(offset + limit, matches, key=score)
+            return [self._tickets[i] for i in ranked[offset:]], len(matches)
+
+    def all(self) -> List[Dict[str, Any]]:
+        return list(self._tickets.values())
+
+    def __len__(self) -> int:
+        return len(self._tickets)
+
+    def _index(self, ticket: Dict[str, Any]):
+        ticket_id = ticket['ticket_id']
+        for token, weight in _term_weights(ticket).items():
+            self._postings[token][ticket_id] = weight
+
+    def _unindex(self, ticket: Dict[str, Any]):
+        ticket_id = ticket['ticket_id']
+        for token in _term_weights(ticket):
+            posting = self._postings.get(token)
+            if posting is not None:
+                posting.pop(ticket_id, None)
+                if not posting:
+                    del self._postings[token]
+
+
+class SQLiteTicketStore:
+    '''
+    Ticket store backed by SQLite, with FTS5 full-text search
+
+    Keeps large ticket sets out of Python memory. `path` may be a file
+    or ':memory:'. Results are ranked with bm25 (title weighted higher).
+    '''
+
+    def __init__(self, path: str = ':memory:'):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS tickets ('
+                'seq INTEGER PRIMARY KEY, ticket_id TEXT UNIQUE, data TEXT)'
+            )
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS counters (prefix TEXT PRIMARY KEY, value INTEGER)'
+            )
+            self._conn.execute(
+                'CREATE VIRTUAL TABLE IF NOT EXISTS tickets_fts '
+                "USING fts5(title, description, content='')"
+            )
+
+    def next_id(self, prefix: str) -> str:
+        '''Allocate the next ID for a prefix (each prefix has its own sequence)'''
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT INTO counters (prefix, value) VALUES (?, 1) '
+                'ON CONFLICT(prefix) DO UPDATE SET value = value + 1',
+                (prefix,)
+            )
+            value = self._conn.execute(
+                'SELECT value FROM counters WHERE prefix = ?', (prefix,)
+            ).fetchone()[0]
+        return f'{prefix}-{value}'
+
+    def next_ids(self, prefix: str, count: int) -> List[str]:
+        '''Allocate `count` consecutive IDs for a prefix'''
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT INTO counters (prefix, value) VALUES (?, ?) '
+                'ON CONFLICT(prefix) DO UPDATE SET value = value + excluded.value',
+                (prefix, count)
+            )
+            last = self._conn.execute(
+                'SELECT value FROM counters WHERE prefix = ?', (prefix,)
+            ).fetchone()[0]
+        return [f'{prefix}-{n}' for n in range(last - count + 1, last + 1)]
+
+    def add(self, ticket: Dict[str, Any]):
+        self.add_many([ticket])
+
+    def add_many(self, tickets: List[Dict[str, Any]]):
+        '''Insert tickets in a single transaction'''
+        with self._lock, self._conn:
+            for ticket in tickets:
+                cursor = self._conn.execute(
+                    'INSERT INTO tickets (ticket_id, data) VALUES (?, ?)',
+                    (ticket['ticket_id'], json.dumps(ticket))
+                )
+                self._conn.execute(
+                    'INSERT INTO tickets_fts (rowid, title, description) VALUES (?, ?, ?)',
+                    (cursor.lastrowid, ticket['title'], ticket['description'])
+                )
+
+    def update(self, ticket: Dict[str, Any]):
+        '''Replace a stored ticket and reindex its text'''
+        with self._lock, self._conn:
+            seq, data = self._conn.execute(
+                'SELECT seq, data FROM tickets WHERE ticket_id = ?', (ticket['ticket_id'],)
+            ).fetchone()
+            old = json.loads(data)
+            # Contentless FTS tables are updated by deleting the old terms
+            self._conn.execute(
+                "INSERT INTO tickets_fts (tickets_fts, rowid, title, description) "
+                "VALUES ('delete', ?, ?, ?)",
+                (seq, old['title'], old['description'])
+            )
+            self._conn.execute(
+                'INSERT INTO tickets_fts (rowid, title, description) VALUES (?, ?, ?)',
+                (seq, ticket['title'], ticket['description'])
+            )
+            self._conn.execute(
+                'UPDATE tickets SET data = ? WHERE seq = ?', (json.dumps(ticket), seq)
+            )
+
+    def get(self, ticket_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT data FROM tickets WHERE ticket_id = ?', (ticket_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def search(self, query: str, limit: int = 10, offset: int = 0) -> Tuple[List[Dict[str, Any]], int]:
+        '''Return (one page of ranked results, total number of matches)'''
+        tokens = sorted(set(tokenize(query)))
+
+        with self._lock:
+            if not tokens:
+                total = self._conn.execute('SELECT count(*) FROM tickets').fetchone()[0]
+                rows = self._conn.execute(
+                    'SELECT data FROM tickets ORDER BY seq DESC LIMIT ? OFFSET ?',
+                    (limit, offset)
+                ).fetchall()
+                return [json.loads(r[0]) for r in rows], total
+
+            # Quote every token so user input is never parsed as FTS syntax
+            match = ' '.join(f'"{t}"' for t in tokens)
+            total = self._conn.execute(
+                'SELECT count(*) FROM tickets_fts WHERE tickets_fts MATCH ?', (match,)
+            ).fetchone()[0]
+            rows = self._conn.execute(
+                'SELECT t.data FROM tickets_fts f JOIN tickets t ON t.seq = f.rowid '
+                'WHERE tickets_fts MATCH ? '
+                f'ORDER BY bm25(tickets_fts, {TITLE_WEIGHT}.0, 1.0), t.seq DESC '
+                'LIMIT ? OFFSET ?',
+                (match, limit, offset)
+            ).fetchall()
+
+        return [json.loads(r[0]) for r in rows], total
+
+    def all(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute('SELECT data FROM tickets ORDER BY seq').fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT count(*) FROM tickets').fetchone()[0]
+
+
+def _term_weights(ticket: Dict[str, Any]) -> Dict[str, int]:
+    weights: Dict[str, int] = defaultdict(int)
+    for token in tokenize(ticket['title']):
+        weights[token] += TITLE_WEIGHT
+    for token in tokenize(ticket['description']):
+        weights[token] += 1
+    return weights
@@ -0,0 +1,200 @@
+﻿'''
+Prometheus metrics for the workflow hot paths
+
+Covers LangGraph node latency, Bedrock latency and token usage per model,
+DynamoDB write latency, MCP execute latency per server/action, and
+admission control (rate-limit waits, scheduler queue depth and wait). Label
+children are cached, so recording a sample is a dict lookup plus a
+histogram observe (about a microsecond); the metrics are meant to stay on
+in production.
+
+prometheus-client is optional: without it (or with METRICS_ENABLED=false)
+every helper is a no-op. Call start_metrics_server() to expose /metrics.
+'''
+from typing import Any, Callable, Dict, Optional, Tuple
+import contextlib
+import functools
+import os
+import threading
+import time
+from observability.structured_logging import get_logger
+
+try:
+    from prometheus_client import Counter, Gauge, Histogram, start_http_server
+except ImportError:  # pragma: no cover - optional dependency
+    Counter = Gauge = Histogram = start_http_server = None
+
+
+ENABLED = Histogram is not None and os.getenv('METRICS_ENABLED', 'true').lower() != 'false'
+
+# Model calls take seconds; in-process MCP actions take microseconds
+SLOW_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+STORAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+if ENABLED:
+    NODE_LATENCY = Histogram(
+        'workflow_node_duration_seconds', 'Time spent in each LangGraph node',
+        ['node'], buckets=SLOW_BUCKETS
+    )
+    BEDROCK_LATENCY = Histogram(
+        'bedrock_request_duration_seconds', 'Bedrock invoke latency (full response or stream)',
+        ['model_id', 'mode'], buckets=SLOW_BUCKETS
+    )
+    BEDROCK_INPUT_TOKENS = Counter(
+        'bedrock_input_tokens', 'Prompt tokens sent to Bedrock', ['model_id']
+    )
+    BEDROCK_OUTPUT_TOKENS = Counter(
+        'bedrock_output_tokens', 'Completion tokens returned by Bedrock', ['model_id']
+    )
+    DYNAMODB_WRITE_LATENCY = Histogram(
+        'dynamodb_write_duration_seconds', 'DynamoDB write latency',
+        ['table', 'operation'], buckets=STORAGE_BUCKETS
+    )
+    BEDROCK_POLICY_EVENTS = Counter(
+        'bedrock_policy_events', 'Retries, hedges, deadline misses and circuit rejections',
+        ['model_id', 'event']
+    )
+    MCP_EXECUTE_LATENCY = Histogram(
+        'mcp_execute_duration_seconds', 'MCP server execute latency',
+        ['server', 'action'], buckets=FAST_BUCKETS
+    )
+    RATE_LIMIT_WAIT = Histogram(
+        'bedrock_rate_limit_wait_seconds', 'Time model calls waited for rate-limit capacity',
+        ['model_id'], buckets=SLOW_BUCKETS
+    )
+    QUEUE_DEPTH = Gauge(
+        'workflow_queue_depth', 'Workflows waiting in the priority scheduler', ['priority']
+    )
+    QUEUE_WAIT = Histogram(
+        'workflow_queue_wait_seconds', 'Time workflows waited in the priority scheduler',
+        ['priority'], buckets=SLOW_BUCKETS
+    )
+
+_children: Dict[Tuple, Any] = {}
+_server_lock = threading.Lock()
+_server_port: Optional[int] = None
+
+
+def _child(metric, *labels):
+    # labels() takes a lock and builds a tuple each call; cache the children
+    key = (id(metric), labels)
+    child = _children.get(key)
+    if child is None:
+        child = _children.setdefault(key, metric.labels(*labels))
+    return child
+
+
+class _Timer:
+    '''Context manager observing elapsed seconds into a histogram child'''
+
+    __slots__ = ('_child', '_start')
+
+    def __init__(self, child):
+        self._child = child
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._child.observe(time.perf_counter() - self._start)
+        return False
+
+
+_NOOP = contextlib.nullcontext()
+
+
+def time_node(node: str, fn: Callable) -> Callable:
+    '''Wrap a LangGraph node function so each call is timed'''
+    if not ENABLED:
+        return fn
+
+    child = _child(NODE_LATENCY, node)
+
+    @functools.wraps(fn)
+    def timed(state):
+        with _Timer(child):
+            return fn(state)
+
+    return timed
+
+
+def time_mcp(server: str, action: str):
+    '''Context manager timing one MCP execute call'''
+    if not ENABLED:
+        return _NOOP
+    return _Timer(_child(MCP_EXECUTE_LATENCY, server, action))
+
+
+def time_dynamodb_write(table: str, operation: str = 'put_item'):
+    '''Context manager timing one DynamoDB write (put_item or batch_write)'''
+    if not ENABLED:
+        return _NOOP
+    return _Timer(_child(DYNAMODB_WRITE_LATENCY, table, operation))
+
+
+def observe_bedrock(
+    model_id: str,
+    seconds: float,
+    input_tokens: Optional[int] = None,
+    output_tokens: Optional[int] = None,
+    mode: str = 'invoke'
+):
+    '''Record one Bedrock call; token counts are skipped when unknown'''
+    if not ENABLED:
+        return
+
+    _child(BEDROCK_LATENCY, model_id, mode).observe(seconds)
+    if input_tokens:
+        _child(BEDROCK_INPUT_TOKENS, model_id).inc(input_tokens)
+    if output_tokens:
+        _child(BEDROCK_OUTPUT_TOKENS, model_id).inc(output_tokens)
+
+
+def count_llm_event(model_id: str, event: str):
+    '''Count a call-policy event (retries, hedges, rejected, ...)'''
+    if ENABLED:
+        _child(BEDROCK_POLICY_EVENTS, model_id, event).inc()
+
+
+def observe_rate_limit_wait(model_id: str, seconds: float):
+    '''Record how long a model call waited for the rate limiter'''
+    if ENABLED:
+        _child(RATE_LIMIT_WAIT, model_id).observe(seconds)
+
+
+def set_queue_depth(priority: str, depth: int):
+    '''Current number of queued workflows at a priority'''
+    if ENABLED:
+        _child(QUEUE_DEPTH, priority).set(depth)
+
+
+def observe_queue_wait(priority: str, seconds: float):
+    '''Record how long a workflow waited before it started'''
+    if ENABLED:
+        _child(QUEUE_WAIT, priority).observe(seconds)
+
+
+def start_metrics_server(port: Optional[int] = None) -> bool:
+    '''
+    Serve /metrics on a background thread (port defaults to METRICS_PORT)
+
+    Returns False when metrics are disabled or no port is configured.
+    Safe to call more than once; only the first call starts a server.
+    '''
+    global _server_port
+
+    if not ENABLED:
+        return False
+
+    port = port or int(os.getenv('METRICS_PORT', '0'))
+    if not port:
+        return False
+
+    with _server_lock:
+        if _server_port is None:
+            start_http_server(port)
+            _server_port = port
+            get_logger('metrics').info(f'Metrics available on :{port}/metrics')
+    return True
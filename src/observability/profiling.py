@@ -0,0 +1,402 @@
+﻿'''
+Opt-in profiling for workflow runs
+
+Answers "where did this slow workflow spend its time": LangGraph
+bookkeeping, a node's own code, boto3 serialization, state JSON encoding
+or an MCP server. For every node call it records:
+
+- a cProfile profile (deterministic, per function)
+- a tracemalloc snapshot diff (allocation sites), unless disabled
+- wall-clock time
+
+A background thread also samples the stacks of every thread working for
+a profiled workflow every few milliseconds, which catches time spent
+waiting (I/O, locks, the model) that cProfile attributes poorly. Stacks
+are rooted at the node (or "(graph)" for LangGraph itself, between
+nodes); work handed to pools (model calls, notification fan-out) is
+rooted at the pool's thread name.
+
+Each report (one workflow, or WORKFLOW_PROFILE_RUNS of them) is written
+to WORKFLOW_PROFILE_DIR as:
+
+    <name>.collapsed       folded stacks for flamegraph.pl or speedscope
+    <name>.pstats          cProfile data of all nodes (snakeviz, pstats)
+    <name>.<node>.pstats   cProfile data of one node
+    <name>.json            per-node time, top functions and allocation sites
+
+e.g. flamegraph.pl profiles/workflow-1a2b3c4d.collapsed > flame.svg
+
+Nothing is wrapped or started unless a profiler is configured, so the
+mode costs nothing when off. When on, expect runs to be several times
+slower; compare nodes with each other, not with production latencies.
+Allocation figures are process-wide while a node runs, so concurrent
+workflows blur them; profile with a concurrency of 1 for exact numbers.
+The snapshot diffs dominate the added time in a large process; turn them
+off (WORKFLOW_PROFILE_TRACEMALLOC=false) when only timings matter.
+
+Settings (read by from_env):
+    WORKFLOW_PROFILE              true to enable (default false)
+    WORKFLOW_PROFILE_DIR          output directory (default profiles)
+    WORKFLOW_PROFILE_RUNS         workflows per report (default 1)
+    WORKFLOW_PROFILE_INTERVAL_MS  stack sampling interval (default 5)
+    WORKFLOW_PROFILE_TRACEMALLOC  allocation snapshots per node (default true)
+'''
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from collections import Counter
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from observability.structured_logging import get_logger
+
+
+# Root of stacks sampled on the thread driving the graph, outside any node
+GRAPH_ROOT = '(graph)'
+# Root of stacks sampled while the profiler takes allocation snapshots
+PROFILER_ROOT = '(profiler)'
+
+# Leaf frames of pool threads with nothing to do; not worth a sample
+IDLE_LEAVES = {
+    ('threading.py', 'wait'),
+    ('queue.py', 'get'),
+    ('thread.py', '_worker'),
+    ('selectors.py', 'select'),
+    ('scheduler.py', '_work'),
+}
+
+TOP_FUNCTIONS = 15
+TOP_ALLOCATION_SITES = 10
+
+_THREAD_SUFFIX = re.compile(r'([-_]\d+)+$')
+
+
+class _Report:
+    '''Profiling data for one workflow or one batch of aggregated workflows'''
+
+    def __init__(self):
+        self.started_at = datetime.now(timezone.utc)
+        self.workflow_ids: List[str] = []
+        self.started = 0
+        self.finished = 0
+        self.run_seconds = 0.0
+        self.node_calls = Counter()
+        self.node_seconds = Counter()
+        self.stats: Dict[str, pstats.Stats] = {}
+        self.allocated = {}
+        self.stacks = Counter()
+        self.lock = threading.Lock()
+
+    def add_node(
+        self,
+        node: str,
+        seconds: float,
+        profile: Optional[cProfile.Profile],
+        allocations: Optional[Counter]
+    ):
+        with self.lock:
+            self.node_calls[node] += 1
+            self.node_seconds[node] += seconds
+            if profile is not None:
+                if node in self.stats:
+                    self.stats[node].add(profile)
+                else:
+                    self.stats[node] = pstats.Stats(profile)
+            if allocations:
+                self.allocated.setdefault(node, Counter()).update(allocations)
+
+    def add_stack(self, stack: str):
+        with self.lock:
+            self.stacks[stack] += 1
+
+
+class WorkflowProfiler:
+    '''
+    Collects per-node cProfile/tracemalloc data and sampled stacks
+
+    The orchestrator wraps each node with wrap_node() and runs each
+    workflow inside workflow(); both are only used when a profiler is
+    configured.
+    '''
+
+    def __init__(
+        self,
+        output_dir: str = 'profiles',
+        runs_per_report: int = 1,
+        interval: float = 0.005,
+        trace_allocations: bool = True
+    ):
+        self.output_dir = output_dir
+        self.runs_per_report = max(1, runs_per_report)
+        self.interval = interval
+        self.trace_allocations = trace_allocations
+        self.logger = get_logger('profiling')
+        self._reports: Dict[str, _Report] = {}
+        self._current: Optional[_Report] = None
+        # thread id -> (report, stack root) for threads working for a workflow
+        self._threads: Dict[int, Tuple[_Report, str]] = {}
+        self._lock = threading.Lock()
+        self._sampler: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._started_tracemalloc = False
+
+        if trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+
+    @classmethod
+    def from_env(cls) -> Optional['WorkflowProfiler']:
+        '''Profiler from WORKFLOW_PROFILE_* settings (None when profiling is off)'''
+        if os.getenv('WORKFLOW_PROFILE', 'false').lower() != 'true':
+            return None
+        return cls(
+            output_dir=os.getenv('WORKFLOW_PROFILE_DIR', 'profiles'),
+            runs_per_report=int(os.getenv('WORKFLOW_PROFILE_RUNS', '1')),
+            interval=float(os.getenv('WORKFLOW_PROFILE_INTERVAL_MS', '5')) / 1000,
+            trace_allocations=os.getenv('WORKFLOW_PROFILE_TRACEMALLOC', 'true').lower() == 'true'
+        )
+
+    @contextlib.contextmanager
+    def workflow(self, workflow_id: str, track_thread: bool = True):
+        '''
+        Profile the workflow run inside the block
+
+        `track_thread` samples the calling thread as LangGraph overhead;
+        pass False from an event loop, which other workflows share.
+        '''
+        report = self._begin(workflow_id)
+        thread_id = threading.get_ident()
+        if track_thread:
+            self._threads[thread_id] = (report, GRAPH_ROOT)
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if track_thread:
+                self._threads.pop(thread_id, None)
+            self._end(report, workflow_id, time.perf_counter() - start)
+
+    def wrap_node(self, name: str, fn: Callable) -> Callable:
+        '''Wrap a node so calls inside a profiled workflow are recorded'''
+
+        def profiled(state):
+            report = self._reports.get(state.get('workflow_id'))
+            if report is None:
+                return fn(state)
+
+            thread_id = threading.get_ident()
+            previous = self._threads.get(thread_id)
+            self._threads[thread_id] = (report, PROFILER_ROOT)
+            before = self._snapshot()
+
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiler is active on this interpreter (Python 3.12+)
+                profile = None
+
+            self._threads[thread_id] = (report, name)
+            start = time.perf_counter()
+            try:
+                return fn(state)
+            finally:
+                elapsed = time.perf_counter() - start
+                if profile is not None:
+                    profile.disable()
+                self._threads[thread_id] = (report, PROFILER_ROOT)
+                allocations = self._allocations(before)
+                if previous is None:
+                    self._threads.pop(thread_id, None)
+                else:
+                    self._threads[thread_id] = previous
+                report.add_node(name, elapsed, profile, allocations)
+
+        return profiled
+
+    def flush(self):
+        '''Write the current aggregate report now, even if it has fewer runs than configured'''
+        with self._lock:
+            report, self._current = self._current, None
+        if report is not None and report.finished:
+            self._write(report)
+
+    def close(self):
+        '''Flush, stop the sampler and stop tracemalloc if this profiler started it'''
+        self.flush()
+        self._stopped.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+
+    def _begin(self, workflow_id: str) -> _Report:
+        with self._lock:
+            if self.runs_per_report == 1:
+                report = _Report()
+            else:
+                if self._current is None or self._current.started >= self.runs_per_report:
+                    self._current = _Report()
+                report = self._current
+            report.started += 1
+            report.workflow_ids.append(workflow_id)
+            self._reports[workflow_id] = report
+
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, name='profiler-sampler', daemon=True)
+                self._sampler.start()
+        return report
+
+    def _end(self, report: _Report, workflow_id: str, seconds: float):
+        with self._lock:
+            self._reports.pop(workflow_id, None)
+            report.finished += 1
+            report.run_seconds += seconds
+            complete = report.finished == report.started and report.started >= self.runs_per_report
+            if complete and report is self._current:
+                self._current = None
+        if complete:
+            self._write(report)
+
+    def _snapshot(self) -> Optional[tracemalloc.Snapshot]:
+        '''Live traced allocations, or None when not tracing'''
+        if not self.trace_allocations or not tracemalloc.is_tracing():
+            return None
+        return tracemalloc.take_snapshot()
+
+    def _allocations(self, before: Optional[tracemalloc.Snapshot]) -> Optional[Counter]:
+        '''Bytes still allocated per file:line that were not allocated at `before`'''
+        if before is None:
+            return None
+        after = self._snapshot()
+        if after is None:
+            return None
+
+        # Cheaper than Snapshot.compare_to(), which groups and sorts every
+        # trace into Statistic objects first. Both counters are built after
+        # the second snapshot, so they are not in it
+        new = Counter(after.traces)
+        new.subtract(before.traces)
+        sites = Counter()
+        for trace, count in new.items():
+            frame = trace.traceback[0]
+            if count > 0 and frame.filename != __file__ and frame.filename != tracemalloc.__file__:
+                sites[f'{frame.filename}:{frame.lineno}'] += trace.size * count
+        return sites
+
+    def _sample(self):
+        '''Sampler thread: fold the stacks of tracked (and pool) threads into their reports'''
+        own = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                reports = {id(report): report for report in self._reports.values()}
+            # Pool threads cannot be tied to a workflow, only to the one report running
+            only = next(iter(reports.values())) if len(reports) == 1 else None
+            names = {thread.ident: thread.name for thread in threading.enumerate()} if only else {}
+
+            for thread_id, frame in frames.items():
+                if thread_id == own:
+                    continue
+                tracked = self._threads.get(thread_id)
+                if tracked is not None:
+                    report, root = tracked
+                elif only is not None and thread_id in names and not _is_idle(frame):
+                    report, root = only, _THREAD_SUFFIX.sub('', names[thread_id])
+                else:
+                    continue
+                report.add_stack(f'{root};{_fold(frame)}')
+
+    def _write(self, report: _Report):
+        os.makedirs(self.output_dir, exist_ok=True)
+        if len(report.workflow_ids) == 1:
+            name = f'workflow-{report.workflow_ids[0]}'
+        else:
+            name = f'workflows-{report.started_at:%Y%m%dT%H%M%S}-{len(report.workflow_ids)}runs'
+        base = os.path.join(self.output_dir, name)
+
+        with report.lock:
+            with open(f'{base}.collapsed', 'w', encoding='utf-8') as f:
+                for stack, count in sorted(report.stacks.items()):
+                    f.write(f'{stack} {count}\n')
+
+            if report.stats:
+                combined = pstats.Stats()
+                for node, stats in report.stats.items():
+                    stats.dump_stats(f'{base}.{node}.pstats')
+                    combined.add(stats)
+                combined.dump_stats(f'{base}.pstats')
+
+            summary = self._summary(report)
+
+        with open(f'{base}.json', 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+        self.logger.info(f'Profile written: {base}.*', extra={'runs': len(report.workflow_ids)})
+
+    def _summary(self, report: _Report) -> Dict[str, Any]:
+        # Caller must hold report.lock
+        runs = len(report.workflow_ids)
+        samples = Counter()
+        for stack, count in report.stacks.items():
+            samples[stack.split(';', 1)[0]] += count
+
+        nodes = {}
+        for node, calls in report.node_calls.items():
+            nodes[node] = {
+                'calls': calls,
+                'total_seconds': round(report.node_seconds[node], 6),
+                'mean_seconds': round(report.node_seconds[node] / calls, 6),
+                'samples': samples.get(node, 0),
+                'top_functions': _top_functions(report.stats.get(node)),
+                'allocated_bytes': sum(report.allocated.get(node, {}).values()),
+                'top_allocation_sites': [
+                    {'site': site, 'bytes': size}
+                    for site, size in report.allocated.get(node, Counter()).most_common(TOP_ALLOCATION_SITES)
+                ]
+            }
+
+        return {
+            'workflow_ids': report.workflow_ids,
+            'runs': runs,
+            'mean_run_seconds': round(report.run_seconds / runs, 6) if runs else None,
+            'sample_interval_ms': self.interval * 1000,
+            'samples_by_root': dict(samples.most_common()),
+            'nodes': nodes
+        }
+
+
+def _fold(frame) -> str:
+    '''Frames from the outermost call to `frame`, joined with ";"'''
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'.replace(';', ':'))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def _is_idle(frame) -> bool:
+    return (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_LEAVES
+
+
+def _top_functions(stats: Optional[pstats.Stats]) -> List[Dict[str, Any]]:
+    '''Functions with the most cumulative time in a node'''
+    if stats is None:
+        return []
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:TOP_FUNCTIONS]
+    return [
+        {
+            'function': f'{func} ({os.path.basename(filename)}:{line})',
+            'calls': calls,
+            'tottime': round(tottime, 6),
+            'cumtime': round(cumtime, 6)
+        }
+        for (filename, line, func), (_, calls, tottime, cumtime, _) in rows
+    ]
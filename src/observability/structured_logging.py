@@ -0,0 +1,231 @@
+﻿'''
+Non-blocking structured logging
+
+Loggers from get_logger() hand records to a bounded in-memory queue; a
+background QueueListener formats them (JSON by default) and writes them to
+stdout. The request path only pays for a level check, an optional sampling
+decision and a put_nowait. When the queue is full the record is dropped
+and counted rather than waiting for a slow sink.
+
+Every record carries the workflow_id and node bound with log_context(),
+so lines from agents and MCP servers inside a node are attributable.
+
+Settings (read once, on first use):
+    LOG_LEVEL         minimum level (default INFO)
+    LOG_FORMAT        json or text (default json)
+    LOG_QUEUE_SIZE    records buffered before dropping (default 10000)
+    LOG_SAMPLE_RATES  per-level keep rates, e.g. DEBUG=0.05,INFO=1
+'''
+from typing import Dict, Any, Optional
+from contextvars import ContextVar
+import atexit
+import contextlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+from datetime import datetime, timezone
+
+
+ROOT_LOGGER = 'workflow_agent'
+
+# Chatty per-call DEBUG lines (e.g. 'Executing: ...') are sampled by default
+DEFAULT_SAMPLE_RATES = 'DEBUG=0.1'
+
+workflow_id_var: ContextVar[Optional[str]] = ContextVar('workflow_id', default=None)
+node_var: ContextVar[Optional[str]] = ContextVar('node', default=None)
+
+# Attributes every LogRecord has; anything else came in through `extra`
+_RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+_configure_lock = threading.Lock()
+_handler: Optional['NonBlockingQueueHandler'] = None
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    '''
+    QueueHandler that never waits: full queue means the record is dropped
+
+    Runs on the caller's thread, so it also samples records by level and
+    captures the workflow/node context before the record changes threads.
+    '''
+
+    def __init__(self, log_queue: queue.Queue, sample_rates: Optional[Dict[int, float]] = None):
+        super().__init__(log_queue)
+        self.sample_rates = sample_rates or {}
+        self.dropped = 0
+        self.sampled_out = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.sample_rates.get(record.levelno)
+        if rate is not None and rate < 1.0 and random.random() >= rate:
+            self.sampled_out += 1
+            return False
+        return super().filter(record)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Merge args now (they may be mutated later) but leave the
+        # formatting, timestamps and tracebacks to the listener thread
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if not hasattr(record, 'workflow_id'):
+            record.workflow_id = workflow_id_var.get()
+        if not hasattr(record, 'node'):
+            record.node = node_var.get()
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JSONFormatter(logging.Formatter):
+    '''One JSON object per line with context and any `extra` fields'''
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            'timestamp': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        if getattr(record, 'workflow_id', None):
+            entry['workflow_id'] = record.workflow_id
+        if getattr(record, 'node', None):
+            entry['node'] = record.node
+
+        for key, value in vars(record).items():
+            if key not in _RESERVED and key not in entry and key not in ('workflow_id', 'node'):
+                entry[key] = value
+
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    '''Human-readable lines for local runs (LOG_FORMAT=text)'''
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s [%(name)s]%(context)s %(message)s')
+
+    def format(self, record: logging.LogRecord) -> str:
+        context = [v for v in (getattr(record, 'workflow_id', None), getattr(record, 'node', None)) if v]
+        record.context = f' [{"/".join(context)}]' if context else ''
+        return super().format(record)
+
+
+def configure_logging(
+    level: Optional[str] = None,
+    fmt: Optional[str] = None,
+    queue_size: Optional[int] = None,
+    sample_rates: Optional[str] = None,
+    stream=None
+):
+    '''
+    (Re)configure the shared logging pipeline
+
+    Arguments override the LOG_* environment settings. Calling this again
+    replaces the previous handler after draining its queue.
+    '''
+    global _handler, _listener
+
+    level = (level or os.getenv('LOG_LEVEL', 'INFO')).upper()
+    fmt = (fmt or os.getenv('LOG_FORMAT', 'json')).lower()
+    queue_size = queue_size or int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+    sample_rates = sample_rates if sample_rates is not None else os.getenv('LOG_SAMPLE_RATES', DEFAULT_SAMPLE_RATES)
+
+    with _configure_lock:
+        _shutdown()
+
+        output = logging.StreamHandler(stream or sys.stdout)
+        output.setFormatter(JSONFormatter() if fmt == 'json' else TextFormatter())
+
+        log_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        _handler = NonBlockingQueueHandler(log_queue, _parse_sample_rates(sample_rates))
+        _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=False)
+        _listener.start()
+
+        root = logging.getLogger(ROOT_LOGGER)
+        root.handlers = [_handler]
+        root.setLevel(level)
+        root.propagate = False
+
+
+def get_logger(name: str) -> logging.Logger:
+    '''Logger under the shared pipeline (configured on first use)'''
+    if _handler is None:
+        with _configure_lock:
+            needs_setup = _handler is None
+        if needs_setup:
+            configure_logging()
+    return logging.getLogger(f'{ROOT_LOGGER}.{name}')
+
+
+@contextlib.contextmanager
+def log_context(workflow_id: Optional[str] = None, node: Optional[str] = None):
+    '''Attach workflow_id / node to every record logged inside the block'''
+    tokens = []
+    if workflow_id is not None:
+        tokens.append((workflow_id_var, workflow_id_var.set(workflow_id)))
+    if node is not None:
+        tokens.append((node_var, node_var.set(node)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def logging_stats() -> Dict[str, int]:
+    '''Records dropped on a full queue, sampled out, and currently queued'''
+    handler = _handler
+    if handler is None:
+        return {'dropped': 0, 'sampled_out': 0, 'queued': 0}
+    return {
+        'dropped': handler.dropped,
+        'sampled_out': handler.sampled_out,
+        'queued': handler.queue.qsize()
+    }
+
+
+def flush_logs():
+    '''Drain queued records to the sink (e.g. before exiting)'''
+    with _configure_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener.start()
+
+
+def _shutdown():
+    # Caller must hold _configure_lock
+    global _handler, _listener
+    if _listener is not None:
+        _listener.stop()
+    _handler = _listener = None
+
+
+def _parse_sample_rates(spec: str) -> Dict[int, float]:
+    rates = {}
+    for part in filter(None, (p.strip() for p in spec.split(','))):
+        name, _, value = part.partition('=')
+        level = logging.getLevelName(name.strip().upper())
+        if isinstance(level, int):
+            rates[level] = float(value)
+    return rates
+
+
+def _stop_at_exit():
+    with _configure_lock:
+        _shutdown()
+
+
+atexit.register(_stop_at_exit)
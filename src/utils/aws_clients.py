@@ -0,0 +1,150 @@
+﻿'''
+Process-wide registry of AWS clients
+
+Creating a boto3 client costs tens of milliseconds (endpoint and model
+loading) and each one owns a connection pool, so agents share them
+instead of building their own. Everything is created lazily on first use.
+
+Clients are thread-safe and shared by all threads. Resources (and the
+Tables built from them) are not, so those are cached per thread. Each
+thread's cache is dropped on its next use after override() or reset().
+'''
+from typing import Dict, Any, Optional
+from botocore.config import Config
+import boto3
+import os
+import threading
+
+
+_lock = threading.Lock()
+_session: Optional[boto3.session.Session] = None
+_clients: Dict[tuple, Any] = {}
+_local = threading.local()
+# Bumped by override() and reset(); per-thread caches from an older generation are stale
+_generation = 0
+# service name -> object returned instead of a real client/resource
+_overrides: Dict[str, Any] = {}
+
+
+def get_region() -> str:
+    '''AWS region used for all clients'''
+    return os.getenv('AWS_REGION', 'us-east-1')
+
+
+def get_config(service: Optional[str] = None) -> Config:
+    '''Shared botocore config: pool size, retry behaviour and timeouts'''
+    if service == 'bedrock-runtime':
+        # Retries and deadlines for model calls live in utils.llm_policy;
+        # the read timeout cuts off attempts the policy stopped waiting for
+        return Config(
+            max_pool_connections=int(os.getenv('AWS_MAX_POOL_CONNECTIONS', '50')),
+            retries={
+                'mode': 'standard',
+                'max_attempts': int(os.getenv('BEDROCK_SDK_MAX_ATTEMPTS', '1'))
+            },
+            connect_timeout=float(os.getenv('BEDROCK_CONNECT_TIMEOUT', '5')),
+            read_timeout=float(os.getenv('BEDROCK_READ_TIMEOUT', '60'))
+        )
+
+    return Config(
+        max_pool_connections=int(os.getenv('AWS_MAX_POOL_CONNECTIONS', '50')),
+        retries={
+            'mode': os.getenv('AWS_RETRY_MODE', 'adaptive'),
+            'max_attempts': int(os.getenv('AWS_MAX_ATTEMPTS', '5'))
+        }
+    )
+
+
+def get_client(service: str, region: Optional[str] = None, endpoint_url: Optional[str] = None):
+    '''
+    Get (or lazily create) the shared client for a service
+
+    `endpoint_url` points the client at a local stand-in (e.g. ElasticMQ).
+    '''
+    if service in _overrides:
+        return _overrides[service]
+
+    key = (service, region or get_region(), endpoint_url)
+
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _lock:
+        # Another thread may have created it while we waited
+        if key not in _clients:
+            _clients[key] = _get_session().client(
+                service, region_name=key[1], endpoint_url=endpoint_url, config=get_config(service)
+            )
+        return _clients[key]
+
+
+def get_resource(service: str, region: Optional[str] = None):
+    '''Get (or lazily create) this thread's resource for a service'''
+    if service in _overrides:
+        return _overrides[service]
+
+    key = (service, region or get_region())
+    resources = _thread_cache('resources')
+
+    if key not in resources:
+        # Session methods are not thread-safe, so creation is serialized
+        with _lock:
+            resources[key] = _get_session().resource(
+                service, region_name=key[1], config=get_config()
+            )
+    return resources[key]
+
+
+def get_table(table_name: str, region: Optional[str] = None):
+    '''Get (or lazily create) this thread's DynamoDB Table handle'''
+    key = (table_name, region or get_region())
+    tables = _thread_cache('tables')
+
+    if key not in tables:
+        tables[key] = get_resource('dynamodb', key[1]).Table(table_name)
+    return tables[key]
+
+
+def override(service: str, obj: Any):
+    '''
+    Serve `obj` for a service instead of a real client or resource
+
+    Used by benchmarks and local runs to plug in fakes (e.g. a stubbed
+    Bedrock client or an in-memory DynamoDB). Call reset() to undo.
+    '''
+    global _generation
+    with _lock:
+        _overrides[service] = obj
+        _clients.clear()
+        _generation += 1
+
+
+def reset():
+    '''Drop overrides, shared clients and every thread's resources (recreated on next use)'''
+    global _session, _generation
+    with _lock:
+        _session = None
+        _clients.clear()
+        _overrides.clear()
+        _generation += 1
+
+
+def _thread_cache(name: str) -> Dict[tuple, Any]:
+    '''This thread's cache `name`, emptied if override() or reset() ran since it was filled'''
+    if getattr(_local, 'generation', None) != _generation:
+        _local.__dict__.clear()
+        _local.generation = _generation
+    cache = getattr(_local, name, None)
+    if cache is None:
+        cache = {}
+        setattr(_local, name, cache)
+    return cache
+
+
+def _get_session() -> boto3.session.Session:
+    # Caller must hold _lock
+    global _session
+    if _session is None:
+        _session = boto3.session.Session()
+    return _session
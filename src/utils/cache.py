@@ -0,0 +1,131 @@
+﻿from typing import Dict, Any, Optional, Tuple
+from collections import OrderedDict
+import hashlib
+import json
+import re
+import threading
+import time
+from observability import metrics
+from utils import aws_clients
+
+
+class ClassificationCache:
+    '''
+    Two-tier cache for triage classifications
+
+    Tier 1 is an in-process LRU. Tier 2 is the shared `<project>-cache`
+    DynamoDB table (hash key `key`, TTL attribute `ttl`), so repeats are
+    also served across processes. The shared tier is best effort: any
+    DynamoDB error is counted and treated as a miss.
+    '''
+
+    def __init__(
+        self,
+        table_name: Optional[str] = None,
+        max_entries: int = 1024,
+        ttl_seconds: int = 86400
+    ):
+        self.table_name = table_name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: 'OrderedDict[str, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {
+            'local_hits': 0,
+            'shared_hits': 0,
+            'misses': 0,
+            'shared_errors': 0
+        }
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        '''Normalize input so trivially different repeats share a key'''
+        return re.sub(r'\s+', ' ', text).strip().lower()
+
+    def make_key(self, text: str, model_id: str, prompt_version: str) -> str:
+        '''Build the cache key from normalized text, model and prompt version'''
+        raw = f'{prompt_version}|{model_id}|{self.normalize(text)}'
+        return 'triage:' + hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        '''Look up a key in the local tier, then the shared tier'''
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > now:
+                self._entries.move_to_end(key)
+                self._stats['local_hits'] += 1
+                return dict(entry[0])
+            if entry:
+                del self._entries[key]
+
+        shared = self._get_shared(key, now)
+
+        with self._lock:
+            if shared is None:
+                self._stats['misses'] += 1
+                return None
+            self._stats['shared_hits'] += 1
+
+        # Never keep a shared entry locally past its own expiry
+        value, shared_expires_at = shared
+        self._put_local(key, value, min(now + self.ttl_seconds, shared_expires_at))
+        return dict(value)
+
+    def put(self, key: str, value: Dict[str, Any]):
+        '''Store a value in both tiers'''
+        expires_at = time.time() + self.ttl_seconds
+        self._put_local(key, value, expires_at)
+
+        if self.table_name is None:
+            return
+
+        try:
+            with metrics.time_dynamodb_write(self.table_name):
+                aws_clients.get_table(self.table_name).put_item(
+                    Item={
+                        'key': key,
+                        'value': json.dumps(value),
+                        'ttl': int(expires_at)
+                    }
+                )
+        except Exception:
+            with self._lock:
+                self._stats['shared_errors'] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        '''Hit/miss counters (every hit is one model call saved)'''
+        with self._lock:
+            stats = dict(self._stats)
+            stats['local_entries'] = len(self._entries)
+
+        lookups = stats['local_hits'] + stats['shared_hits'] + stats['misses']
+        stats['llm_calls_saved'] = stats['local_hits'] + stats['shared_hits']
+        stats['hit_rate'] = stats['llm_calls_saved'] / lookups if lookups else 0.0
+        return stats
+
+    def _put_local(self, key: str, value: Dict[str, Any], expires_at: float):
+        with self._lock:
+            self._entries[key] = (dict(value), expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _get_shared(self, key: str, now: float) -> Optional[Tuple[Dict[str, Any], float]]:
+        '''(value, expiry time) of a live shared entry, or None'''
+        if self.table_name is None:
+            return None
+
+        try:
+            item = aws_clients.get_table(self.table_name).get_item(Key={'key': key}).get('Item')
+        except Exception:
+            with self._lock:
+                self._stats['shared_errors'] += 1
+            return None
+
+        # DynamoDB deletes expired items lazily, so check the TTL ourselves
+        if not item or int(item.get('ttl', 0)) <= now:
+            return None
+
+        return json.loads(item['value']), float(item['ttl'])
@@ -0,0 +1,144 @@
+﻿from typing import Dict, List, Optional, Tuple
+from collections import deque, defaultdict
+import hashlib
+import random
+import re
+import threading
+import time
+
+
+# Mersenne prime for the universal hash family used by MinHash
+_PRIME = (1 << 61) - 1
+
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+
+
+class NearDuplicateIndex:
+    '''
+    MinHash/LSH index of recent texts for near-duplicate lookup
+
+    Texts are shingled into word bigrams and summarized by a MinHash
+    signature of `num_perm` values. Signatures are split into `bands`
+    LSH buckets, so a lookup only compares against texts that share a
+    bucket. Candidates are kept when their estimated Jaccard similarity
+    is at least `threshold`. Entries older than `window_seconds` are
+    evicted, which keeps both memory and lookup cost bounded by
+    recent traffic rather than total history.
+    '''
+
+    def __init__(
+        self,
+        threshold: float = 0.6,
+        window_seconds: float = 3600,
+        num_perm: int = 60,
+        bands: int = 20,
+        max_words: int = 200,
+        seed: int = 1
+    ):
+        if num_perm % bands:
+            raise ValueError('num_perm must be a multiple of bands')
+
+        self.threshold = threshold
+        self.window_seconds = window_seconds
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.max_words = max_words
+
+        rng = random.Random(seed)
+        self._perms = [
+            (rng.randrange(1, _PRIME), rng.randrange(0, _PRIME))
+            for _ in range(num_perm)
+        ]
+        self._buckets: Dict[Tuple, set] = defaultdict(set)
+        self._signatures: Dict[str, Tuple[int, ...]] = {}
+        self._added_at: Dict[str, float] = {}
+        # (added_at, key) in insertion order, for window eviction
+        self._entries: deque = deque()
+        self._lock = threading.Lock()
+
+    def add(self, key: str, text: str, now: Optional[float] = None):
+        '''Index a text under a key (e.g. a ticket ID)'''
+        now = time.time() if now is None else now
+        signature = self.signature(text)
+
+        with self._lock:
+            self._evict(now)
+            if key in self._signatures:
+                self._remove(key)
+            self._signatures[key] = signature
+            self._added_at[key] = now
+            self._entries.append((now, key))
+            for band in self._band_keys(signature):
+                self._buckets[band].add(key)
+
+    def find(self, text: str, now: Optional[float] = None) -> Optional[Tuple[str, float]]:
+        '''Most similar indexed key within the window as (key, similarity), or None'''
+        now = time.time() if now is None else now
+        signature = self.signature(text)
+
+        with self._lock:
+            self._evict(now)
+
+            candidates = set()
+            for band in self._band_keys(signature):
+                candidates.update(self._buckets.get(band, ()))
+
+            best = None
+            for key in candidates:
+                similarity = self._similarity(signature, self._signatures[key])
+                if similarity >= self.threshold and (best is None or similarity > best[1]):
+                    best = (key, similarity)
+
+        return best
+
+    def signature(self, text: str) -> Tuple[int, ...]:
+        '''MinHash signature of a text's word-bigram shingles'''
+        hashes = [_hash64(s) for s in _shingles(text, self.max_words)]
+        return tuple(
+            min((a * h + b) % _PRIME for h in hashes)
+            for a, b in self._perms
+        )
+
+    def __len__(self) -> int:
+        return len(self._signatures)
+
+    def _band_keys(self, signature: Tuple[int, ...]) -> List[Tuple]:
+        return [
+            (band, signature[band * self.rows:(band + 1) * self.rows])
+            for band in range(self.bands)
+        ]
+
+    def _similarity(self, a: Tuple[int, ...], b: Tuple[int, ...]) -> float:
+        return sum(x == y for x, y in zip(a, b)) / self.num_perm
+
+    def _evict(self, now: float):
+        # Caller must hold _lock
+        cutoff = now - self.window_seconds
+        while self._entries and self._entries[0][0] < cutoff:
+            added_at, key = self._entries.popleft()
+            # Skip stale entries for keys that were re-added later
+            if self._added_at.get(key) == added_at:
+                self._remove(key)
+
+    def _remove(self, key: str):
+        # Caller must hold _lock
+        signature = self._signatures.pop(key)
+        del self._added_at[key]
+        for band in self._band_keys(signature):
+            bucket = self._buckets.get(band)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band]
+
+
+def _shingles(text: str, max_words: int) -> set:
+    words = TOKEN_PATTERN.findall(text.lower())[:max_words]
+    if len(words) < 2:
+        return set(words) or {''}
+    return {f'{a} {b}' for a, b in zip(words, words[1:])}
+
+
+def _hash64(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
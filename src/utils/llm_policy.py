@@ -0,0 +1,342 @@
+﻿'''
+Deadline, retry, hedging and circuit-breaking policy for model calls
+
+A Bedrock brownout shows up as throttling, 5xx errors or calls that
+simply take too long. LLMCallPolicy.call() bounds all three:
+
+- every call has a deadline. With hedging on, attempts run on a shared,
+  bounded pool so the caller stops waiting when it passes (the abandoned
+  attempt is cut off later by the client's read timeout); once the pool
+  is busy, calls fail fast instead of queueing behind abandoned attempts.
+  With hedging off, attempts run on the caller's thread and the client's
+  read timeout (BEDROCK_READ_TIMEOUT) bounds each of them
+- throttling and transient errors are retried with full-jitter
+  exponential backoff, within the deadline
+- optionally, when an attempt is slower than the recent p95, a second
+  identical request is sent and whichever answers first wins
+- a per-model circuit breaker opens after consecutive failures and
+  rejects calls immediately until a probe succeeds
+
+Callers catch LLMUnavailableError to degrade (e.g. a default
+classification) instead of failing the workflow.
+'''
+from typing import Any, Callable, Dict, Optional, TypeVar
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+import os
+import random
+import threading
+import time
+from botocore.exceptions import (
+    ClientError, ConnectTimeoutError, EndpointConnectionError, ReadTimeoutError
+)
+from observability import metrics
+
+
+T = TypeVar('T')
+
+# Bedrock error codes worth another attempt
+RETRYABLE_CODES = {
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'ServiceUnavailableException',
+    'InternalServerException',
+    'ModelNotReadyException',
+    'ModelTimeoutException',
+}
+
+RETRYABLE_EXCEPTIONS = (ConnectTimeoutError, EndpointConnectionError, ReadTimeoutError)
+
+# Successful latencies kept per model for the hedging threshold
+LATENCY_WINDOW = 500
+MIN_HEDGE_SAMPLES = 20
+
+
+class LLMUnavailableError(RuntimeError):
+    '''The model could not answer in time (retries exhausted, deadline, open circuit)'''
+
+
+class LLMDeadlineExceeded(LLMUnavailableError):
+    pass
+
+
+class CircuitOpenError(LLMUnavailableError):
+    pass
+
+
+class PolicySaturated(LLMUnavailableError):
+    '''Every pool thread is busy, e.g. with attempts abandoned at their deadline'''
+
+
+def is_retryable(error: Exception) -> bool:
+    '''Throttling, transient server errors and connection timeouts'''
+    if isinstance(error, RETRYABLE_EXCEPTIONS):
+        return True
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code') in RETRYABLE_CODES
+    return False
+
+
+class CircuitBreaker:
+    '''
+    Opens after `failure_threshold` consecutive failures
+
+    While open, calls are rejected for `reset_seconds`; then a single
+    probe is let through (half-open). Its success closes the circuit,
+    its failure opens it again.
+    '''
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = 'closed'
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self._opened_at >= self.reset_seconds:
+                self.state = 'half_open'
+                self._probing = False
+            if self.state == 'half_open' and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == 'half_open' or self._failures >= self.failure_threshold:
+                self.state = 'open'
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+    def release(self):
+        '''Let another probe through after one that ended without an outcome'''
+        with self._lock:
+            self._probing = False
+
+
+class LLMCallPolicy:
+    '''Applies deadline, retry, hedging and circuit breaking to model calls'''
+
+    def __init__(
+        self,
+        deadline: float = 30.0,
+        max_attempts: int = 4,
+        base_backoff: float = 0.25,
+        max_backoff: float = 4.0,
+        hedge: bool = False,
+        hedge_min_delay: float = 0.5,
+        failure_threshold: int = 5,
+        reset_seconds: float = 30.0,
+        max_threads: int = 64
+    ):
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.max_threads = max_threads
+        self._pool = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix='llm-call')
+        # Attempts submitted to the pool and not finished yet, abandoned ones included
+        self._outstanding = 0
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._latencies: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+        self._stats = Counter()
+
+    @classmethod
+    def from_env(cls) -> 'LLMCallPolicy':
+        return cls(
+            deadline=float(os.getenv('LLM_DEADLINE_SECONDS', '30')),
+            max_attempts=int(os.getenv('LLM_MAX_ATTEMPTS', '4')),
+            base_backoff=float(os.getenv('LLM_BACKOFF_BASE', '0.25')),
+            max_backoff=float(os.getenv('LLM_BACKOFF_MAX', '4')),
+            hedge=os.getenv('LLM_HEDGING_ENABLED', 'false').lower() == 'true',
+            hedge_min_delay=float(os.getenv('LLM_HEDGE_MIN_DELAY', '0.5')),
+            failure_threshold=int(os.getenv('LLM_BREAKER_FAILURES', '5')),
+            reset_seconds=float(os.getenv('LLM_BREAKER_RESET_SECONDS', '30')),
+            # A primary attempt and a hedge for every concurrent workflow
+            max_threads=int(os.getenv('LLM_POLICY_THREADS') or 2 * int(os.getenv('WORKFLOW_MAX_CONCURRENCY', '8')))
+        )
+
+    def call(self, key: str, fn: Callable[[], T], deadline: Optional[float] = None) -> T:
+        '''
+        Run fn() (one model request) under the policy
+
+        `key` identifies the model, which has its own breaker and latency
+        history. Non-retryable errors (e.g. validation) propagate as-is;
+        the model did answer, so for the breaker they count as successes.
+        '''
+        breaker = self._breaker(key)
+        if not breaker.allow():
+            self._count(key, 'rejected')
+            raise CircuitOpenError(f'Circuit open for {key}')
+
+        expires = time.monotonic() + (deadline or self.deadline)
+        attempt = 0
+
+        while True:
+            attempt += 1
+            start = time.monotonic()
+            # Every attempt ends in record_success or record_failure; anything
+            # else (e.g. KeyboardInterrupt) must not keep a half-open probe
+            settled = False
+            try:
+                result = self._attempt(key, fn, expires)
+            except PolicySaturated:
+                # Nothing was sent, so nothing to tell the breaker
+                raise
+            except LLMDeadlineExceeded:
+                breaker.record_failure()
+                settled = True
+                self._count(key, 'deadline_exceeded')
+                raise
+            except Exception as e:
+                if not is_retryable(e):
+                    breaker.record_success()
+                    settled = True
+                    raise
+                breaker.record_failure()
+                settled = True
+                self._count(key, 'retryable_error')
+
+                backoff = random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** (attempt - 1)))
+                if attempt >= self.max_attempts or time.monotonic() + backoff >= expires:
+                    raise LLMUnavailableError(f'{key} unavailable after {attempt} attempts: {e}') from e
+                if not breaker.allow():
+                    self._count(key, 'rejected')
+                    raise CircuitOpenError(f'Circuit open for {key}') from e
+
+                self._count(key, 'retries')
+                time.sleep(backoff)
+                continue
+            else:
+                breaker.record_success()
+                settled = True
+                self._record_latency(key, time.monotonic() - start)
+                return result
+            finally:
+                if not settled:
+                    breaker.release()
+
+    def stats(self) -> Dict[str, Any]:
+        '''Event counters plus breaker state and hedge threshold per model'''
+        with self._lock:
+            stats = {'events': dict(self._stats), 'outstanding_attempts': self._outstanding}
+            keys = list(self._breakers)
+        stats['models'] = {
+            key: {'breaker': self._breakers[key].state, 'hedge_delay': self._hedge_delay(key)}
+            for key in keys
+        }
+        return stats
+
+    def _attempt(self, key: str, fn: Callable[[], T], expires: float) -> T:
+        '''One attempt (plus a hedge if it is slow), bounded by the deadline'''
+        if not self.hedge:
+            # Nothing to race, so no thread hop; the read timeout bounds it
+            return fn()
+
+        primary = self._submit(fn)
+        if primary is None:
+            self._count(key, 'saturated')
+            raise PolicySaturated(f'{self.max_threads} model calls already outstanding')
+        futures = [primary]
+
+        hedge_delay = self._hedge_delay(key)
+        if hedge_delay is not None:
+            done, _ = wait(futures, timeout=max(0.0, min(hedge_delay, expires - time.monotonic())))
+            if not done and time.monotonic() < expires:
+                hedge = self._submit(fn)
+                self._count(key, 'hedges' if hedge is not None else 'hedges_skipped')
+                if hedge is not None:
+                    futures.append(hedge)
+
+        pending = set(futures)
+        error = None
+        while pending:
+            remaining = expires - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is not primary:
+                        self._count(key, 'hedge_wins')
+                    return future.result()
+                error = error or future.exception()
+
+        if error is not None and not pending:
+            raise error
+        raise LLMDeadlineExceeded(f'{key} did not answer within the deadline')
+
+    def _submit(self, fn: Callable[[], T]) -> Optional[Future]:
+        '''Run fn on the pool, or return None when every thread is taken'''
+        with self._lock:
+            if self._outstanding >= self.max_threads:
+                return None
+            self._outstanding += 1
+        future = self._pool.submit(fn)
+        future.add_done_callback(self._finished)
+        return future
+
+    def _finished(self, future: Future):
+        with self._lock:
+            self._outstanding -= 1
+
+    def _hedge_delay(self, key: str) -> Optional[float]:
+        '''Recent p95 latency (at least hedge_min_delay), or None without enough data'''
+        with self._lock:
+            samples = sorted(self._latencies.get(key, ()))
+        if len(samples) < MIN_HEDGE_SAMPLES:
+            return None
+        return max(self.hedge_min_delay, samples[int(len(samples) * 0.95)])
+
+    def _breaker(self, key: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = self._breakers[key] = CircuitBreaker(self.failure_threshold, self.reset_seconds)
+            return breaker
+
+    def _record_latency(self, key: str, seconds: float):
+        with self._lock:
+            samples = self._latencies.get(key)
+            if samples is None:
+                samples = self._latencies[key] = deque(maxlen=LATENCY_WINDOW)
+            samples.append(seconds)
+
+    def _count(self, key: str, event: str):
+        with self._lock:
+            self._stats[event] += 1
+        metrics.count_llm_event(key, event)
+
+
+_policy: Optional[LLMCallPolicy] = None
+_policy_lock = threading.Lock()
+
+
+def get_llm_policy() -> Optional[LLMCallPolicy]:
+    '''Process-wide policy (shared breakers and latency history); None if LLM_POLICY_ENABLED=false'''
+    global _policy
+    if os.getenv('LLM_POLICY_ENABLED', 'true').lower() != 'true':
+        return None
+    if _policy is None:
+        with _policy_lock:
+            if _policy is None:
+                _policy = LLMCallPolicy.from_env()
+    return _policy
@@ -0,0 +1,153 @@
+﻿'''
+Client-side token buckets for the Bedrock account quotas
+
+Bedrock enforces requests-per-second and tokens-per-minute quotas per
+account and model. Going over them just earns ThrottlingExceptions,
+which cost a round trip and a backoff each. A shared limiter keeps this
+process under its share instead: every BaseAgent acquires one request
+and the call's estimated tokens before each attempt it sends, retries
+and hedges included. Once the response reports its real usage, that
+attempt's estimate is settled; failed attempts stay charged at theirs.
+'''
+from typing import Optional
+import math
+import os
+import threading
+import time
+from observability import metrics
+from utils.llm_policy import LLMUnavailableError
+
+
+class RateLimitTimeout(LLMUnavailableError):
+    '''Waited longer than allowed for rate-limit capacity'''
+
+
+class TokenBucket:
+    '''
+    Refills `rate` units per second up to `capacity`
+
+    The balance may go negative through debit() (usage above the
+    estimate). Later acquisitions wait until it has refilled.
+    '''
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, amount: float) -> float:
+        '''Take `amount` and return 0.0, or return the seconds until it would fit'''
+        # Requests larger than the bucket would never fit; let them drain it instead
+        amount = min(amount, self.capacity)
+        with self._lock:
+            self._refill()
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return 0.0
+            return (amount - self._tokens) / self.rate
+
+    def debit(self, amount: float):
+        '''Adjust the balance without waiting (negative amounts refund)'''
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens - amount)
+
+    def available(self) -> float:
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+    def _refill(self):
+        # Caller must hold _lock
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class ModelRateLimiter:
+    '''
+    Request and token buckets shared by all model calls in the process
+
+    Either limit may be None (unlimited). acquire() blocks until both
+    buckets have room, or raises RateLimitTimeout after `max_wait`
+    seconds.
+    '''
+
+    def __init__(
+        self,
+        requests_per_second: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        max_wait: float = 30.0
+    ):
+        self.requests = TokenBucket(requests_per_second, max(1.0, requests_per_second)) \
+            if requests_per_second else None
+        # A minute's quota may be spent in a burst, as Bedrock allows
+        self.tokens = TokenBucket(tokens_per_minute / 60.0, tokens_per_minute) \
+            if tokens_per_minute else None
+        self.max_wait = max_wait
+
+    @classmethod
+    def from_env(cls) -> Optional['ModelRateLimiter']:
+        '''Limiter from BEDROCK_MAX_RPS / BEDROCK_MAX_TOKENS_PER_MINUTE (None when neither is set)'''
+        rps = os.getenv('BEDROCK_MAX_RPS')
+        tpm = os.getenv('BEDROCK_MAX_TOKENS_PER_MINUTE')
+        if not rps and not tpm:
+            return None
+        return cls(
+            requests_per_second=float(rps) if rps else None,
+            tokens_per_minute=float(tpm) if tpm else None,
+            max_wait=float(os.getenv('BEDROCK_RATE_LIMIT_MAX_WAIT', '30'))
+        )
+
+    def acquire(self, model_id: str, tokens: int):
+        '''Wait for one request slot and `tokens` tokens'''
+        start = time.monotonic()
+        waited = False
+
+        # Take the request slot first; tokens are usually the tighter limit
+        for bucket, amount in ((self.requests, 1), (self.tokens, tokens)):
+            if bucket is None:
+                continue
+            while True:
+                delay = bucket.try_acquire(amount)
+                if delay == 0.0:
+                    break
+                waited = True
+                if time.monotonic() - start + delay > self.max_wait:
+                    if bucket is self.tokens and self.requests is not None:
+                        self.requests.debit(-1)
+                    metrics.observe_rate_limit_wait(model_id, time.monotonic() - start)
+                    raise RateLimitTimeout(f'Rate limit: no capacity for {model_id} within {self.max_wait}s')
+                # Short sleeps so several waiters share capacity as it refills
+                time.sleep(min(delay, 0.05))
+
+        if waited:
+            metrics.observe_rate_limit_wait(model_id, time.monotonic() - start)
+
+    def settle(self, estimated: int, actual: Optional[int]):
+        '''Correct the token bucket once the real usage is known'''
+        if self.tokens is not None and actual is not None:
+            self.tokens.debit(actual - min(estimated, self.tokens.capacity))
+
+
+def estimate_tokens(text: str, max_tokens: int) -> int:
+    '''Worst-case tokens for a call: ~4 characters per prompt token plus the output cap'''
+    return math.ceil(len(text) / 4) + max_tokens
+
+
+_limiter: Optional[ModelRateLimiter] = None
+_limiter_loaded = False
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> Optional[ModelRateLimiter]:
+    '''Process-wide limiter, or None when no quota is configured'''
+    global _limiter, _limiter_loaded
+    if not _limiter_loaded:
+        with _limiter_lock:
+            if not _limiter_loaded:
+                _limiter = ModelRateLimiter.from_env()
+                _limiter_loaded = True
+    return _limiter
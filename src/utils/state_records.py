@@ -0,0 +1,268 @@
+﻿'''
+Compact, versioned encoding for agent-state records
+
+DynamoDB bills writes per KB and its latency grows with item size, so
+records no longer carry `json.dumps(state)` as a string next to a
+redundant `updated_at`. In the compact format `state` is a binary
+attribute:
+
+    byte 0     format version (FORMAT_VERSION)
+    byte 1     flags: COMPRESSED (zlib), DELTA
+    bytes 2..  JSON without whitespace, UTF-8, zlib-compressed when the
+               encoded state is at least `compress_min_bytes` long
+
+A DELTA record holds {"base": ..., "set": {...}, "unset": [...]}: only
+the fields that changed since the record for the same key (agent +
+workflow) whose timestamp is `base`, so a workflow checkpointed after
+every node writes its input once instead of once per node. Deltas are
+only taken against records whose write was acknowledged (see
+StateRecordCodec.acknowledge); the first record for a key in a process
+is full, and so is every `max_chain`-th one, which bounds how many
+records a reader folds.
+
+decode_state() reads both the compact format and the JSON strings
+written before it; rebuild_state() folds a workflow's records back into
+its full state. STATE_RECORD_FORMAT=json keeps writing the old format
+(e.g. while older readers are still deployed).
+
+Settings (read once, by get_codec):
+    STATE_RECORD_FORMAT        compact or json (default compact)
+    STATE_COMPRESS_MIN_BYTES   compress states at least this long (default 1024)
+    STATE_DELTA_WRITES         write deltas after the first record (default true)
+    STATE_DELTA_MAX_CHAIN      deltas between full records (default 20)
+'''
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from collections import OrderedDict
+from datetime import datetime
+import json
+import os
+import struct
+import threading
+import zlib
+
+
+FORMAT_VERSION = 1
+
+COMPRESSED = 0x01
+DELTA = 0x02
+
+_HEADER = struct.Struct('>BB')
+
+# Keys whose last written fields are remembered, per codec
+MAX_TRACKED_KEYS = 10000
+
+
+class StateRecordError(ValueError):
+    '''A state attribute that is neither a known compact version nor JSON'''
+
+
+def encode_state(
+    state: Dict[str, Any],
+    removed: Optional[List[str]] = None,
+    compress_min_bytes: int = 1024,
+    base: Any = None
+) -> bytes:
+    '''Compact encoding of a full state, or of a delta on record `base` when `removed` is given'''
+    flags = 0
+    payload = state
+    if removed is not None:
+        flags |= DELTA
+        payload = {'base': base, 'set': state, 'unset': removed}
+
+    body = json.dumps(payload, separators=(',', ':'), ensure_ascii=False, default=str).encode('utf-8')
+    if len(body) >= compress_min_bytes:
+        compressed = zlib.compress(body)
+        # Small or already dense states can grow
+        if len(compressed) < len(body):
+            flags |= COMPRESSED
+            body = compressed
+    return _HEADER.pack(FORMAT_VERSION, flags) + body
+
+
+def decode_state(value: Any) -> Tuple[Dict[str, Any], Optional[List[str]]]:
+    '''
+    (fields, removed) from a record's state attribute
+
+    `removed` is None for a full state and a list of keys for a delta.
+    Accepts compact bytes (or boto3's Binary wrapper) and JSON strings.
+    '''
+    fields, removed, _ = decode_record(value)
+    return fields, removed
+
+
+def decode_record(value: Any) -> Tuple[Dict[str, Any], Optional[List[str]], Any]:
+    '''decode_state() plus the timestamp of the record a delta applies to'''
+    if isinstance(value, str):
+        return json.loads(value), None, None
+
+    data = bytes(getattr(value, 'value', value))
+    if len(data) < _HEADER.size:
+        raise StateRecordError('State record too short')
+    version, flags = _HEADER.unpack_from(data)
+    if version != FORMAT_VERSION:
+        raise StateRecordError(f'Unsupported state record version {version}')
+
+    body = data[_HEADER.size:]
+    if flags & COMPRESSED:
+        try:
+            body = zlib.decompress(body)
+        except zlib.error as e:
+            raise StateRecordError(f'Corrupt state record: {str(e)}')
+    payload = json.loads(body.decode('utf-8'))
+    if flags & DELTA:
+        return payload['set'], payload['unset'], payload.get('base')
+    return payload, None, None
+
+
+def apply_record(state: Optional[Dict[str, Any]], fields: Dict[str, Any], removed: Optional[List[str]]) -> Dict[str, Any]:
+    '''State after one decoded record: a full record replaces it, a delta patches it'''
+    if removed is None or state is None:
+        return dict(fields)
+    state.update(fields)
+    for key in removed:
+        state.pop(key, None)
+    return state
+
+
+def rebuild_state(items: Iterable[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    '''
+    Fold one workflow's records (oldest first) into its latest full state
+
+    A delta is applied to the state as of its base record, so records
+    interleaved from several writers of the same workflow still fold
+    correctly. A delta whose base is missing is applied to the state so far.
+    '''
+    state = None
+    states: Dict[int, Dict[str, Any]] = {}
+    for item in items:
+        fields, removed, base = decode_record(item['state'])
+        if removed is not None and base is not None and int(base) in states:
+            state = dict(states[int(base)])
+        elif state is not None:
+            state = dict(state)
+        state = apply_record(state, fields, removed)
+        states[int(item['timestamp'])] = state
+    return state
+
+
+class StateRecordCodec:
+    '''
+    Builds the state attributes of a record, full or delta
+
+    Remembers, per key, the fields of the last record whose write was
+    acknowledged (as encoded JSON, so later mutation of the caller's
+    dicts cannot hide a change). Deltas are only taken against that
+    record: while a write is unacknowledged, or after one failed
+    (forget), the next record is full. Writers must call acknowledge()
+    once a record is durable.
+    '''
+
+    def __init__(
+        self,
+        compact: bool = True,
+        compress_min_bytes: int = 1024,
+        delta: bool = True,
+        max_chain: int = 20
+    ):
+        self.compact = compact
+        self.compress_min_bytes = compress_min_bytes
+        self.delta = delta and compact
+        self.max_chain = max_chain
+        # key -> (deltas since the last full record, {field: encoded value}, timestamp)
+        self._last: OrderedDict = OrderedDict()
+        # key -> the same for the record written last, until acknowledged
+        self._unacknowledged: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> 'StateRecordCodec':
+        return cls(
+            compact=os.getenv('STATE_RECORD_FORMAT', 'compact').lower() != 'json',
+            compress_min_bytes=int(os.getenv('STATE_COMPRESS_MIN_BYTES', '1024')),
+            delta=os.getenv('STATE_DELTA_WRITES', 'true').lower() == 'true',
+            max_chain=int(os.getenv('STATE_DELTA_MAX_CHAIN', '20'))
+        )
+
+    def attributes(
+        self,
+        key: str,
+        state: Dict[str, Any],
+        timestamp: Any = None,
+        changed: Optional[List[str]] = None
+    ) -> Dict[str, Any]:
+        '''
+        Record attributes holding `state`, to be written with sort key `timestamp`
+
+        `changed` names the fields that changed since the previous record
+        for `key`. Without it they are found by comparing with the fields
+        last written. Pass it when records for one key can be written
+        from diverging copies of the state (parallel graph branches).
+        A record with the same `timestamp` as the previous one replaces it
+        in the table, so it is written in full.
+        '''
+        if not self.compact:
+            return {'state': json.dumps(state), 'updated_at': datetime.now().isoformat()}
+        if not self.delta:
+            return {'state': encode_state(state, compress_min_bytes=self.compress_min_bytes)}
+
+        # Only needed to find the changes ourselves
+        encoded = {} if changed is not None else {
+            field: json.dumps(value, sort_keys=True, default=str) for field, value in state.items()
+        }
+        with self._lock:
+            chain, last, last_timestamp = self._last.pop(key, (None, None, None))
+            full = (
+                last is None
+                or key in self._unacknowledged
+                or chain >= self.max_chain
+                or timestamp is None
+                or timestamp == last_timestamp
+            )
+            if not full:
+                self._last[key] = (chain, last, last_timestamp)
+                if changed is None:
+                    changed = [field for field, value in encoded.items() if last.get(field) != value]
+                    changed += [field for field in last if field not in encoded]
+            self._unacknowledged.pop(key, None)
+            self._unacknowledged[key] = (0 if full else chain + 1, encoded, timestamp)
+            # Writes that are never acknowledged must not pile up either
+            while len(self._unacknowledged) > MAX_TRACKED_KEYS:
+                self._unacknowledged.popitem(last=False)
+
+        if full:
+            return {'state': encode_state(state, compress_min_bytes=self.compress_min_bytes)}
+        fields = {field: state[field] for field in changed if field in state}
+        removed = [field for field in changed if field not in state]
+        return {'state': encode_state(fields, removed, self.compress_min_bytes, base=last_timestamp)}
+
+    def acknowledge(self, key: str, timestamp: Any):
+        '''The record for `key` written with sort key `timestamp` is durable'''
+        with self._lock:
+            pending = self._unacknowledged.get(key)
+            if pending is None or pending[2] != timestamp:
+                return
+            del self._unacknowledged[key]
+            self._last.pop(key, None)
+            self._last[key] = pending
+            while len(self._last) > MAX_TRACKED_KEYS:
+                self._last.popitem(last=False)
+
+    def forget(self, key: str):
+        '''Drop what was last written for `key` (its next record is full)'''
+        with self._lock:
+            self._last.pop(key, None)
+            self._unacknowledged.pop(key, None)
+
+
+_codec: Optional[StateRecordCodec] = None
+_codec_lock = threading.Lock()
+
+
+def get_codec() -> StateRecordCodec:
+    '''Process-wide codec (shared delta bookkeeping)'''
+    global _codec
+    if _codec is None:
+        with _codec_lock:
+            if _codec is None:
+                _codec = StateRecordCodec.from_env()
+    return _codec
@@ -0,0 +1,210 @@
+﻿from typing import Callable, Dict, Any, List, Optional, Tuple
+import atexit
+import os
+import queue
+import threading
+import time
+from observability import metrics
+from observability.structured_logging import get_logger
+from utils import aws_clients
+
+
+logger = get_logger('state_writer')
+
+# Called with True once a record is written, False when writing it failed
+WriteCallback = Callable[[bool], None]
+
+
+class StateWriter:
+    '''
+    Write-behind buffer for agent-state records
+
+    Records are queued and written by a background thread with
+    `batch_writer`, whenever `batch_size` records are waiting or
+    `flush_interval` seconds have passed. The queue is bounded: when it
+    is full, submit() blocks for up to `put_timeout` seconds and then
+    writes the record itself, so records are slowed down, never dropped.
+    Records that fail even when retried one by one are counted and logged.
+    '''
+
+    def __init__(
+        self,
+        table_name: str,
+        max_buffer: int = 1000,
+        batch_size: int = 25,
+        flush_interval: float = 1.0,
+        put_timeout: float = 5.0
+    ):
+        self.table_name = table_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self._queue: 'queue.Queue[Tuple[Dict[str, Any], Optional[WriteCallback]]]' = queue.Queue(maxsize=max_buffer)
+        self._stop = threading.Event()
+        # Set first by close(); submits after it write inline. _submitting
+        # counts submits past that check, which close() waits out
+        self._closed = False
+        self._submitting = 0
+        self._submit_cond = threading.Condition()
+        self._stats_lock = threading.Lock()
+        self._stats = {'written': 0, 'failed': 0, 'batches': 0, 'overflow_writes': 0}
+        self._thread = threading.Thread(
+            target=self._run, name=f'state-writer-{table_name}', daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, item: Dict[str, Any], on_written: Optional[WriteCallback] = None):
+        '''
+        Queue a record for writing (blocks briefly when the buffer is full)
+
+        `on_written` is told whether the record was written, once that is
+        known. Inline writes raise on failure, like put_item.
+        '''
+        with self._submit_cond:
+            closed = self._closed
+            if not closed:
+                self._submitting += 1
+        if closed:
+            self._write_one(item, on_written, raise_errors=True)
+            return
+
+        try:
+            self._queue.put((item, on_written), timeout=self.put_timeout)
+        except queue.Full:
+            # Backpressure exhausted: write inline rather than lose the record
+            self._write_one(item, on_written, raise_errors=True)
+            self._count('overflow_writes')
+        finally:
+            with self._submit_cond:
+                self._submitting -= 1
+                self._submit_cond.notify_all()
+
+    def flush(self):
+        '''Block until every record submitted so far has been written'''
+        self._queue.join()
+
+    def close(self):
+        '''Flush remaining records and stop the background thread'''
+        with self._submit_cond:
+            if self._closed:
+                return
+            self._closed = True
+            # Records already on their way into the queue are drained too
+            self._submit_cond.wait_for(lambda: self._submitting == 0)
+        self.flush()
+        self._stop.set()
+        self._thread.join(timeout=self.flush_interval * 2)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['pending'] = self._queue.qsize()
+        return stats
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._next_batch()
+            if batch:
+                self._write_batch(batch)
+
+    def _next_batch(self) -> List[Tuple[Dict[str, Any], Optional[WriteCallback]]]:
+        '''Collect up to batch_size records, waiting at most flush_interval'''
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _write_batch(self, batch: List[Tuple[Dict[str, Any], Optional[WriteCallback]]]):
+        try:
+            # Same-key records in one batch are rejected by DynamoDB, so the
+            # latest one wins, exactly like consecutive put_item calls
+            with metrics.time_dynamodb_write(self.table_name, 'batch_write'):
+                with aws_clients.get_table(self.table_name).batch_writer(
+                    overwrite_by_pkeys=['workflow_id', 'timestamp']
+                ) as writer:
+                    for item, _ in batch:
+                        writer.put_item(Item=item)
+            self._count('written', len(batch))
+            self._count('batches')
+            for _, on_written in batch:
+                _notify(on_written, True)
+        except Exception as e:
+            logger.warning(f'Batched state write failed, retrying individually: {str(e)}')
+            for item, on_written in batch:
+                self._write_one(item, on_written)
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    def _write_one(self, item: Dict[str, Any], on_written: Optional[WriteCallback], raise_errors: bool = False):
+        try:
+            self._write_sync(item)
+        except Exception as e:
+            self._count('failed')
+            _notify(on_written, False)
+            if raise_errors:
+                raise
+            logger.error(f'State write failed for workflow {item.get("workflow_id")}: {str(e)}')
+            return
+        _notify(on_written, True)
+
+    def _write_sync(self, item: Dict[str, Any]):
+        with metrics.time_dynamodb_write(self.table_name):
+            aws_clients.get_table(self.table_name).put_item(Item=item)
+        self._count('written')
+
+    def _count(self, name: str, amount: int = 1):
+        with self._stats_lock:
+            self._stats[name] += amount
+
+
+def _notify(on_written: Optional[WriteCallback], written: bool):
+    if on_written is None:
+        return
+    try:
+        on_written(written)
+    except Exception as e:
+        logger.warning(f'State write callback failed: {str(e)}')
+
+
+_writers: Dict[str, StateWriter] = {}
+_writers_lock = threading.Lock()
+
+
+def get_state_writer(table_name: str) -> StateWriter:
+    '''Process-wide writer for a table (created on first use)'''
+    writer = _writers.get(table_name)
+    if writer is not None:
+        return writer
+
+    with _writers_lock:
+        if table_name not in _writers:
+            _writers[table_name] = StateWriter(
+                table_name,
+                max_buffer=int(os.getenv('STATE_WRITE_BUFFER', '1000')),
+                batch_size=int(os.getenv('STATE_WRITE_BATCH_SIZE', '25')),
+                flush_interval=float(os.getenv('STATE_WRITE_FLUSH_INTERVAL', '1.0'))
+            )
+        return _writers[table_name]
+
+
+def flush_all():
+    '''Flush every writer (e.g. before reading back what was written)'''
+    for writer in list(_writers.values()):
+        writer.flush()
+
+
+@atexit.register
+def close_all():
+    '''Flush and stop every writer; runs automatically at interpreter exit'''
+    for writer in list(_writers.values()):
+        writer.close()
@@ -0,0 +1,169 @@
+﻿from typing import Dict, Any, List, Optional
+from collections import OrderedDict
+import threading
+import time
+from boto3.dynamodb.conditions import Key
+from observability import metrics
+from utils import aws_clients, state_records
+from utils.state_writer import get_state_writer
+
+
+# Marks checkpoint records among the other agent-state records of a workflow
+CHECKPOINT_AGENT = 'orchestrator-checkpoint'
+
+# Workflows whose last checkpoint timestamp is remembered. Abandoned
+# workflows never reach forget(), so past this the oldest are dropped
+MAX_TRACKED_WORKFLOWS = 10000
+
+
+class CheckpointStore:
+    '''
+    Per-node workflow checkpoints in the agent-state table
+
+    Each checkpointed node writes the full WorkflowState under the
+    workflow's ID with a millisecond timestamp, so checkpoints sort after
+    one another (and after the second-resolution records of save_state).
+    Writes are synchronous by default: a node only counts as done once
+    its checkpoint is durable. With sync=False the checkpoint goes
+    through the write-behind StateWriter instead, for nodes that are
+    cheap and safe to run again if it is lost.
+
+    Nodes on parallel branches each see only their own input, so every
+    checkpoint also lists the keys its node wrote. restore() replays
+    those keys in order to rebuild a state that includes every branch.
+
+    In the compact record format (see utils.state_records) a checkpoint
+    after the first holds only those keys and completed_nodes, not the
+    whole state again.
+    '''
+
+    def __init__(self, table_name: str):
+        self.table_name = table_name
+        self._last_ts: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def save(
+        self,
+        workflow_id: str,
+        node: str,
+        state: Dict[str, Any],
+        updated: Optional[List[str]] = None,
+        sync: bool = True
+    ):
+        '''Record that `node` completed with `state`, having written the keys in `updated`'''
+        item = {
+            'workflow_id': workflow_id,
+            'timestamp': self._next_timestamp(workflow_id),
+            'agent': CHECKPOINT_AGENT,
+            'node': node
+        }
+        codec = state_records.get_codec()
+        key = f'{CHECKPOINT_AGENT}:{workflow_id}'
+        if updated is None:
+            # Without the written keys restore() takes the whole record
+            codec.forget(key)
+            item.update(codec.attributes(key, state, timestamp=item['timestamp']))
+        else:
+            item['updated'] = updated
+            item.update(codec.attributes(
+                key, state, timestamp=item['timestamp'], changed=list(updated) + ['completed_nodes']
+            ))
+
+        def written(ok: bool):
+            # The next checkpoint cannot be a delta on one that was lost
+            if ok:
+                codec.acknowledge(key, item['timestamp'])
+            else:
+                codec.forget(key)
+
+        if not sync:
+            get_state_writer(self.table_name).submit(item, on_written=written)
+            return
+        try:
+            with metrics.time_dynamodb_write(self.table_name, 'checkpoint'):
+                aws_clients.get_table(self.table_name).put_item(Item=item)
+        except Exception:
+            written(False)
+            raise
+        written(True)
+
+    def latest(self, workflow_id: str) -> Optional[Dict[str, Any]]:
+        '''
+        Most recent checkpoint as {'node', 'timestamp', 'state'}, or None
+
+        When that checkpoint is a delta, 'state' is the one restore()
+        rebuilds from all of the workflow's checkpoints.
+        '''
+        query = {
+            'KeyConditionExpression': Key('workflow_id').eq(workflow_id),
+            'ScanIndexForward': False
+        }
+
+        while True:
+            page = aws_clients.get_table(self.table_name).query(**query)
+            for item in page.get('Items', []):
+                if item.get('agent') == CHECKPOINT_AGENT:
+                    state, removed = state_records.decode_state(item['state'])
+                    return {
+                        'node': item['node'],
+                        'timestamp': int(item['timestamp']),
+                        'state': state if removed is None else self.restore(workflow_id)
+                    }
+            if 'LastEvaluatedKey' not in page:
+                return None
+            query['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+    def restore(self, workflow_id: str) -> Optional[Dict[str, Any]]:
+        '''
+        State combining every checkpoint of a workflow, or None
+
+        Checkpoints are applied oldest first; each contributes only the
+        keys its node wrote (all keys for records without that list, the
+        keys it holds for deltas), and completed_nodes accumulates across
+        all of them.
+        '''
+        query = {
+            'KeyConditionExpression': Key('workflow_id').eq(workflow_id),
+            'ScanIndexForward': True
+        }
+
+        state = None
+        completed: List[str] = []
+        while True:
+            page = aws_clients.get_table(self.table_name).query(**query)
+            for item in page.get('Items', []):
+                if item.get('agent') != CHECKPOINT_AGENT:
+                    continue
+                saved, removed = state_records.decode_state(item['state'])
+                if state is None or 'updated' not in item:
+                    state = state_records.apply_record(state, saved, removed)
+                elif removed is not None:
+                    state_records.apply_record(state, saved, removed)
+                else:
+                    for key in item['updated']:
+                        state[key] = saved[key]
+                for node in saved.get('completed_nodes', []):
+                    if node not in completed:
+                        completed.append(node)
+            if 'LastEvaluatedKey' not in page:
+                break
+            query['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+        if state is not None:
+            state['completed_nodes'] = completed
+        return state
+
+    def forget(self, workflow_id: str):
+        '''Drop in-process bookkeeping for a finished or failed workflow'''
+        with self._lock:
+            self._last_ts.pop(workflow_id, None)
+        state_records.get_codec().forget(f'{CHECKPOINT_AGENT}:{workflow_id}')
+
+    def _next_timestamp(self, workflow_id: str) -> int:
+        # Two nodes can finish within the same millisecond; keep keys unique
+        with self._lock:
+            ts = max(int(time.time() * 1000), self._last_ts.pop(workflow_id, 0) + 1)
+            self._last_ts[workflow_id] = ts
+            while len(self._last_ts) > MAX_TRACKED_WORKFLOWS:
+                self._last_ts.popitem(last=False)
+            return ts
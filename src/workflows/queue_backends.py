@@ -0,0 +1,179 @@
+﻿from typing import Dict, Any, List, Optional
+from abc import ABC, abstractmethod
+from collections import deque
+import json
+import threading
+import time
+import uuid
+from observability.structured_logging import get_logger
+from utils import aws_clients
+
+
+# SQS limits receive/delete/change-visibility batches to 10 entries
+MAX_BATCH = 10
+
+logger = get_logger('queue')
+
+
+class QueueBackend(ABC):
+    '''
+    Minimal queue interface used by the workflow worker
+
+    Messages are dicts with 'message_id', 'receipt_handle' and 'body'
+    (the decoded JSON payload).
+    '''
+
+    @abstractmethod
+    def send(self, body: Dict[str, Any]) -> str:
+        '''Enqueue a JSON payload, returning its message ID'''
+        pass
+
+    @abstractmethod
+    def receive(self, max_messages: int = MAX_BATCH, wait_seconds: int = 20) -> List[Dict[str, Any]]:
+        '''Long-poll for up to max_messages messages'''
+        pass
+
+    @abstractmethod
+    def delete_batch(self, receipt_handles: List[str]):
+        '''Delete processed messages (any number; chunked as needed)'''
+        pass
+
+    @abstractmethod
+    def change_visibility_batch(self, receipt_handles: List[str], timeout: int):
+        '''Extend how long in-flight messages stay hidden from other consumers'''
+        pass
+
+
+class SQSQueue(QueueBackend):
+    '''Amazon SQS (or any SQS-compatible endpoint such as ElasticMQ)'''
+
+    def __init__(self, queue_url: str, endpoint_url: Optional[str] = None):
+        self.queue_url = queue_url
+        self.client = aws_clients.get_client('sqs', endpoint_url=endpoint_url)
+
+    def send(self, body: Dict[str, Any]) -> str:
+        response = self.client.send_message(
+            QueueUrl=self.queue_url, MessageBody=json.dumps(body)
+        )
+        return response['MessageId']
+
+    def receive(self, max_messages: int = MAX_BATCH, wait_seconds: int = 20) -> List[Dict[str, Any]]:
+        response = self.client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=min(max_messages, MAX_BATCH),
+            WaitTimeSeconds=wait_seconds
+        )
+        return [
+            {
+                'message_id': m['MessageId'],
+                'receipt_handle': m['ReceiptHandle'],
+                'body': _decode(m['Body'])
+            }
+            for m in response.get('Messages', [])
+        ]
+
+    def delete_batch(self, receipt_handles: List[str]):
+        for chunk in _chunks(receipt_handles):
+            response = self.client.delete_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[{'Id': str(i), 'ReceiptHandle': h} for i, h in enumerate(chunk)]
+            )
+            for failure in response.get('Failed', []):
+                logger.error(f'SQS delete failed: {failure.get("Message")}')
+
+    def change_visibility_batch(self, receipt_handles: List[str], timeout: int):
+        for chunk in _chunks(receipt_handles):
+            self.client.change_message_visibility_batch(
+                QueueUrl=self.queue_url,
+                Entries=[
+                    {'Id': str(i), 'ReceiptHandle': h, 'VisibilityTimeout': timeout}
+                    for i, h in enumerate(chunk)
+                ]
+            )
+
+
+class InMemoryQueue(QueueBackend):
+    '''
+    In-process queue with SQS-like visibility timeouts
+
+    For tests and local runs: a received message is hidden until it is
+    deleted or its visibility timeout lapses, after which it is delivered
+    again.
+    '''
+
+    def __init__(self, visibility_timeout: int = 300):
+        self.visibility_timeout = visibility_timeout
+        self._ready: deque = deque()
+        # receipt handle -> (message_id, body, visible_again_at)
+        self._in_flight: Dict[str, tuple] = {}
+        self._condition = threading.Condition()
+
+    def send(self, body: Dict[str, Any]) -> str:
+        message_id = str(uuid.uuid4())
+        with self._condition:
+            self._ready.append((message_id, body))
+            self._condition.notify()
+        return message_id
+
+    def receive(self, max_messages: int = MAX_BATCH, wait_seconds: int = 20) -> List[Dict[str, Any]]:
+        deadline = time.monotonic() + wait_seconds
+        with self._condition:
+            while True:
+                self._requeue_expired()
+                if self._ready:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self._condition.wait(timeout=min(remaining, 0.1))
+
+            messages = []
+            while self._ready and len(messages) < min(max_messages, MAX_BATCH):
+                message_id, body = self._ready.popleft()
+                receipt_handle = str(uuid.uuid4())
+                self._in_flight[receipt_handle] = (
+                    message_id, body, time.monotonic() + self.visibility_timeout
+                )
+                messages.append({
+                    'message_id': message_id,
+                    'receipt_handle': receipt_handle,
+                    'body': body
+                })
+            return messages
+
+    def delete_batch(self, receipt_handles: List[str]):
+        with self._condition:
+            for handle in receipt_handles:
+                self._in_flight.pop(handle, None)
+
+    def change_visibility_batch(self, receipt_handles: List[str], timeout: int):
+        with self._condition:
+            for handle in receipt_handles:
+                if handle in self._in_flight:
+                    message_id, body, _ = self._in_flight[handle]
+                    self._in_flight[handle] = (message_id, body, time.monotonic() + timeout)
+
+    def size(self) -> Dict[str, int]:
+        '''Messages waiting and messages in flight'''
+        with self._condition:
+            return {'ready': len(self._ready), 'in_flight': len(self._in_flight)}
+
+    def _requeue_expired(self):
+        # Caller must hold the condition lock
+        now = time.monotonic()
+        for handle, (message_id, body, visible_at) in list(self._in_flight.items()):
+            if visible_at <= now:
+                del self._in_flight[handle]
+                self._ready.append((message_id, body))
+
+
+def _decode(body: str) -> Any:
+    try:
+        return json.loads(body)
+    except ValueError:
+        return body
+
+
+def _chunks(items: List[Any], size: int = MAX_BATCH):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
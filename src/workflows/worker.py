@@ -0,0 +1,190 @@
+﻿from typing import Dict, Any, List, Optional
+from concurrent.futures import Future
+import argparse
+import os
+import signal
+import threading
+import time
+from observability import metrics
+from observability.structured_logging import get_logger, flush_logs
+from workflows.orchestrator import WorkflowOrchestrator
+from workflows.queue_backends import QueueBackend, SQSQueue, MAX_BATCH
+
+
+logger = get_logger('worker')
+
+
+class WorkflowWorker:
+    '''
+    Consumes workflow requests from a queue and runs them through the orchestrator
+
+    Each message body is {'user_input': ..., 'channel': ...} with an optional
+    'workflow_id' (defaults to the message ID). Messages run on a priority
+    scheduler: besides one message per worker, up to `prefetch` more are
+    held locally so a likely incident can overtake routine reports that
+    arrived before it. Keeping that buffer small bounds how long a message
+    sits locally. A heartbeat keeps extending the visibility of in-flight
+    and buffered messages, which covers slow Bedrock calls.
+    Successful messages are deleted in batches. A failed workflow's message
+    is left alone and is delivered again after its visibility timeout.
+    '''
+
+    def __init__(
+        self,
+        queue: QueueBackend,
+        orchestrator: Optional[WorkflowOrchestrator] = None,
+        workers: int = 4,
+        visibility_timeout: int = 300,
+        wait_seconds: int = 20,
+        prefetch: Optional[int] = None
+    ):
+        self.queue = queue
+        self.orchestrator = orchestrator or WorkflowOrchestrator()
+        self.workers = workers
+        self.visibility_timeout = visibility_timeout
+        self.wait_seconds = wait_seconds
+        self.prefetch = workers if prefetch is None else prefetch
+        self._pool = self.orchestrator.build_scheduler(workers, name='workflow-worker')
+        self._in_flight: Dict[str, Future] = {}
+        self._to_delete: List[str] = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.stats = {'processed': 0, 'failed': 0, 'invalid': 0}
+
+    def run(self, max_messages: Optional[int] = None):
+        '''
+        Poll and process until stop() is called
+
+        With max_messages the worker stops by itself once that many
+        messages have been received (useful for tests and one-off drains).
+        '''
+        heartbeat = threading.Thread(target=self._heartbeat, name='visibility-heartbeat', daemon=True)
+        heartbeat.start()
+        received = 0
+
+        logger.info(f'Started with {self.workers} workers')
+
+        try:
+            while not self._stop.is_set():
+                if max_messages is not None and received >= max_messages:
+                    break
+
+                free = self.workers + self.prefetch - self._in_flight_count()
+                if free <= 0:
+                    # Workers busy and buffer full: wait for one to finish
+                    time.sleep(0.05)
+                    self._flush_deletes()
+                    continue
+
+                batch_size = min(free, MAX_BATCH)
+                if max_messages is not None:
+                    batch_size = min(batch_size, max_messages - received)
+
+                messages = self.queue.receive(batch_size, wait_seconds=self.wait_seconds)
+                received += len(messages)
+
+                for message in messages:
+                    self._dispatch(message)
+
+                self._flush_deletes()
+        finally:
+            self._stop.set()
+            self._pool.shutdown(wait=True)
+            self._flush_deletes()
+            logger.info(f'Stopped: {self.stats}')
+            flush_logs()
+
+    def stop(self):
+        '''Stop polling; in-flight workflows are allowed to finish'''
+        self._stop.set()
+
+    def _dispatch(self, message: Dict[str, Any]):
+        body = message['body']
+        handle = message['receipt_handle']
+
+        if not isinstance(body, dict) or 'user_input' not in body:
+            # Poison message: it will never succeed, so drop it
+            logger.error(f'Invalid workflow message {message["message_id"]}: {body!r}')
+            with self._lock:
+                self.stats['invalid'] += 1
+                self._to_delete.append(handle)
+            return
+
+        # The message ID doubles as the workflow ID, so a redelivered
+        # message resumes from its last checkpoint instead of starting over
+        body = dict(body, workflow_id=body.get('workflow_id') or message['message_id'])
+        priority = self.orchestrator.admission_priority(body)
+        future = self._pool.submit(priority, self.orchestrator.run_isolated, body)
+        with self._lock:
+            self._in_flight[handle] = future
+        future.add_done_callback(lambda f: self._on_done(handle, f))
+
+    def _on_done(self, handle: str, future: Future):
+        state = future.result()
+        with self._lock:
+            self._in_flight.pop(handle, None)
+            if state['status'] == 'failed':
+                self.stats['failed'] += 1
+            else:
+                self.stats['processed'] += 1
+                self._to_delete.append(handle)
+
+    def _flush_deletes(self):
+        with self._lock:
+            handles, self._to_delete = self._to_delete, []
+        if handles:
+            self.queue.delete_batch(handles)
+
+    def _heartbeat(self):
+        '''Extend visibility of in-flight messages well before it lapses'''
+        interval = max(1, self.visibility_timeout // 3)
+        while not self._stop.wait(interval):
+            with self._lock:
+                handles = list(self._in_flight)
+            if handles:
+                try:
+                    self.queue.change_visibility_batch(handles, self.visibility_timeout)
+                except Exception as e:
+                    logger.warning(f'Visibility extension failed: {str(e)}')
+
+    def _in_flight_count(self) -> int:
+        with self._lock:
+            return len(self._in_flight)
+
+
+def main():
+    '''Entry point: PYTHONPATH=src python -m workflows.worker --queue-url ...'''
+    parser = argparse.ArgumentParser(description='Run workflows from the SQS workflow queue')
+    parser.add_argument('--queue-url', default=os.getenv('SQS_QUEUE_URL'))
+    parser.add_argument('--endpoint-url', default=os.getenv('SQS_ENDPOINT_URL'),
+                        help='SQS-compatible endpoint, e.g. a local ElasticMQ')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('WORKER_CONCURRENCY', '4')))
+    parser.add_argument('--visibility-timeout', type=int, default=300)
+    parser.add_argument('--prefetch', type=int, default=os.getenv('WORKER_PREFETCH'),
+                        help='Extra messages buffered for priority ordering (default: --workers)')
+    args = parser.parse_args()
+
+    if not args.queue_url:
+        parser.error('--queue-url or SQS_QUEUE_URL is required')
+
+    worker = WorkflowWorker(
+        SQSQueue(args.queue_url, endpoint_url=args.endpoint_url),
+        workers=args.workers,
+        visibility_timeout=args.visibility_timeout,
+        prefetch=args.prefetch
+    )
+
+    # Expose /metrics when METRICS_PORT is set
+    metrics.start_metrics_server()
+
+    # Finish in-flight work on SIGTERM (e.g. during a deploy)
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        worker.stop()
+
+
+if __name__ == '__main__':
+    main()